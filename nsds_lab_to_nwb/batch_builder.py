@@ -0,0 +1,273 @@
+import glob
+import hashlib
+import json
+import logging.config
+import multiprocessing
+import os
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+from nsds_lab_to_nwb.nwb_builder import NWBBuilder
+from nsds_lab_to_nwb.utils import get_data_path
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class BatchManifest():
+    """Status of each block of a batch conversion, kept in a local JSON file
+
+    Each block has an entry with
+    - status: 'pending', 'running', 'done' or 'failed'
+    - block_metadata_path: the block metadata the block is converted with
+    - attempts: number of conversions started
+    - started, finished: (str) local ISO time of the last conversion
+    - duration: (float) wall time in seconds of the last conversion
+    - timers: wall time of the build and write steps (see NWBBuilder.report)
+    - output_file, output_bytes, output_hash: path, size and sha256 of the NWB file
+    - error: message and traceback of the last failure
+    The file is saved after each change of status, so that an interrupted batch can be resumed.
+    Blocks that were still 'running' when the batch was interrupted are converted again.
+    """
+
+    statuses = ('pending', 'running', 'done', 'failed')
+
+    def __init__(self, path):
+        self.path = path
+        self.blocks = OrderedDict()
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                self.blocks = json.load(f, object_pairs_hook=OrderedDict)['blocks']
+
+    def add(self, block_folder, block_metadata_path):
+        '''Add a pending entry for a new block. Existing entries keep their status.'''
+        if block_folder not in self.blocks:
+            self.blocks[block_folder] = OrderedDict([('status', 'pending'), ('attempts', 0)])
+        self.blocks[block_folder]['block_metadata_path'] = block_metadata_path
+        return self.blocks[block_folder]
+
+    def is_done(self, block_folder):
+        '''True if the block has been converted and its NWB file still exists.'''
+        entry = self.blocks.get(block_folder, {})
+        return entry.get('status') == 'done' and os.path.isfile(entry.get('output_file') or '')
+
+    def update(self, block_folder, **kwargs):
+        '''Update the entry of a block, and save the manifest.'''
+        status = kwargs.get('status')
+        if status is not None and status not in self.statuses:
+            raise ValueError('unknown status {}'.format(status))
+        self.blocks[block_folder].update(kwargs)
+        self.save()
+
+    def count(self):
+        '''Number of blocks per status.'''
+        counts = OrderedDict((status, 0) for status in self.statuses)
+        for entry in self.blocks.values():
+            counts[entry['status']] += 1
+        return counts
+
+    def save(self):
+        '''Write the manifest to a temporary file first, so that it is never left half written.'''
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        temp_file = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(temp_file, 'w') as f:
+            json.dump({'blocks': self.blocks}, f, indent=2)
+        os.replace(temp_file, self.path)
+
+
+class BatchBuilder():
+    """Convert a batch of blocks to NWB files with NWBBuilder, in a pool of processes
+
+    The progress of the batch is recorded in a BatchManifest. Running the same batch again
+    skips the blocks that are done, and converts the pending blocks and the blocks that were
+    interrupted (and the failed blocks, if retry_failed is set).
+
+    If a worker process dies (e.g., killed for running out of memory), the blocks that were being
+    converted are marked as failed, and the remaining blocks are converted in a new pool.
+    """
+
+    default_manifest_name = 'batch_manifest.json'
+
+    # the builder of each block runs a read-ahead thread next to the writer (see WriteProfile),
+    # and its own threads and processes are limited to one (see _convert_block)
+    default_num_workers = max(1, (os.cpu_count() or 1) // 2)
+
+    def __init__(self, save_path, block_metadata_path, manifest_path=None, num_workers=None,
+                 retry_failed=False, **builder_kwargs):
+        '''
+        Args:
+        - save_path: (str) path to save the NWB files (see NWBBuilder)
+        - block_metadata_path: (str) block metadata of all blocks, i.e., the block CSV of the animal.
+                               '{block_folder}' is replaced by the block folder, e.g., for the YAML
+                               file of each legacy block.
+        - manifest_path: (str) path of the manifest (default: batch_manifest.json in save_path)
+        - num_workers: (int) number of blocks converted in parallel processes (default: half the
+                       number of CPUs). 0 converts the blocks one after another in this process.
+        - retry_failed: (bool) also convert the blocks that failed in a previous run
+        - builder_kwargs: passed on to the NWBBuilder of each block. In worker processes, num_threads
+                          and num_processes default to 1, since the blocks already run in parallel.
+        '''
+        self.save_path = save_path
+        self.block_metadata_path = block_metadata_path
+        self.manifest = BatchManifest(manifest_path or os.path.join(save_path, self.default_manifest_name))
+        self.num_workers = self.default_num_workers if num_workers is None else num_workers
+        self.retry_failed = retry_failed
+        self.builder_kwargs = builder_kwargs
+        self.__start_times = {}
+
+    @staticmethod
+    def find_blocks(patterns, data_path=None):
+        '''
+        Expand block folders and glob patterns of block folders (e.g., 'RVG02_B*') into the list
+        of block folders. Patterns are matched against the block folders in the animal folders
+        of the data path.
+        '''
+        block_folders = []
+        for pattern in patterns:
+            if glob.has_magic(pattern):
+                matches = sorted(os.path.basename(path) for path in
+                                 glob.glob(os.path.join(get_data_path(data_path), '*', pattern))
+                                 if os.path.isdir(path))
+                if not matches:
+                    logger.warning('No block folder matches {}'.format(pattern))
+            else:
+                matches = [pattern]
+            block_folders.extend(match for match in matches if match not in block_folders)
+        return block_folders
+
+    def get_block_metadata_path(self, block_folder):
+        return self.block_metadata_path.replace('{block_folder}', block_folder)
+
+    def run(self, block_folders):
+        '''
+        Convert the blocks that are not done yet.
+
+        Returns:
+        - counts: (dict) number of blocks per status
+        '''
+        todo = []
+        for block_folder in block_folders:
+            entry = self.manifest.add(block_folder, self.get_block_metadata_path(block_folder))
+            if self.manifest.is_done(block_folder):
+                continue
+            if entry['status'] == 'failed' and not self.retry_failed:
+                logger.info('Skipping {}, which failed before'.format(block_folder))
+                continue
+            entry['status'] = 'pending'
+            todo.append(block_folder)
+        self.manifest.save()
+        logger.info('Converting {} of {} blocks'.format(len(todo), len(block_folders)))
+
+        if self.num_workers == 0:
+            for block_folder in todo:
+                self.__start(block_folder)
+                try:
+                    result = _convert_block(block_folder, self.manifest.blocks[block_folder]['block_metadata_path'],
+                                            self.save_path, self.builder_kwargs)
+                except Exception:
+                    self.__finish(block_folder, error=traceback.format_exc())
+                else:
+                    self.__finish(block_folder, result=result)
+            return self.manifest.count()
+
+        pending = list(todo)
+        while pending:
+            self.__run_pool(pending)
+        return self.manifest.count()
+
+    def __run_pool(self, pending):
+        '''
+        Internal helper function used to convert the pending blocks in a pool of worker processes.
+        The blocks are removed from pending once they are submitted. Returns early if a worker dies,
+        as the pool is then broken, with the remaining blocks left in pending.
+        '''
+        # spawn rather than fork the workers, as the builders start threads and processes of their own
+        mp_context = multiprocessing.get_context('spawn')
+        builder_kwargs = dict(self.builder_kwargs)
+        builder_kwargs.setdefault('num_threads', 1)
+        builder_kwargs.setdefault('num_processes', 1)
+        with ProcessPoolExecutor(max_workers=self.num_workers, mp_context=mp_context) as pool:
+            running = {}
+            while pending or running:
+                # only submit as many blocks as there are workers, so that 'running' is accurate
+                while pending and len(running) < self.num_workers:
+                    block_folder = pending.pop(0)
+                    self.__start(block_folder)
+                    future = pool.submit(_convert_block, block_folder,
+                                         self.manifest.blocks[block_folder]['block_metadata_path'],
+                                         self.save_path, builder_kwargs)
+                    running[future] = block_folder
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                broken = False
+                for future in done:
+                    block_folder = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        self.__finish(block_folder, result=future.result())
+                        continue
+                    broken = broken or isinstance(error, BrokenProcessPool)
+                    self.__finish(block_folder, error=''.join(traceback.format_exception(
+                        type(error), error, error.__traceback__)))
+                if broken:
+                    # all blocks in the pool fail with the worker that died
+                    logger.error('A worker process died, converting the remaining blocks in a new pool')
+                    wait(running)
+                    for future, block_folder in running.items():
+                        error = future.exception() or BrokenProcessPool('the process pool is broken')
+                        self.__finish(block_folder, error=''.join(traceback.format_exception(
+                            type(error), error, error.__traceback__)))
+                    return
+
+    def __start(self, block_folder):
+        '''
+        Internal helper function used to record the start of the conversion of a block.
+        '''
+        logger.info('Converting {}...'.format(block_folder))
+        entry = self.manifest.blocks[block_folder]
+        self.manifest.update(block_folder, status='running', attempts=entry['attempts'] + 1,
+                             started=datetime.now().isoformat(), finished=None, duration=None, error=None)
+        self.__start_times[block_folder] = time.perf_counter()
+
+    def __finish(self, block_folder, result=None, error=None):
+        '''
+        Internal helper function used to record the result (or error) of the conversion of a block.
+        '''
+        duration = time.perf_counter() - self.__start_times.pop(block_folder)
+        if error is not None:
+            logger.error('Converting {} failed:\n{}'.format(block_folder, error))
+            self.manifest.update(block_folder, status='failed', finished=datetime.now().isoformat(),
+                                 duration=duration, error=error)
+        else:
+            logger.info('{} has been converted in {:.1f} s'.format(block_folder, duration))
+            self.manifest.update(block_folder, status='done', finished=datetime.now().isoformat(),
+                                 duration=duration, **result)
+
+
+def hash_file(path, block_size=16 * 1024 * 1024):
+    '''Returns the sha256 hex digest of a file.'''
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _convert_block(block_folder, block_metadata_path, save_path, builder_kwargs):
+    '''
+    Build and write the NWB file of one block (run in a worker process).
+    Returns the output_file, output_bytes, output_hash and timers of the block's manifest entry.
+    '''
+    nwb_builder = NWBBuilder(block_folder=block_folder, save_path=save_path,
+                             block_metadata_path=block_metadata_path, **builder_kwargs)
+    nwb_content = nwb_builder.build()
+    output_file = nwb_builder.write(nwb_content)
+    timers = dict(nwb_builder.report.timers) if nwb_builder.report is not None else {}
+    return {'output_file': os.path.abspath(output_file),
+            'output_bytes': os.path.getsize(output_file),
+            'output_hash': hash_file(output_file),
+            'timers': timers}
@@ -0,0 +1,189 @@
+import queue
+import threading
+
+import numpy as np
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk
+
+
+class BufferedChunkIterator(AbstractDataChunkIterator):
+    """Read the chunks of another data chunk iterator ahead while the previous chunks are written
+
+    hdmf asks an iterator for a chunk, writes it to the HDF5 file and only then asks for the next one,
+    so that reading and writing never overlap. This iterator runs the wrapped iterator in a background
+    producer thread, which copies its chunks into a ring of num_buffers preallocated buffers of
+    buffer_size bytes, while the HDF5 writer drains the filled buffers. A buffer is reused once the
+    writer asks for the next chunk, i.e., once the chunk in it has been written. Chunks that are larger
+    than a buffer are split along the first axis (at multiples of the recommended chunk shape of the
+    wrapped iterator), so that at most num_buffers buffers and one chunk of the wrapped iterator are
+    held in memory at any time.
+    """
+
+    default_num_buffers = 2
+    """
+    Default number of buffers in the ring (double buffering).
+    """
+
+    default_buffer_size = 64 * 1024 * 1024
+    """
+    Default size in bytes of a single buffer.
+    """
+
+    def __init__(self, data, num_buffers=None, buffer_size=None):
+        """
+
+        Args:
+            data (AbstractDataChunkIterator): the iterator to read ahead
+            num_buffers (int, optional): number of buffers in the ring. Defaults to default_num_buffers.
+            buffer_size (int, optional): size in bytes of each buffer. Defaults to default_buffer_size,
+                                         or to the size of the whole dataset if that is smaller.
+        """
+        self.data = data
+        self.num_buffers = max(1, int(num_buffers or self.default_num_buffers))
+        self.buffer_size = self.__get_buffer_size(buffer_size)
+        self.__buffers = None
+        self.__free = queue.Queue()
+        self.__filled = queue.Queue()
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__current = None
+        self.__done = False
+
+    def __get_buffer_size(self, buffer_size):
+        """
+        Internal helper function used to determine the buffer size, which is never larger than the data.
+        """
+        buffer_size = int(buffer_size or self.default_buffer_size)
+        maxshape = self.data.maxshape
+        if maxshape is not None and all(dim is not None for dim in maxshape):
+            data_size = int(np.prod(maxshape, dtype='int64')) * np.dtype(self.data.dtype).itemsize
+            buffer_size = min(buffer_size, max(1, data_size))
+        return buffer_size
+
+    def __iter__(self):
+        """Return the iterator object"""
+        return self
+
+    def __next__(self):
+        """Return the next buffered chunk or raise a StopIteration exception if all chunks have been read."""
+        if self.__done:
+            raise StopIteration
+        # The previous chunk has been written, so that its buffer can be filled again
+        if self.__current is not None:
+            self.__free.put(self.__current)
+            self.__current = None
+        if self.__thread is None:
+            self.__start()
+        kind, index, item = self.__filled.get()
+        if kind == 'done':
+            self.close()
+            raise StopIteration
+        if kind == 'error':
+            self.close()
+            raise item
+        self.__current = index
+        return item
+
+    next = __next__
+
+    def __start(self):
+        """
+        Internal helper function used to allocate the buffers and to start the producer thread.
+        """
+        self.__buffers = [np.empty(self.buffer_size, dtype=np.uint8) for _ in range(self.num_buffers)]
+        for index in range(self.num_buffers):
+            self.__free.put(index)
+        self.__thread = threading.Thread(target=self.__produce, name='BufferedChunkIterator', daemon=True)
+        self.__thread.start()
+
+    def __produce(self):
+        """
+        Internal helper function run by the producer thread. Copies the chunks of the wrapped iterator
+        into free buffers and queues them for the writer.
+        """
+        try:
+            for chunk in self.data:
+                for data, selection in self.__split(chunk):
+                    index = self.__get_free_buffer()
+                    if index is None:
+                        return
+                    if data.nbytes <= self.buffer_size:
+                        buffered = self.__buffers[index][:data.nbytes].view(data.dtype).reshape(data.shape)
+                        buffered[...] = data
+                        data = buffered
+                    # else: the chunk cannot be split to fit into a buffer and is passed on as it is
+                    self.__filled.put(('chunk', index, DataChunk(data, selection)))
+        except BaseException as e:
+            self.__filled.put(('error', None, e))
+        else:
+            self.__filled.put(('done', None, None))
+
+    def __get_free_buffer(self):
+        """
+        Internal helper function used to wait for a free buffer. Returns None if the iterator was closed.
+        """
+        while not self.__stop.is_set():
+            try:
+                return self.__free.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def __split(self, chunk):
+        """
+        Internal helper function used to split a chunk along the first axis into pieces that fit into a buffer.
+        """
+        data = np.asarray(chunk.data)
+        selection = chunk.selection
+        is_tuple = isinstance(selection, tuple)
+        selections = selection if is_tuple else (selection,)
+        first = selections[0] if len(selections) > 0 else None
+        if (data.nbytes <= self.buffer_size or data.ndim == 0 or data.shape[0] == 0 or
+                not isinstance(first, slice) or first.step not in (None, 1)):
+            yield data, selection
+            return
+        row_bytes = data.nbytes // data.shape[0]
+        rows = self.buffer_size // row_bytes
+        chunk_shape = self.data.recommended_chunk_shape()
+        if chunk_shape is not None and rows >= chunk_shape[0]:
+            rows -= rows % chunk_shape[0]
+        if rows == 0:
+            yield data, selection
+            return
+        offset = first.start or 0
+        for start in range(0, data.shape[0], rows):
+            stop = min(start + rows, data.shape[0])
+            piece_selection = (slice(offset + start, offset + stop),) + selections[1:]
+            yield data[start:stop], piece_selection if is_tuple else piece_selection[0]
+
+    def close(self):
+        """
+        Stop the producer thread and close the wrapped iterator (if it can be closed).
+        """
+        self.__done = True
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        self.__buffers = None
+        self.__current = None
+        close = getattr(self.data, 'close', None)
+        if close is not None:
+            close()
+
+    def recommended_chunk_shape(self):
+        """Recommend the chunk shape of the wrapped iterator"""
+        return self.data.recommended_chunk_shape()
+
+    def recommended_data_shape(self):
+        """Recommend the initial shape of the wrapped iterator"""
+        return self.data.recommended_data_shape()
+
+    @property
+    def dtype(self):
+        """Data type of the wrapped iterator"""
+        return self.data.dtype
+
+    @property
+    def maxshape(self):
+        """Maximum shape of the wrapped iterator"""
+        return self.data.maxshape
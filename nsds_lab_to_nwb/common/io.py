@@ -1,7 +1,14 @@
+import contextlib
 import json
+import logging
 import yaml
 import csv
 
+import h5py
+
+logger = logging.getLogger(__name__)
+
+
 def read_yaml(file_path):
     with open(file_path, 'r') as stream:
         metadata_dict = yaml.safe_load(stream)
@@ -16,3 +23,55 @@ def csv_to_dict(csv_file):
     if ('key', 'value') in mydict.items():
         mydict.pop('key')
     return mydict
+
+
+BACKUP_GROUP = 'replace_groups_backup'
+
+
+@contextlib.contextmanager
+def replace_groups(path, group_paths):
+    '''
+    Context manager replacing groups (or datasets) of an HDF5 file. The old groups are moved aside
+    into a backup group, so that new groups can be written in their place in the with block.
+    They are deleted once the with block succeeds, and moved back if it raises, i.e., the file
+    never loses the old groups before the new ones have been written.
+
+    A backup left by an interrupted replacement (e.g., a killed process) is restored first.
+
+    Args:
+    - path: (str) path to the HDF5 file
+    - group_paths: (list) absolute paths of the groups in the file
+    '''
+    group_paths = list(group_paths)
+    with h5py.File(path, 'a') as h5_file:
+        if BACKUP_GROUP in h5_file:
+            logger.warning('Restoring the groups of an interrupted replacement in {}'.format(path))
+            _restore_groups(h5_file)
+        backup = h5_file.create_group(BACKUP_GROUP)
+        backup.attrs['group_paths'] = json.dumps(group_paths)
+        for index, group_path in enumerate(group_paths):
+            if group_path in h5_file:
+                h5_file.move(group_path, '{}/{}'.format(BACKUP_GROUP, index))
+    try:
+        yield
+    except BaseException:
+        logger.error('Restoring the previous {} in {}'.format(group_paths, path))
+        with h5py.File(path, 'a') as h5_file:
+            _restore_groups(h5_file)
+        raise
+    # note, HDF5 does not reclaim the space of deleted objects; use h5repack to shrink the file
+    with h5py.File(path, 'a') as h5_file:
+        del h5_file[BACKUP_GROUP]
+
+
+def _restore_groups(h5_file):
+    '''
+    Internal helper function used to replace the (partially) written groups by their backup.
+    '''
+    backup = h5_file[BACKUP_GROUP]
+    for index, group_path in enumerate(json.loads(backup.attrs['group_paths'])):
+        if group_path in h5_file:
+            del h5_file[group_path]
+        if str(index) in backup:
+            h5_file.move('{}/{}'.format(BACKUP_GROUP, index), group_path)
+    del h5_file[BACKUP_GROUP]
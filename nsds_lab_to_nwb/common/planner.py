@@ -0,0 +1,178 @@
+import json
+import os
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+
+from nsds_lab_to_nwb.common.write_profile import WriteProfile
+
+
+class ThroughputTable():
+    """Read/write throughput and compression ratio per kind of dataset, used to predict a conversion
+
+    The default rates are rough figures for local disks. Calibrate the table with the throughput
+    reports of previous conversions (see ThroughputReport) that used the same write profile.
+    The default compression ratio of a compressed kind is likewise only a rough guess.
+    """
+
+    default_read_mb_per_s = 100.
+    default_write_mb_per_s = 200.
+    default_compression_ratio = 2.
+
+    def __init__(self, rates=None):
+        '''
+        Args:
+        - rates: (dict) for each kind, a dict with read_mb_per_s, write_mb_per_s and compression_ratio.
+                 Missing entries use the defaults.
+        '''
+        self.rates = dict(rates or {})
+
+    @classmethod
+    def from_reports(cls, report_files):
+        '''Calibrate the table with the JSON throughput reports of previous conversions.'''
+        totals = {}
+        for report_file in report_files:
+            with open(report_file, 'r') as f:
+                report = json.load(f)
+            for counter in report['datasets']:
+                total = totals.setdefault(counter['kind'], {'bytes_read': 0, 'read_time': 0.,
+                                                            'data_bytes': 0, 'write_time': 0.,
+                                                            'stored_data_bytes': 0, 'bytes_written': 0})
+                if counter['read_wall_time']:
+                    total['bytes_read'] += counter['bytes_read']
+                    total['read_time'] += counter['read_wall_time']
+                if counter['data_bytes'] and counter['write_wall_time']:
+                    total['data_bytes'] += counter['data_bytes']
+                    total['write_time'] += counter['write_wall_time']
+                if counter['data_bytes'] and counter['bytes_written']:
+                    total['stored_data_bytes'] += counter['data_bytes']
+                    total['bytes_written'] += counter['bytes_written']
+
+        rates = {}
+        for kind, total in totals.items():
+            rates[kind] = {}
+            if total['read_time'] > 0:
+                rates[kind]['read_mb_per_s'] = total['bytes_read'] / total['read_time'] / 1e6
+            if total['write_time'] > 0:
+                rates[kind]['write_mb_per_s'] = total['data_bytes'] / total['write_time'] / 1e6
+            if total['bytes_written'] > 0:
+                rates[kind]['compression_ratio'] = total['stored_data_bytes'] / total['bytes_written']
+        return cls(rates)
+
+    def get_rates(self, kind, compressed):
+        '''Return the (read_mb_per_s, write_mb_per_s, compression_ratio) of a kind of dataset.'''
+        rates = self.rates.get(kind, {})
+        compression_ratio = rates.get('compression_ratio',
+                                      self.default_compression_ratio if compressed else 1.)
+        return (rates.get('read_mb_per_s', self.default_read_mb_per_s),
+                rates.get('write_mb_per_s', self.default_write_mb_per_s),
+                compression_ratio)
+
+
+class ConversionPlanner():
+    """Estimate the output size, peak memory and duration of a conversion from the dataset headers
+
+    The datasets are described by the originators (see NWBBuilder.plan), i.e., by their shape and
+    dtype, whether they are held in memory until the NWB file is written (in_memory), and how many
+    bytes their reader holds at a time while they are written (chunk_bytes). No data is read.
+
+    - output bytes: the size of the data divided by the compression ratio of its kind
+    - peak memory: all datasets held in memory, plus the largest reader and write pipeline
+      (datasets are written one after another), plus the chunk cache of the write profile
+    - duration: read and write time of each dataset. With the write pipeline, the reads and
+      writes of streamed datasets overlap, i.e., the slower of the two is counted.
+    """
+
+    def __init__(self, write_profile=None, throughput=None):
+        '''
+        Args:
+        - write_profile: (str, dict or WriteProfile) profile the datasets will be written with
+        - throughput: (ThroughputTable) measured throughput (default: ThroughputTable defaults)
+        '''
+        self.write_profile = WriteProfile.get(write_profile)
+        self.throughput = throughput or ThroughputTable()
+
+    def plan(self, descriptions, output_file=None):
+        '''
+        Args:
+        - descriptions: (list) description (dict) of each dataset, with name and kind
+        - output_file: (str) path of the NWB file, to check the free disk space
+
+        Returns:
+        - plan: (dict) estimates per dataset and in total
+        '''
+        pipeline = self.write_profile.pipeline
+        datasets = []
+        resident_bytes = 0
+        working_bytes = 0
+        for description in descriptions:
+            dataset = self.__plan_dataset(description, pipeline)
+            datasets.append(dataset)
+            if description['in_memory']:
+                resident_bytes += dataset['data_bytes']
+            working_bytes = max(working_bytes, dataset['memory_bytes'] if not description['in_memory'] else 0)
+
+        chunk_cache_bytes = self.write_profile.chunk_cache.get('rdcc_nbytes', 1024 * 1024)
+        total = OrderedDict([
+            ('data_bytes', sum(d['data_bytes'] for d in datasets)),
+            ('output_bytes', sum(d['output_bytes'] for d in datasets)),
+            ('peak_memory_bytes', resident_bytes + working_bytes + chunk_cache_bytes),
+            ('duration', sum(d['duration'] for d in datasets)),
+        ])
+        plan = OrderedDict([('datasets', datasets), ('total', total)])
+        if output_file is not None:
+            plan['free_disk_bytes'] = shutil.disk_usage(os.path.dirname(os.path.abspath(output_file))).free
+        plan['available_memory_bytes'] = self.get_available_memory()
+        return plan
+
+    def __plan_dataset(self, description, pipeline):
+        '''
+        Internal helper function used to estimate the size, memory and duration of a single dataset.
+        '''
+        kind = description['kind']
+        dtype = np.dtype(description['dtype'])
+        shape = tuple(int(dim) for dim in description['shape'])
+        options = self.write_profile.settings.get(kind) or {}
+        if options.get('quantize') and dtype.kind == 'f':
+            # assumes that the quantization is detected (otherwise the data is written as is)
+            dtype = np.dtype('int16' if options['quantize'] is True else options['quantize'])
+        data_bytes = int(np.prod(shape, dtype='int64')) * dtype.itemsize
+        read_mb_per_s, write_mb_per_s, compression_ratio = self.throughput.get_rates(
+            kind, compressed=options.get('compression') is not None)
+
+        read_time = data_bytes / 1e6 / read_mb_per_s
+        write_time = data_bytes / 1e6 / write_mb_per_s
+        streamed = not description['in_memory']
+        if streamed and pipeline['num_buffers']:
+            memory_bytes = ((description.get('chunk_bytes') or 0) +
+                            pipeline['num_buffers'] * min(pipeline['buffer_size'], data_bytes))
+            duration = max(read_time, write_time)
+        elif streamed:
+            memory_bytes = description.get('chunk_bytes') or 0
+            duration = read_time + write_time
+        else:
+            memory_bytes = data_bytes
+            duration = read_time + write_time
+
+        return OrderedDict([
+            ('name', description['name']),
+            ('kind', kind),
+            ('shape', list(shape)),
+            ('dtype', dtype.str),
+            ('streamed', streamed),
+            ('data_bytes', data_bytes),
+            ('output_bytes', int(data_bytes / compression_ratio)),
+            ('memory_bytes', int(memory_bytes)),
+            ('read_time', read_time),
+            ('write_time', write_time),
+            ('duration', duration),
+        ])
+
+    @staticmethod
+    def get_available_memory():
+        '''Available physical memory in bytes, or None if it cannot be determined.'''
+        try:
+            return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            return None
@@ -0,0 +1,145 @@
+import numpy as np
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk
+
+
+class QuantizationError(ValueError):
+    """Raised if data that was detected as quantized cannot be stored exactly as integers"""
+    pass
+
+
+def find_quantization(sample, dtype='int16'):
+    '''
+    Detect whether the float values of a sample are integer codes scaled by a constant, i.e.,
+    sample == float32(codes * conversion + offset) exactly, with codes in the range of dtype.
+
+    Args:
+    - sample: (array) float data, e.g., windows read from a stream
+    - dtype: integer dtype of the codes
+
+    Returns:
+    - (conversion, offset): or None if the sample is not quantized (or too small to tell)
+    '''
+    values = np.unique(np.asarray(sample, dtype='float32'))
+    if len(values) < 2 or not np.all(np.isfinite(values)):
+        return None
+    values = values.astype('float64')
+    info = np.iinfo(dtype)
+    # rough estimate: the float32 rounding of large values blurs their differences
+    step = np.min(np.diff(values))
+
+    # try a pure scaling first (e.g., ADC values), then an offset at a value in the middle of the range
+    middle = values[np.argmin(np.abs(values - (values[0] + values[-1]) / 2))]
+    for offset in (0., middle):
+        conversion = _fit_conversion(values, offset, step)
+        if conversion is None:
+            continue
+        codes = np.round((values - offset) / conversion)
+        if codes.min() < info.min or codes.max() > info.max:
+            continue
+        if np.array_equal((codes * conversion + offset).astype('float32'), values.astype('float32')):
+            return float(conversion), float(offset)
+    return None
+
+
+def _fit_conversion(values, offset, step):
+    '''
+    Internal helper function used to refine a rough step into the conversion of the codes.
+
+    The codes of the values closest to the offset are exact even with a rough step, so the conversion
+    is fitted on these first, and then on ever more values. As each value is the float32 rounding of
+    codes * conversion + offset, the conversion is finally chosen in the middle of the interval
+    allowed by all values (a least squares fit may miss values close to a rounding boundary).
+    '''
+    centered = values - offset
+    order = np.argsort(np.abs(centered))
+    num_values = 8
+    while True:
+        subset = centered[order[:num_values]]
+        codes = np.round(subset / step)
+        if not np.any(codes):
+            return None
+        step = np.dot(codes, subset) / np.dot(codes, codes)
+        if num_values >= len(centered):
+            break
+        num_values *= 4
+
+    codes = np.round(centered / step)
+    nonzero = codes != 0
+    values32 = values[nonzero].astype('float32')
+    below = (values[nonzero] + np.nextafter(values32, np.float32(-np.inf)).astype('float64')) / 2
+    above = (values[nonzero] + np.nextafter(values32, np.float32(np.inf)).astype('float64')) / 2
+    bounds = np.sort([(below - offset) / codes[nonzero], (above - offset) / codes[nonzero]], axis=0)
+    low, high = bounds[0].max(), bounds[1].min()
+    if low > high:
+        return step
+    return (low + high) / 2
+
+
+def quantize(data, conversion, offset, dtype='int16'):
+    '''
+    Convert float data to integer codes, such that data == float32(codes * conversion + offset).
+
+    Returns:
+    - codes: (array) or None if the round trip is not exact for all values
+    '''
+    data = np.asarray(data)
+    codes = np.round((data.astype('float64') - offset) / conversion)
+    info = np.iinfo(dtype)
+    if codes.size and (codes.min() < info.min or codes.max() > info.max):
+        return None
+    if not np.array_equal((codes * conversion + offset).astype(data.dtype), data):
+        return None
+    return codes.astype(dtype)
+
+
+class QuantizedChunkIterator(AbstractDataChunkIterator):
+    """Convert the float chunks of another data chunk iterator to integer codes
+
+    Each chunk is checked for an exact round trip. WriteProfile.quantize checks the whole data before
+    it wraps an iterator, so a chunk that cannot be stored exactly (a QuantizationError, rather than a
+    loss of information) means that the data changed between the check and the write.
+    """
+
+    def __init__(self, data, conversion, offset, dtype='int16'):
+        self.data = data
+        self.conversion = conversion
+        self.offset = offset
+        self.__dtype = np.dtype(dtype)
+
+    def __iter__(self):
+        """Return the iterator object"""
+        return self
+
+    def __next__(self):
+        """Return the next chunk of the wrapped iterator as integer codes"""
+        chunk = next(self.data)
+        codes = quantize(chunk.data, self.conversion, self.offset, dtype=self.__dtype)
+        if codes is None:
+            raise QuantizationError('data at {} is not quantized with conversion {} and offset {}'.format(
+                chunk.selection, self.conversion, self.offset))
+        return DataChunk(codes, chunk.selection)
+
+    next = __next__
+
+    def close(self):
+        close = getattr(self.data, 'close', None)
+        if close is not None:
+            close()
+
+    def recommended_chunk_shape(self):
+        """Recommend the chunk shape of the wrapped iterator"""
+        return self.data.recommended_chunk_shape()
+
+    def recommended_data_shape(self):
+        """Recommend the initial shape of the wrapped iterator"""
+        return self.data.recommended_data_shape()
+
+    @property
+    def dtype(self):
+        """Integer data type of the codes"""
+        return self.__dtype
+
+    @property
+    def maxshape(self):
+        """Maximum shape of the wrapped iterator"""
+        return self.data.maxshape
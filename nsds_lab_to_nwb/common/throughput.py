@@ -0,0 +1,250 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import h5py
+import numpy as np
+from hdmf.data_utils import AbstractDataChunkIterator
+
+
+class DatasetCounter():
+    """Throughput counters of a single dataset written to the NWB file
+
+    - bytes_read: number of bytes read from the input files (or returned by the reader)
+    - read_wall_time, read_cpu_time: time spent reading the data. The CPU time is that of the
+      thread reading the data, i.e., without the CPU time of the reader's own helper threads.
+    - write_wall_time, write_cpu_time: time spent by the writer (hdmf/h5py) on the chunks of the
+      data, including the compression. Only measured for data written through an iterator.
+    - wait_time: time the writer waited for the next chunk to be read. A large wait time means
+      that the dataset is bound by the reads, rather than by the compression or the writes.
+    - data_bytes: uncompressed size of the dataset
+    - bytes_written: size of the dataset in the HDF5 file
+    """
+
+    def __init__(self, name, kind):
+        self.name = name
+        self.kind = kind
+        self.bytes_read = 0
+        self.read_wall_time = 0.
+        self.read_cpu_time = 0.
+        self.write_wall_time = None
+        self.write_cpu_time = None
+        self.wait_time = None
+        self.data_bytes = None
+        self.bytes_written = None
+        self.__lock = threading.Lock()
+
+    def __getstate__(self):
+        # the counters of the device files are returned by worker processes (see NeuralDataOriginator)
+        state = self.__dict__.copy()
+        del state['_DatasetCounter__lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+    def add_read(self, nbytes, wall_time, cpu_time):
+        with self.__lock:
+            self.bytes_read += int(nbytes)
+            self.read_wall_time += wall_time
+            self.read_cpu_time += cpu_time
+
+    def add_write(self, wall_time, cpu_time, wait_time):
+        with self.__lock:
+            self.write_wall_time = (self.write_wall_time or 0.) + wall_time
+            self.write_cpu_time = (self.write_cpu_time or 0.) + cpu_time
+            self.wait_time = (self.wait_time or 0.) + wait_time
+
+    @contextmanager
+    def count_read(self, nbytes=0):
+        '''Count the time spent in the with block as read time.'''
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield self
+        finally:
+            self.add_read(nbytes, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+
+    def to_dict(self):
+        def rate(nbytes, seconds):
+            if nbytes is None or not seconds:
+                return None
+            return nbytes / seconds / 1e6
+
+        compression_ratio = None
+        if self.data_bytes and self.bytes_written:
+            compression_ratio = self.data_bytes / self.bytes_written
+        return OrderedDict([
+            ('name', self.name),
+            ('kind', self.kind),
+            ('bytes_read', self.bytes_read),
+            ('data_bytes', self.data_bytes),
+            ('bytes_written', self.bytes_written),
+            ('compression_ratio', compression_ratio),
+            ('read_wall_time', self.read_wall_time),
+            ('read_cpu_time', self.read_cpu_time),
+            ('read_mb_per_s', rate(self.bytes_read, self.read_wall_time)),
+            ('write_wall_time', self.write_wall_time),
+            ('write_cpu_time', self.write_cpu_time),
+            ('write_mb_per_s', rate(self.data_bytes, self.write_wall_time)),
+            ('wait_time', self.wait_time),
+        ])
+
+
+class CountingChunkIterator(AbstractDataChunkIterator):
+    """Count the bytes and the time of the chunks of another data chunk iterator
+
+    On the 'read' side, the time spent in the wrapped iterator is counted as read time.
+    On the 'write' side, the time between the requests for the next chunk is counted as write time
+    (hdmf writes each chunk before it asks for the next one), and the time spent in the wrapped
+    iterator as wait time.
+    """
+
+    def __init__(self, data, counter, side='read'):
+        if side not in ('read', 'write'):
+            raise ValueError('unknown side {}'.format(side))
+        self.data = data
+        self.counter = counter
+        self.side = side
+        self.__last_wall = None
+        self.__last_cpu = None
+
+    def __iter__(self):
+        """Return the iterator object"""
+        return self
+
+    def __next__(self):
+        """Return the next chunk of the wrapped iterator, counting its bytes and time."""
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        if self.side == 'write' and self.__last_wall is not None:
+            # the previous chunk has been written
+            write_wall, write_cpu = wall_start - self.__last_wall, cpu_start - self.__last_cpu
+        else:
+            write_wall, write_cpu = 0., 0.
+        try:
+            chunk = next(self.data)
+        except StopIteration:
+            if self.side == 'write':
+                self.counter.add_write(write_wall, write_cpu, 0.)
+            raise
+        finally:
+            wall_time = time.perf_counter() - wall_start
+            cpu_time = time.thread_time() - cpu_start
+        if self.side == 'read':
+            self.counter.add_read(np.asarray(chunk.data).nbytes, wall_time, cpu_time)
+        else:
+            self.counter.add_write(write_wall, write_cpu, wall_time)
+            self.__last_wall, self.__last_cpu = time.perf_counter(), time.thread_time()
+        return chunk
+
+    next = __next__
+
+    def close(self):
+        close = getattr(self.data, 'close', None)
+        if close is not None:
+            close()
+
+    def recommended_chunk_shape(self):
+        """Recommend the chunk shape of the wrapped iterator"""
+        return self.data.recommended_chunk_shape()
+
+    def recommended_data_shape(self):
+        """Recommend the initial shape of the wrapped iterator"""
+        return self.data.recommended_data_shape()
+
+    @property
+    def dtype(self):
+        """Data type of the wrapped iterator"""
+        return self.data.dtype
+
+    @property
+    def maxshape(self):
+        """Maximum shape of the wrapped iterator"""
+        return self.data.maxshape
+
+
+class ThroughputReport():
+    """Throughput counters of all datasets of a conversion, reported as JSON
+
+    The counters are created by WriteProfile.wrap (see WriteProfile.report), and the sizes of the
+    datasets in the file are filled in by update_storage once the NWB file has been written.
+    """
+
+    # HDF5 path of the data of each kind of dataset in the NWB file
+    paths = {
+        'electrical_series': '/acquisition/{}/data',
+        'mark': '/stimulus/presentation/{}/data',
+        'stimulus': '/stimulus/presentation/{}/data',
+    }
+
+    def __init__(self):
+        self.counters = OrderedDict()
+        self.timers = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get_counter(self, name, kind):
+        '''Return the counter of the dataset, creating it if needed.'''
+        with self.__lock:
+            if name not in self.counters:
+                self.counters[name] = DatasetCounter(name, kind)
+            return self.counters[name]
+
+    def add_counter(self, counter):
+        '''Add the counter of a dataset that was counted elsewhere, e.g., in a worker process
+        writing a device file. It replaces the counter of the dataset, if any.'''
+        with self.__lock:
+            self.counters[counter.name] = counter
+
+    def add_time(self, name, seconds):
+        '''Record the wall time of a step of the conversion (e.g., of the whole build or write step).'''
+        self.timers[name] = self.timers.get(name, 0.) + seconds
+
+    def wrap_read(self, name, kind, data):
+        '''Count the reads of the data of a dataset.'''
+        counter = self.get_counter(name, kind)
+        if isinstance(data, AbstractDataChunkIterator):
+            maxshape = data.maxshape
+            if maxshape is not None and all(dim is not None for dim in maxshape):
+                counter.data_bytes = int(np.prod(maxshape, dtype='int64')) * np.dtype(data.dtype).itemsize
+            return CountingChunkIterator(data, counter, side='read')
+        # the data has already been read (see DatasetCounter.count_read)
+        nbytes = getattr(data, 'nbytes', None)
+        if nbytes is not None:
+            counter.data_bytes = int(nbytes)
+            counter.bytes_read += int(nbytes)
+        return data
+
+    def wrap_write(self, name, kind, data):
+        '''Count the writes of the data of a dataset.'''
+        if not isinstance(data, AbstractDataChunkIterator):
+            return data
+        return CountingChunkIterator(data, self.get_counter(name, kind), side='write')
+
+    def update_storage(self, path):
+        '''Read the size in the file of each counted dataset from the written NWB file. The external
+        links to device files are followed, so that the size of a linked dataset is that in its file.'''
+        with h5py.File(path, 'r') as h5_file:
+            for counter in self.counters.values():
+                dataset = h5_file.get(self.paths[counter.kind].format(counter.name))
+                if dataset is None:
+                    continue
+                counter.bytes_written = int(dataset.id.get_storage_size())
+                if counter.data_bytes is None:
+                    counter.data_bytes = int(dataset.size * dataset.dtype.itemsize)
+
+    def to_dict(self):
+        return OrderedDict([
+            ('datasets', [counter.to_dict() for counter in self.counters.values()]),
+            ('timers', OrderedDict(self.timers)),
+        ])
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def write(self, path):
+        '''Write the report to a JSON file.'''
+        with open(path, 'w') as f:
+            f.write(self.to_json())
+        return path
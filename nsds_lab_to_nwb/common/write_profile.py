@@ -0,0 +1,341 @@
+import contextlib
+import copy
+import os
+
+import h5py
+import numpy as np
+from hdmf.backends.hdf5 import H5DataIO
+from hdmf.data_utils import AbstractDataChunkIterator
+
+from nsds_lab_to_nwb.common.buffered_iterator import BufferedChunkIterator
+from nsds_lab_to_nwb.common.io import read_yaml
+from nsds_lab_to_nwb.common.quantization import QuantizedChunkIterator, find_quantization, quantize
+
+
+class WriteProfile():
+    """HDF5 storage settings (chunking, filters and chunk cache) of the datasets written to NWB
+
+    The settings are chosen per kind of data:
+    - 'electrical_series': the (time, channels) neural data of each device
+    - 'mark': the recorded mark track
+    - 'stimulus': the stimulus WAV track
+
+    Each kind maps to a dict with the keys
+    - chunk_time: (int) number of samples per chunk along the time axis
+    - chunk_channels: (int) number of channels per chunk (None: all channels)
+    - compression: (str) 'gzip', 'lzf' or None
+    - compression_opts: (int) gzip level
+    - shuffle: (bool) apply the HDF5 shuffle filter before compressing
+    - quantize: (bool or str) store float data as integer codes (True: 'int16') if a sample of
+      the data turns out to be integer codes scaled by a constant (see WriteProfile.quantize)
+    A kind that is missing or maps to None is written with the hdmf defaults.
+
+    The 'chunk_cache' entry holds the rdcc_nbytes, rdcc_nslots and rdcc_w0 arguments
+    of the h5py file the NWB file is written with. The cache should be large enough to
+    hold one row of chunks across all channels, otherwise a chunk written in several
+    time windows is compressed and read back again for each window.
+
+    The 'pipeline' entry holds the num_buffers and buffer_size (in bytes) of the ring of buffers
+    through which the data of iterators is read ahead while the previous chunks are written
+    (see BufferedChunkIterator). num_buffers 0 reads and writes each chunk in turn, as hdmf does.
+
+    If a ThroughputReport is set as the report of the profile, the reads and writes of the
+    wrapped datasets are counted in it.
+
+    The profile keeps the iterators it wraps, so that close() stops their read-ahead threads
+    if the writer gives up before it has consumed them (e.g., when the write fails).
+
+    A profile is given as the name of a preset (see WriteProfile.presets), a dict with
+    the above entries, or the path to a YAML file holding such a dict.
+    """
+
+    kinds = ('electrical_series', 'mark', 'stimulus')
+
+    presets = {
+        # hdmf defaults: contiguous datasets without compression
+        'none': {},
+        # best compression for archival
+        'gzip': {
+            'electrical_series': {'chunk_time': 16384, 'chunk_channels': 16,
+                                  'compression': 'gzip', 'compression_opts': 4, 'shuffle': True},
+            'mark': {'chunk_time': 65536, 'compression': 'gzip', 'compression_opts': 4, 'shuffle': True},
+            'stimulus': {'chunk_time': 65536, 'compression': 'gzip', 'compression_opts': 4, 'shuffle': True},
+            'chunk_cache': {'rdcc_nbytes': 64 * 1024 * 1024, 'rdcc_nslots': 10007},
+        },
+        # faster to write and read back, at a lower compression ratio
+        'lzf': {
+            'electrical_series': {'chunk_time': 16384, 'chunk_channels': 16,
+                                  'compression': 'lzf', 'shuffle': True},
+            'mark': {'chunk_time': 65536, 'compression': 'lzf', 'shuffle': True},
+            'stimulus': {'chunk_time': 65536, 'compression': 'lzf', 'shuffle': True},
+            'chunk_cache': {'rdcc_nbytes': 64 * 1024 * 1024, 'rdcc_nslots': 10007},
+        },
+    }
+
+    default_preset = 'none'
+
+    # number and length (in samples) of the windows read to detect the quantization of a stream
+    quantize_num_windows = 8
+    quantize_window_size = 4096
+    # maximum number of bytes per window read to check the quantization of a whole stream
+    quantize_check_bytes = 64 * 1024 * 1024
+
+    default_pipeline = {'num_buffers': BufferedChunkIterator.default_num_buffers,
+                        'buffer_size': BufferedChunkIterator.default_buffer_size}
+
+    def __init__(self, profile=None, num_buffers=None, buffer_size=None, quantize=None):
+        '''
+        Args:
+        - profile: (str or dict) name of a preset, path to a YAML file, or dict of settings.
+                   None uses the default preset.
+        - num_buffers: (int) overrides the number of buffers of the write pipeline
+        - buffer_size: (int) overrides the size in bytes of each buffer of the write pipeline
+        - quantize: (bool or str) overrides the quantization of the e-series
+        '''
+        if profile is None:
+            profile = self.default_preset
+        if isinstance(profile, str):
+            if profile in self.presets:
+                settings = copy.deepcopy(self.presets[profile])
+            elif os.path.isfile(profile):
+                settings = read_yaml(profile) or {}
+            else:
+                raise ValueError('unknown write profile {}. Available presets: {}'.format(
+                    profile, list(self.presets.keys())))
+        else:
+            settings = copy.deepcopy(dict(profile))
+
+        unknown = set(settings.keys()) - set(self.kinds) - {'chunk_cache', 'pipeline'}
+        if unknown:
+            raise ValueError('unknown entries in write profile: {}'.format(sorted(unknown)))
+        pipeline = dict(self.default_pipeline)
+        pipeline.update(settings.get('pipeline') or {})
+        if num_buffers is not None:
+            pipeline['num_buffers'] = num_buffers
+        if buffer_size is not None:
+            pipeline['buffer_size'] = buffer_size
+        settings['pipeline'] = pipeline
+        if quantize is not None:
+            settings['electrical_series'] = dict(settings.get('electrical_series') or {}, quantize=quantize)
+        self.settings = settings
+        self.report = None
+        self.__iterators = []
+
+    @classmethod
+    def get(cls, profile=None, num_buffers=None, buffer_size=None, quantize=None):
+        '''Return profile if it is already a WriteProfile (and no settings are
+        overridden), otherwise create one from it.'''
+        if isinstance(profile, cls):
+            if num_buffers is None and buffer_size is None and quantize is None:
+                return profile
+            profile = profile.settings
+        return cls(profile, num_buffers=num_buffers, buffer_size=buffer_size, quantize=quantize)
+
+    @property
+    def chunk_cache(self):
+        return dict(self.settings.get('chunk_cache') or {})
+
+    @property
+    def pipeline(self):
+        return dict(self.settings['pipeline'])
+
+    def count_read(self, kind, name):
+        '''Context manager counting the time spent in the with block as the read time of the
+        dataset (if the profile has a report). Used around the reads of array data.
+        '''
+        if self.report is None or name is None:
+            return contextlib.nullcontext()
+        return self.report.get_counter(name, kind).count_read()
+
+    def quantize(self, kind, data, read_window=None):
+        '''Store float data as integer codes if the profile quantizes the given kind.
+
+        The conversion and offset are detected on windows spread across the data, which are read
+        with read_window (arrays are sliced). The data is then checked as a whole, and is kept as
+        float if the round trip is not exact (e.g., if the sample missed a finer step of the data).
+        Iterator data is checked window by window through read_window (an extra read pass over the
+        data), since the integer dataset cannot be turned back into float once it is being written.
+        It is then wrapped in a QuantizedChunkIterator.
+
+        Args:
+        - kind: (str) one of WriteProfile.kinds
+        - data: (array or AbstractDataChunkIterator) time-first float data
+        - read_window: (function) read_window(start, stop) returns the (time, channels) data
+                       of samples start to stop. Required for iterators.
+
+        Returns:
+        - (data, conversion, offset): conversion 1. and offset 0. if the data is unchanged
+        '''
+        options = self.settings.get(kind) or {}
+        dtype = options.get('quantize')
+        if not dtype or np.dtype(getattr(data, 'dtype', 'int8')).kind != 'f':
+            return data, 1., 0.
+        if dtype is True:
+            dtype = 'int16'
+
+        shape = self.__get_shape(data)
+        if shape is None or shape[0] is None:
+            return data, 1., 0.
+        num_samples = shape[0]
+        if read_window is None:
+            if isinstance(data, AbstractDataChunkIterator):
+                raise ValueError('read_window is required to quantize an iterator')
+            read_window = lambda start, stop: data[start:stop]  # noqa: E731
+        window_size = min(self.quantize_window_size, num_samples)
+        starts = np.unique(np.linspace(0, num_samples - window_size, self.quantize_num_windows).astype('int64'))
+        sample = np.concatenate([np.asarray(read_window(start, start + window_size)).ravel()
+                                 for start in starts])
+        quantization = find_quantization(sample, dtype=dtype)
+        if quantization is None:
+            return data, 1., 0.
+        conversion, offset = quantization
+
+        if isinstance(data, AbstractDataChunkIterator):
+            if not self.__is_quantized(read_window, shape, data.dtype, conversion, offset, dtype):
+                return data, 1., 0.
+            return QuantizedChunkIterator(data, conversion, offset, dtype=dtype), conversion, offset
+        codes = quantize(data, conversion, offset, dtype=dtype)
+        if codes is None:
+            return data, 1., 0.
+        return codes, conversion, offset
+
+    def __is_quantized(self, read_window, shape, data_dtype, conversion, offset, dtype):
+        '''
+        Internal helper function used to check that all windows of the data round trip exactly.
+        '''
+        row_bytes = int(np.prod(shape[1:], dtype='int64')) * np.dtype(data_dtype).itemsize
+        window_size = max(1, self.quantize_check_bytes // max(1, row_bytes))
+        for start in range(0, shape[0], window_size):
+            window = read_window(start, min(start + window_size, shape[0]))
+            if quantize(window, conversion, offset, dtype=dtype) is None:
+                return False
+        return True
+
+    def wrap(self, kind, data, name=None):
+        '''Wrap the data of the given kind in an H5DataIO with the settings of the profile.
+        Iterators are first wrapped in a BufferedChunkIterator, so that they are read ahead
+        while they are written. The data is returned unchanged if the profile has no settings
+        for the kind (and no report).
+
+        Args:
+        - kind: (str) one of WriteProfile.kinds
+        - data: (array or AbstractDataChunkIterator) time-first data
+        - name: (str) name of the dataset in the report (the data is not counted if None)
+
+        Returns:
+        - data: (H5DataIO or data)
+        '''
+        if kind not in self.kinds:
+            raise ValueError('unknown data kind {}'.format(kind))
+        count = self.report is not None and name is not None
+        if count:
+            data = self.report.wrap_read(name, kind, data)
+        pipeline = self.settings['pipeline']
+        if isinstance(data, AbstractDataChunkIterator) and pipeline['num_buffers']:
+            data = BufferedChunkIterator(data, num_buffers=pipeline['num_buffers'],
+                                         buffer_size=pipeline['buffer_size'])
+        if count:
+            data = self.report.wrap_write(name, kind, data)
+        if isinstance(data, AbstractDataChunkIterator):
+            self.__iterators.append(data)
+        options = self.settings.get(kind)
+        if not options:
+            return data
+
+        io_kwargs = {}
+        chunks = self.get_chunk_shape(kind, self.__get_shape(data))
+        if chunks is not None:
+            io_kwargs['chunks'] = chunks
+        if options.get('compression') is not None:
+            io_kwargs['compression'] = options['compression']
+            if options.get('compression_opts') is not None:
+                io_kwargs['compression_opts'] = options['compression_opts']
+        if options.get('shuffle', False):
+            io_kwargs['shuffle'] = True
+        if not io_kwargs:
+            return data
+        return H5DataIO(data=data, **io_kwargs)
+
+    def write_dataset(self, parent, name, kind, data, report_name=None):
+        '''Write the data of the given kind to a new dataset of an h5py group, with the
+        settings of the profile. Used to write data to HDF5 files outside of the NWB file.
+
+        Args:
+        - parent: (h5py.Group) group (or file) to create the dataset in
+        - name: (str) name of the dataset
+        - kind: (str) one of WriteProfile.kinds
+        - data: (array or AbstractDataChunkIterator) time-first data
+        - report_name: (str) name of the dataset in the report (the data is not counted if None).
+                       The size of the written dataset is also filled in.
+
+        Returns:
+        - dataset: (h5py.Dataset)
+        '''
+        data = self.wrap(kind, data, name=report_name)
+        io_settings = {}
+        if isinstance(data, H5DataIO):
+            io_settings = dict(data.io_settings)
+            data = data.data
+        if not isinstance(data, AbstractDataChunkIterator):
+            dataset = parent.create_dataset(name, data=data, **io_settings)
+        else:
+            io_settings.pop('maxshape', None)
+            maxshape = tuple(data.maxshape)
+            shape = tuple(data.recommended_data_shape())
+            if shape != maxshape:
+                # only chunked datasets can be extended
+                io_settings.setdefault('chunks', True)
+            try:
+                dataset = parent.create_dataset(name, shape=shape, maxshape=maxshape, dtype=data.dtype,
+                                                **io_settings)
+                for chunk in data:
+                    bounds = chunk.get_min_bounds()
+                    if any(bound > dim for bound, dim in zip(bounds, dataset.shape)):
+                        dataset.id.extend(bounds)
+                    dataset[chunk.selection] = chunk.data
+            finally:
+                self.__close(data)
+        if self.report is not None and report_name is not None:
+            counter = self.report.get_counter(report_name, kind)
+            counter.bytes_written = int(dataset.id.get_storage_size())
+            if counter.data_bytes is None:
+                counter.data_bytes = int(dataset.size * dataset.dtype.itemsize)
+        return dataset
+
+    def get_chunk_shape(self, kind, shape):
+        '''Chunk shape for a dataset of the given kind and shape, clipped to the shape.
+        None lets hdmf choose (or write a contiguous dataset).
+        '''
+        options = self.settings.get(kind) or {}
+        chunk_time = options.get('chunk_time')
+        if chunk_time is None or shape is None or None in shape[:1]:
+            return None
+        chunks = [max(1, min(int(chunk_time), shape[0]))]
+        if len(shape) > 1:
+            chunk_channels = options.get('chunk_channels') or shape[1]
+            chunks.append(max(1, min(int(chunk_channels), shape[1] or int(chunk_channels))))
+            chunks.extend(max(1, dim or 1) for dim in shape[2:])
+        return tuple(chunks)
+
+    def close(self):
+        '''Close the iterators wrapped by the profile. Call once the NWB file has been written
+        (or the write failed), so that no read-ahead thread stays blocked on a full buffer.'''
+        iterators, self.__iterators = self.__iterators, []
+        for data in iterators:
+            self.__close(data)
+
+    @staticmethod
+    def __close(data):
+        close = getattr(data, 'close', None)
+        if close is not None:
+            close()
+
+    def open_file(self, path, mode='w'):
+        '''Open the h5py file to write the NWB file with, using the chunk cache of the profile.'''
+        return h5py.File(path, mode, **self.chunk_cache)
+
+    @staticmethod
+    def __get_shape(data):
+        if isinstance(data, AbstractDataChunkIterator):
+            return data.maxshape
+        return getattr(data, 'shape', None)
@@ -1,31 +1,145 @@
+from collections import OrderedDict
+
+import numpy as np
+from hdmf.common import DynamicTable
 from pynwb.ecephys import ElectricalSeries
 
+from nsds_lab_to_nwb.common.write_profile import WriteProfile
 from nsds_lab_to_nwb.components.htk.readers.instrument import EPhysInstrumentData
 
 
 class HtkManager():
-    def __init__(self, raw_path):
+    def __init__(self, raw_path, prefetch=0, num_threads=None, index_file=True, write_profile=None, decode=True):
+        '''
+        Args:
+        - raw_path: (str) path to the RawHTK directory
+        - prefetch: (int) number of data tiles to read ahead of the NWB writer
+                    in background threads. 0 (default) disables prefetching, as the
+                    write profile already reads the data ahead (see WriteProfile.wrap).
+        - num_threads: (int) number of HTK reader threads (default: prefetch)
+        - index_file: (str or bool) sidecar index caching the layout of the RawHTK
+                      directory (see HTKCollection). True (default) writes the index to the
+                      user cache directory ($XDG_CACHE_HOME or ~/.cache), False disables the index.
+        - write_profile: (str, dict or WriteProfile) HDF5 chunking and compression of the
+                         e-series data (see WriteProfile)
+        - decode: (bool) decode compressed (_C) HTK files to float32. If False, then their int16
+                  values are written as they are stored, and the A/B coefficients of the files become
+                  the conversion and offset of the e-series. If the coefficients differ between
+                  channels (or bands), they are kept in a scaling table instead (see scaling_tables).
+        '''
         self.raw_path = raw_path
+        self.prefetch = prefetch
+        self.num_threads = num_threads
+        self.index_file = index_file
+        self.write_profile = WriteProfile.get(write_profile)
+        self.decode = decode
+        # scaling table of each device whose coefficients differ between channels (see get_series_scaling)
+        self.scaling_tables = OrderedDict()
+
+    # extract only reads the headers, the data is read by the iterator while it is written
+    reads_on_extract = False
 
     def extract(self, device_name, dev_conf, electrode_table_region):
         ''' adapted from mars.HTKNWB.add_raw_htk
         now manages one device at a time
         '''
+        with self.write_profile.count_read('electrical_series', device_name):
+            data, rate = self.get_data(device_name, dev_conf)
+        data, conversion, offset = self.quantize(data)
+        conversion, offset, description = self.get_series_scaling(device_name, conversion, offset)
+
+        # Create the electrical series
+        e_series = ElectricalSeries(name=device_name, #name
+                                    data=self.write_profile.wrap('electrical_series', data, name=device_name), #data
+                                    electrodes=electrode_table_region, #electrode table region
+                                    starting_time=0.0,
+                                    rate=rate,
+                                    conversion=conversion,
+                                    offset=offset,
+                                    description=description)
+        return e_series
+
+    def get_data(self, device_name, dev_conf):
+        ''' returns (data, rate) of one device, where data is an iterator over the
+        time-first data of the HTK files
+        '''
         # Create the instrument reader
         device_reader = EPhysInstrumentData(
                         htkdir=self.raw_path,
                         prefix=dev_conf['prefix'],
                         postfix=dev_conf['ch_ids'],
                         device_name=dev_conf['device_type'],
-                        read_on_create=False)
+                        read_on_create=False,
+                        memmap=True,
+                        index_file=self.index_file,
+                        decode=self.decode)
 
         # Read the raw data with the device_reader
-        device_reader.read_data(create_iterator=True, time_axis_first=True, has_bands=False)
+        device_reader.read_data(create_iterator=True, time_axis_first=True, has_bands=False,
+                                prefetch=self.prefetch, num_threads=self.num_threads)
 
-        # Create the electrical series
-        e_series = ElectricalSeries(name=device_name, #name
-                                    data=device_reader.data, #data
-                                    electrodes=electrode_table_region, #electrode table region
-                                    starting_time=0.0,
-                                    rate=dev_conf['sampling_rate'])
-        return e_series
+        return device_reader.data, dev_conf['sampling_rate']
+
+    def quantize(self, data):
+        ''' stores the iterator returned by get_data as integer codes, if the write profile
+        quantizes the e-series (see WriteProfile.quantize). The quantization is detected on
+        windows read from the HTK files. Returns (data, conversion, offset).
+
+        If compressed HTK files are not decoded, the data already holds their int16 values, and the
+        conversion and offset are those of the file headers. They are arrays of shape
+        (#channels, #bands) if the coefficients differ between the files (see get_series_scaling).
+        '''
+        collection = data.data
+        if not collection.decode and collection.compressed:
+            conversion, offset = collection.get_scaling()
+            if np.all(conversion == conversion.flat[0]) and np.all(offset == offset.flat[0]):
+                return data, float(conversion.flat[0]), float(offset.flat[0])
+            return data, conversion, offset
+
+        def read_window(start, stop):
+            return collection.read_window(start / collection.sample_rate, stop / collection.sample_rate)
+
+        return self.write_profile.quantize('electrical_series', data, read_window=read_window)
+
+    def get_series_scaling(self, device_name, conversion, offset):
+        ''' returns the (conversion, offset, description) of the e-series of a device. If the
+        conversion and offset returned by quantize are arrays, they are kept in the scaling
+        table of the device, and the e-series holds the int16 values with a conversion of 1.
+        '''
+        if not np.ndim(conversion):
+            return conversion, offset, 'no description'
+        table = self.make_scaling_table(device_name, conversion, offset)
+        self.scaling_tables[device_name] = table
+        description = ('int16 values of compressed HTK files. Decode the values of each channel with '
+                       'the conversion and offset in the scaling table {}.'.format(table.name))
+        return 1., 0., description
+
+    @staticmethod
+    def make_scaling_table(device_name, conversion, offset):
+        ''' returns a table with the conversion and offset of each channel (column of the
+        e-series) and band, i.e., the decoded data is data * conversion + offset.
+        '''
+        table = DynamicTable(name='{}_scaling'.format(device_name),
+                             description=('Scaling of the int16 values of the e-series {} per channel and band: '
+                                          'data * conversion + offset'.format(device_name)))
+        table.add_column(name='channel', description='index of the channel in the e-series')
+        table.add_column(name='band', description='index of the band in the HTK file')
+        table.add_column(name='conversion', description='1 / A coefficient of the HTK file')
+        table.add_column(name='offset', description='B / A coefficient of the HTK file')
+        for (channel, band), value in np.ndenumerate(conversion):
+            table.add_row(channel=channel, band=band, conversion=value, offset=offset[channel, band])
+        return table
+
+    def describe(self, device_name, dev_conf):
+        ''' describes the data of one device from the HTK headers, without reading it.
+        Returns a dict with the shape and dtype of the time-first data, the sampling rate,
+        in_memory (always False, the data is read tile by tile) and the number of bytes
+        of the tiles held by the reader (chunk_bytes).
+        '''
+        data, rate = self.get_data(device_name, dev_conf)
+        try:
+            tile_bytes = data.channel_block * data.time_block * np.dtype(data.dtype).itemsize
+            return {'shape': tuple(data.maxshape), 'dtype': np.dtype(data.dtype), 'rate': rate,
+                    'in_memory': False, 'chunk_bytes': tile_bytes * (self.prefetch + 1)}
+        finally:
+            data.close()
@@ -6,6 +6,6 @@ class HtkReader():
 
     @staticmethod
     def read_htk(path):
-        file = HTKFile(path)
-        data = file.read_data()
+        with HTKFile(path) as file:
+            data = file.read_data()
         return data, file.sample_rate
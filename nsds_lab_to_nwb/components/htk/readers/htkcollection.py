@@ -48,12 +48,20 @@ prepare derivative works, incorporate into other computer software, distribute,
 sublicense such enhancements or derivative works thereof, in binary and source code form.
 """
 
+import hashlib
+import json
 import os
+import threading
 import warnings
+import weakref
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 
 import numpy as np
 
-from .htkfile import HTKFile
+from .htkfile import HTKFile, HTKFormat, read_htk_headers
 
 
 class HTKCollection(object):
@@ -82,7 +90,16 @@ class HTKCollection(object):
             should we should divide the sampling rate given in the header by in order to convert the
             rate to the appropriate value in Hz.
     :var bands: 1D numpy array with center of the frequency bands
+    :ivar memmap: Boolean indicating whether channels are opened as lazy np.memmap views in read_channel
+    :ivar max_open_files: Maximum number of HTK files kept open for repeated sample/window reads
+    :ivar index_file: Path of the sidecar index file the directory layout was loaded from or saved to (or None)
     """
+
+    index_version = 1
+    """
+    Version of the format of the sidecar index files. Index files with a different version are ignored.
+    """
+
     def __init__(self,
                  directory,
                  prefix=None,
@@ -93,7 +110,11 @@ class HTKCollection(object):
                  check_consistency=False,
                  sample_rate_base=10000.,
                  noblock=True,
-                 postfix=None):
+                 postfix=None,
+                 memmap=False,
+                 max_open_files=64,
+                 index_file=None,
+                 decode=True):
         """
         Initialize object for management of directory of RAW neural recording in HTK format.
 
@@ -121,6 +142,22 @@ class HTKCollection(object):
         :param noblock: Boolean to indicate that no block index is given in the filename (default=True)
         :type noblock: bool
         :param postfix: Tuple of valid postfix strings values or numpy array of ints with the file index values
+        :param memmap: Open the channels as read-only np.memmap views (see HTKFile.read_data) in read_channel
+                       rather than reading them into memory (default=False)
+        :type memmap: bool
+        :param max_open_files: Maximum number of file handles that are kept open in a least-recently-used pool
+                       to be reused by repeated sample/window reads (default=64). Set to 0 to close the files
+                       after each read. Use close() or the collection as a context manager to close all files.
+        :type max_open_files: int
+        :param index_file: Path of a JSON sidecar index in which the file list, the channel/block maps and
+                       the header metadata of the collection are cached, so that the directory does not need
+                       to be listed and parsed again. The index is invalidated if the modification time of the
+                       directory or the size of any of the files changes. Set to True to write the index to
+                       the default location in the user cache directory, $XDG_CACHE_HOME or ~/.cache (see
+                       get_index_file), or None/False to not use an index (default=None).
+        :param decode: Decode the int16 values of compressed (_C) files to floats. If False, then the int16 values
+                       are read as stored, and dtype is int16. Use get_scaling to get the coefficients of the files.
+        :type decode: bool
 
         :raises: AssertionError is raised if check_consistency if enabled and inconsistencies
                  in metadata are found between HTK files in the collection.
@@ -131,9 +168,23 @@ class HTKCollection(object):
         self.prefix = prefix
         self.noblock = noblock
         self.postfix = postfix if postfix is None else postfix
-        self.htk_files, self.channel_to_file_map, self.file_to_channel_map = self.__get_htk_files()
+        self.memmap = memmap
+        self.max_open_files = max_open_files
+        self.decode = decode
+        self.__file_pool = OrderedDict()
+        self.__file_pool_lock = threading.Lock()
+        self.index_file = None
         self.data = None
-        self.num_samples, self.sample_period, self.sample_rate, self.sample_size, self.parameter_kind, self.num_bands, self.dtype = self.__get_htk_metadata()
+        index_file = self.get_index_file(self.directory) if index_file is True else index_file
+        if not index_file or not self.__load_index(index_file):
+            self.htk_files, self.channel_to_file_map, self.file_to_channel_map = self.__get_htk_files()
+            self.num_samples, self.sample_period, self.sample_rate, self.sample_size, self.parameter_kind, \
+                self.num_bands, self.dtype = self.__get_htk_metadata()
+            if index_file and len(self.htk_files) > 0:
+                self.__save_index(index_file)
+        if not decode and self.compressed:
+            # the index holds the dtype of the decoded data
+            self.dtype = np.dtype('int16')
         if check_consistency:
             assert self.__check_consistency()
         if layout is None:
@@ -148,6 +199,96 @@ class HTKCollection(object):
                                       guess_bands=guess_bands)
         self.shape = (int(len(self.htk_files)), int(self.num_samples), int(self.num_bands))
 
+    @staticmethod
+    def get_index_file(directory):
+        """
+        Get the default location of the sidecar index file of a directory of HTK files.
+        The index is kept in the user cache directory ($XDG_CACHE_HOME or ~/.cache) under a hash of the path
+        of the directory, so that nothing is written into the (often shared or read-only) raw data folders.
+        An index next to the directory can be used by passing its path as index_file.
+
+        :param directory: Directory with the HTK files
+
+        :returns: Path of the index file
+        """
+        directory = os.path.abspath(directory)
+        cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        cache_name = hashlib.sha1(directory.encode('utf-8')).hexdigest() + '.htkindex.json'
+        return os.path.join(cache_dir, 'nsds_lab_to_nwb', cache_name)
+
+    def __get_index_key(self):
+        """
+        Internal helper function used to compute the key of the collection in the sidecar index. The key
+        encodes all parameters that determine the file list and the metadata of the collection.
+        """
+        postfix = self.postfix
+        if postfix is not None:
+            postfix = [type(postfix).__name__, np.asarray(postfix).tolist()]
+        return json.dumps([self.prefix, postfix, bool(self.noblock), self.sample_rate_base])
+
+    def __load_index(self, index_file):
+        """
+        Internal helper function used to initialize the file list, the channel/block maps and the header
+        metadata from the sidecar index, if it is valid.
+
+        :param index_file: Path of the index file
+
+        :returns: Boolean indicating whether the collection was initialized from the index
+        """
+        try:
+            with open(index_file, 'r') as f:
+                entry = json.load(f)['collections'][self.__get_index_key()]
+            if entry['version'] != self.index_version or \
+                    entry['directory_mtime_ns'] != os.stat(self.directory).st_mtime_ns:
+                return False
+            htk_files = [os.path.join(self.directory, filename) for filename in entry['files']]
+            if any(os.stat(filename).st_size != entry['file_size'] for filename in htk_files):
+                return False
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        self.htk_files = htk_files
+        self.channel_to_file_map = np.asarray(entry['channel_to_file_map'], dtype='uint64')
+        self.file_to_channel_map = [tuple(location) for location in entry['file_to_channel_map']]
+        self.num_samples, self.sample_period, self.sample_rate, self.sample_size, \
+            self.parameter_kind, self.num_bands = entry['metadata']
+        self.dtype = np.dtype(entry['dtype'])
+        self.index_file = index_file
+        return True
+
+    def __save_index(self, index_file):
+        """
+        Internal helper function used to save the file list, the channel/block maps and the header metadata
+        to the sidecar index. Entries of the index for other prefix/postfix selections are preserved.
+        Failing to write the index is not an error, since the index is only a cache.
+
+        :param index_file: Path of the index file
+        """
+        entry = {'version': self.index_version,
+                 'directory_mtime_ns': os.stat(self.directory).st_mtime_ns,
+                 'files': [os.path.basename(filename) for filename in self.htk_files],
+                 'file_size': os.stat(self.htk_files[0]).st_size,
+                 'channel_to_file_map': self.channel_to_file_map.tolist(),
+                 'file_to_channel_map': [[int(bi), int(ci)] for bi, ci in self.file_to_channel_map],
+                 'metadata': [self.num_samples, self.sample_period, self.sample_rate, self.sample_size,
+                              self.parameter_kind, self.num_bands],
+                 'dtype': np.dtype(self.dtype).str}
+        try:
+            try:
+                with open(index_file, 'r') as f:
+                    index = json.load(f)
+                index['collections'][self.__get_index_key()] = entry
+            except (OSError, ValueError, KeyError, TypeError):
+                index = {'directory': self.directory, 'collections': {self.__get_index_key(): entry}}
+            os.makedirs(os.path.dirname(index_file), exist_ok=True)
+            # Write to a temporary file first so that concurrent readers never see a partial index
+            temp_file = '%s.%i.tmp' % (index_file, os.getpid())
+            with open(temp_file, 'w') as f:
+                json.dump(index, f)
+            os.replace(temp_file, index_file)
+        except OSError:
+            return
+        self.index_file = index_file
+
     def __get_bands(self, bands_file=None, guess_bands=False):
         """
         Try to construct the bands from the filename. Note, this assumes that the metadata has already been
@@ -259,51 +400,29 @@ class HTKCollection(object):
         NOTE! This function assumes that the list of htk_files has already been computed.
         """
         if len(self.htk_files) > 0:
-            tempfile = HTKFile(self.htk_files[0], sample_rate_base=self.sample_rate_base)
-            num_samples = tempfile.num_samples
-            sample_period = tempfile.sample_period
-            sample_rate = tempfile.sample_rate
-            sample_size = tempfile.sample_size
-            parameter_kind = tempfile.parameter_kind
-            num_bands = tempfile.vector_length
-            dtype = tempfile.read_sample(0).dtype
-            del tempfile
+            with HTKFile(self.htk_files[0], sample_rate_base=self.sample_rate_base) as tempfile:
+                num_samples = tempfile.num_samples
+                sample_period = tempfile.sample_period
+                sample_rate = tempfile.sample_rate
+                sample_size = tempfile.sample_size
+                parameter_kind = tempfile.parameter_kind
+                num_bands = tempfile.vector_length
+                dtype = tempfile.read_sample(0).dtype
             return num_samples, sample_period, sample_rate, sample_size, parameter_kind, num_bands, dtype
 
     def __check_consistency(self):
         """
         Internal helper function used to check that all HTK files in the collection
         have the same structure (i.e, whether the header information of the HTK files
-        is the same for all files).
+        is the same for all files). Only the headers of the files are read (see read_htk_headers).
         NOTE! This function assumes that the list of htk_files has already been computed.
         """
         if len(self.htk_files) <= 1:
             return True
         else:
-            consistent = True
-            tempfile = HTKFile(self.htk_files[0], sample_rate_base=self.sample_rate_base)
-            num_samples1 = tempfile.num_samples
-            sample_period1 = tempfile.sample_period
-            sample_rate1 = tempfile.sample_rate
-            sample_size1 = tempfile.sample_size
-            parameter_kind1 = tempfile.parameter_kind
-            del tempfile
-            for filename in self.htk_files:
-                tempfile = HTKFile(filename, sample_rate_base=self.sample_rate_base)
-                num_samples2 = tempfile.num_samples
-                sample_period2 = tempfile.sample_period
-                sample_rate2 = tempfile.sample_rate
-                sample_size2 = tempfile.sample_size
-                parameter_kind2 = tempfile.parameter_kind
-                consistent &= num_samples1 != num_samples2 or \
-                    sample_period1 != sample_period2 or \
-                    sample_rate1 != sample_rate2 or \
-                    sample_size1 != sample_size2 or \
-                    parameter_kind1 != parameter_kind2
-                del tempfile
-                if not consistent:
-                    break
-            return consistent
+            headers = read_htk_headers(self.htk_files)
+            # The sample rate is computed from the sample period, so comparing the headers is sufficient
+            return bool(np.all(headers == headers[0]))
 
     def __get_htk_files(self):
         """
@@ -320,10 +439,11 @@ class HTKCollection(object):
         :raises: A ValueError is raised in case that HTK files of varying sizes are found.
 
         """
-        # Compute the list of all htk files
-        filelist =  [os.path.join(self.directory, filename)      # Record the full path off all htk files
-                        for filename in os.listdir(self.directory)  # Iterate through all files in the directory
-                        if filename.endswith('.htk')]               # Record all HTK files
+        # Compute the list of all htk files. os.scandir lets us reuse the directory entries to get the file sizes
+        direntries = {os.path.join(self.directory, entry.name): entry   # Record the full path off all htk files
+                      for entry in os.scandir(self.directory)           # Iterate through all files in the directory
+                      if entry.name.endswith('.htk')}                   # Record all HTK files
+        filelist = list(direntries.keys())
         # print(filelist)
         if self.prefix is not None: # Remove all files from the list that do not have the approbriate prefix
             filelist = [filename for filename in filelist if os.path.basename(filename).startswith(self.prefix)]
@@ -348,7 +468,7 @@ class HTKCollection(object):
             warnings.warn('No HTK files found in the given data directory.')
             return [], np.zeros((0, 0), dtype='uint64'), []
         #Check if all files in the list have the same size
-        filesizes = np.asarray([os.path.getsize(path) for path in filelist])
+        filesizes = np.asarray([direntries[path].stat().st_size for path in filelist])
         if len(np.unique(filesizes)) != 1:
             raise ValueError('HTK files of varying size found in the same location. Try to set the prefix filter')
 
@@ -522,17 +642,120 @@ class HTKCollection(object):
         del self.data
         self.data = None
 
-    def read_channel(self, fileindex):
+    @property
+    def compressed(self):
+        """Boolean indicating whether the files store compressed (_C) int16 values"""
+        return bool(len(self.htk_files) > 0 and self.parameter_kind & HTKFormat.param_kind_encoding['_C'])
+
+    def get_scaling(self):
+        """
+        Get the scaling of the values of each file, i.e., the decoded data of a file is
+        values * conversion + offset (see HTKFile.get_scaling). Only the headers of the files are read.
+
+        :returns: Tuple (conversion, offset) of float64 arrays of shape (#files, #bands)
+        """
+        conversion = np.ones((len(self.htk_files), int(self.num_bands)))
+        offset = np.zeros((len(self.htk_files), int(self.num_bands)))
+        if self.compressed:
+            for fileindex in range(len(self.htk_files)):
+                with self.__pooled_file(fileindex) as tempfile:
+                    conversion[fileindex], offset[fileindex] = tempfile.get_scaling()
+        return conversion, offset
+
+    def read_channel(self, fileindex, sample_slice=None):
         """
         Get the data for the file with the given index.
+
+        :param fileindex: Index of the file of interest
+        :param sample_slice: Optional slice object selecting a contiguous range of samples of the channel.
+                             Only the selected samples are read from file (see HTKFile.read_samples).
+
+        :returns: Numpy array of shape (#samples, #bands) with the data of the channel
         """
-        if self.data:
-            return self.data[fileindex]
+        if self.data is not None:
+            if sample_slice is None:
+                return self.data[fileindex]
+            return self.data[fileindex, sample_slice]
+        elif sample_slice is None:
+            # Full reads are not pooled, since the HTKFile keeps a reference to the data it has read
+            with HTKFile(self.htk_files[fileindex], sample_rate_base=self.sample_rate_base) as tempfile:
+                return tempfile.read_data(memmap=self.memmap, decode=self.decode)
         else:
+            # Read only the requested samples with a single read
+            start, stop, step = sample_slice.indices(self.num_samples)
+            if step != 1:
+                raise ValueError('sample_slice must select a contiguous range of samples')
+            with self.__pooled_file(fileindex) as tempfile:
+                return tempfile.read_samples(start, stop, decode=self.decode)
+
+    @contextmanager
+    def __pooled_file(self, fileindex):
+        """
+        Internal helper function used to get an open HTKFile for the file with the given index from the
+        pool of open files. While in use, the file is removed from the pool (so that it cannot be closed
+        by another thread) and it is returned to the pool as most recently used afterwards. The least
+        recently used files are closed once more than max_open_files files are in the pool.
+        """
+        with self.__file_pool_lock:
+            tempfile = self.__file_pool.pop(fileindex, None)
+        if tempfile is None:
             tempfile = HTKFile(self.htk_files[fileindex], sample_rate_base=self.sample_rate_base)
-            return tempfile.read_data()
+        try:
+            yield tempfile
+        finally:
+            evicted = []
+            with self.__file_pool_lock:
+                if fileindex in self.__file_pool:
+                    evicted.append(tempfile)  # Another thread has already returned a handle for the file
+                else:
+                    self.__file_pool[fileindex] = tempfile
+                while len(self.__file_pool) > self.max_open_files:
+                    evicted.append(self.__file_pool.popitem(last=False)[1])
+            for evicted_file in evicted:
+                evicted_file.close()
 
-    def read_data(self, print_status=False):
+    def close(self):
+        """
+        Close all HTK files that are kept open in the pool of open files.
+        """
+        with self.__file_pool_lock:
+            pooled_files = list(self.__file_pool.values())
+            self.__file_pool.clear()
+        for pooled_file in pooled_files:
+            pooled_file.close()
+
+    def __enter__(self):
+        """Use the HTKCollection as a context manager that closes all pooled files on exit"""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read_window(self, t_start, t_stop, channels=None):
+        """
+        Read the data of the time window [t_start, t_stop) for a set of channels.
+        Only the samples of the window are read, with a single read per file at the computed byte offset.
+
+        :param t_start: Start time of the window in seconds
+        :param t_stop: Stop time of the window in seconds
+        :param channels: List of the indices of the files (channels) to be read. Default is None, i.e., all files.
+
+        :returns: Numpy array of shape (#samples, #channels) or (#samples, #channels, #bands)
+                  in case that the collection has more than one band.
+        """
+        if channels is None:
+            channels = range(len(self.htk_files))
+        # All files have the same sample rate and number of samples, so any file gives the sample range
+        with self.__pooled_file(channels[0] if len(channels) > 0 else 0) as htkfile:
+            start, stop = htkfile.get_sample_range(t_start, t_stop)
+        window = np.empty((stop - start, len(channels), int(self.num_bands)), dtype=self.dtype)
+        for i, fileindex in enumerate(channels):
+            window[:, i] = self.read_channel(fileindex, sample_slice=slice(start, stop))
+        if self.num_bands == 1:
+            window = window[..., 0]
+        return window
+
+    def read_data(self, print_status=False, num_workers=None):
         """
         Read all data from file and return the numpy array.
         This function modifies self.data to safe the data
@@ -541,7 +764,19 @@ class HTKCollection(object):
         :param print_status: One of [True, False, 'jupyter']. True means-Print status message on
                         read progress on screen. 'jupyter' means create a progress bar in a Jupyter notebook.
                         False means, don't show process. Default is False.
+        :param num_workers: Number of processes used to read the files in parallel. If larger than 1, then
+                        the data is allocated in a multiprocessing.shared_memory block and each worker reads
+                        a disjoint range of files directly into it, i.e., no channel data is pickled.
+                        self.data is then a view on the shared memory, which is released once the array
+                        (and all views on it) have been deleted.
+                        Default is None, i.e., read all files sequentially in this process.
         """
+        if num_workers is not None and num_workers > 1 and self.data is None and len(self.htk_files) > 1:
+            self.data = self.__read_data_parallel(num_workers)
+            if print_status is True:
+                print('Reading HTK Collection: [100%]')
+            return self.data
+
         if print_status == True:
             import sys
         elif print_status == 'jupyter':
@@ -561,10 +796,9 @@ class HTKCollection(object):
                                      str(int(100. * float(fileindex) / float(len(self.htk_files)-1))) +
                                      "%]" + "\r")
                     sys.stdout.flush()
-                tempfile = HTKFile(filename, sample_rate_base=self.sample_rate_base)
-                #datalist[fileindex] = tempfile.read_data()
-                self.data[fileindex] = tempfile.read_data()
-                del tempfile
+                with HTKFile(filename, sample_rate_base=self.sample_rate_base) as tempfile:
+                    #datalist[fileindex] = tempfile.read_data()
+                    self.data[fileindex] = tempfile.read_data(decode=self.decode)
             if print_status:
                 print('')
             #Convert the data to numpy and make sure we have a 2D shaped array if we only have one frequency band
@@ -572,6 +806,69 @@ class HTKCollection(object):
         # Return the full data
         return self.data
 
+    def __read_data_parallel(self, num_workers):
+        """
+        Internal helper function used to read all files with a pool of processes into shared memory.
+
+        :param num_workers: Number of worker processes
+
+        :returns: Numpy array of shape self.shape that is backed by a shared memory block. The block is
+                  closed when the array is garbage-collected.
+        """
+        dtype = np.dtype(self.dtype)
+        block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(self.shape)) * dtype.itemsize))
+        # Split the files into contiguous, disjoint ranges, one per task
+        num_workers = min(num_workers, len(self.htk_files))
+        boundaries = np.linspace(0, len(self.htk_files), num_workers + 1).astype('int')
+        try:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                futures = [executor.submit(_read_htk_files_into_shared_memory,
+                                           block.name, self.shape, dtype.str,
+                                           self.htk_files[start:stop], start, self.sample_rate_base,
+                                           self.decode)
+                           for start, stop in zip(boundaries[:-1], boundaries[1:])]
+                for future in futures:
+                    future.result()
+        except Exception:
+            block.close()
+            raise
+        finally:
+            # the workers are done with the name, the mapping of this process stays valid
+            block.unlink()
+        data = np.ndarray(self.shape, dtype=dtype, buffer=block.buf)
+        # numpy does not keep the buffer of the block exported, so the block must only be closed
+        # (i.e., unmapped) once the array and all views on it are gone
+        weakref.finalize(data, block.close)
+        return data
+
+
+def _read_htk_files_into_shared_memory(shared_memory_name, shape, dtype, filenames, start_index, sample_rate_base,
+                                       decode=True):
+    """
+    Read the given HTK files into the rows [start_index, start_index+len(filenames)) of a
+    shared memory array. This is the task executed by the workers of HTKCollection.read_data.
+
+    :param shared_memory_name: Name of the multiprocessing.shared_memory block with the output array
+    :param shape: Shape of the output array
+    :param dtype: Numpy dtype string of the output array
+    :param filenames: List of the HTK files to be read
+    :param start_index: Index of the first file in the output array
+    :param sample_rate_base: See HTKFile
+    :param decode: Decode compressed (_C) values to floats (see HTKFile.read_data)
+    """
+    # NOTE: The block is owned (and unlinked) by the parent process. Workers share the resource
+    # tracker of the parent, so attaching here does not register the block a second time.
+    block = shared_memory.SharedMemory(name=shared_memory_name)
+    try:
+        data = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        for i, filename in enumerate(filenames):
+            # The blocks are converted from big-endian (and decoded) directly into the shared memory
+            with HTKFile(filename, sample_rate_base=sample_rate_base) as htkfile:
+                htkfile.read_data_into(data[start_index + i], decode=decode)
+        del data
+    finally:
+        block.close()
+
 
 try:
     #from form.data_utils import DataChunkIterator, DataChunk
@@ -581,13 +878,34 @@ try:
     class HTKChannelIterator(AbstractDataChunkIterator):
         """
         Custom data chunk iterator to iterate over the channels of an HTK collection.
+
+        The iterator reads a block of channels at a time and emits (time_block, channel_block) tiles
+        (or (channel_block, time_block) tiles if time_axis_first is False). The tiles are aligned with the
+        HDF5 chunk shape returned by recommended_chunk_shape, and the number of samples per tile is derived
+        from a memory budget, so that only a single tile is held in memory at any time. The transpose
+        to the time-first layout is therefore done tile by tile rather than on the full data.
         """
+
+        default_chunk_bytes = 1024 * 1024
+        """
+        Target size in bytes of a single HDF5 chunk if no chunk shape is given.
+        """
+
+        default_channel_chunk = 16
+        """
+        Default number of channels per HDF5 chunk if no chunk shape is given.
+        """
+
+        default_memory_budget = 64 * 1024 * 1024
+        """
+        Default maximum size in bytes of a single tile returned by the iterator.
+        """
+
         #@docval({'name': 'data', 'type': HTKCollection, 'doc': 'The HTKCollection to iterate over.'})
         def __init__(self, **kwargs):
             super(HTKChannelIterator, self).__init__()
             self.data = getargs('data',kwargs)
             self.__dtype = getargs('dtype',kwargs)
-            self.current_fileindex = 0
             self.time_axis_first = getargs('time_axis_first', kwargs)
             self.__maxshape = list(getargs('maxshape',kwargs))
             self.__has_bands = getargs('has_bands',kwargs)
@@ -602,72 +920,193 @@ try:
 
             else:
                 self.shape = self.data.shape
-            
+                self.__maxshape = tuple(self.__maxshape)
+                if not self.__has_bands:
+                    self.shape = self.shape[0:2]
+                    self.__maxshape = self.__maxshape[0:2]
+            self.__channel_chunk, self.__time_chunk = self.__get_chunk_size(kwargs.get('chunk_shape', None))
+            self.channel_block, self.time_block = self.__get_block_size(kwargs.get('buffer_size', None),
+                                                                        kwargs.get('memory_budget', None))
+            self.current_fileindex = 0
+            self.current_sampleindex = 0
+            self.prefetch = int(kwargs.get('prefetch', None) or 0)
+            self.num_threads = kwargs.get('num_threads', None) or max(1, self.prefetch)
+            self.__executor = None
+            self.__pending = deque()
 
         @classmethod
-        def from_htk_collection(cls, collection, time_axis_first=False, has_bands=True):
+        def from_htk_collection(cls, collection, time_axis_first=False, has_bands=True,
+                                chunk_shape=None, buffer_size=None, memory_budget=None,
+                                prefetch=0, num_threads=None):
             """
             Convenience function to generate a HTKChannelIterator from an existing HTKCollection
             :param collection: The input HTKCollection for which we should create an iterator
             :type collection: HTKCollection
+            :param chunk_shape: Tuple with the HDF5 chunk shape in the order of the output dimensions.
+                                If None, then a chunk shape of about default_chunk_bytes is used.
+            :param buffer_size: Number of channels to read per tile. Rounded to a multiple of the channels
+                                per chunk. If None, then one chunk of channels is read per tile.
+            :param memory_budget: Maximum number of bytes per tile (default=default_memory_budget).
+            :param prefetch: Number of tiles to read ahead in background threads while the current tile
+                             is consumed. 0 means read each tile synchronously in __next__ (default=0).
+                             Note, up to prefetch+1 tiles are held in memory at any time.
+            :param num_threads: Number of reader threads used for prefetching (default=prefetch).
             :return: HTKChannelIterator for the input HTKCollection
             """
             return cls(data=collection,
                        maxshape=collection.shape,
                        dtype=collection.dtype,
                        time_axis_first=time_axis_first,
-                       has_bands=has_bands)
+                       has_bands=has_bands,
+                       chunk_shape=chunk_shape,
+                       buffer_size=buffer_size,
+                       memory_budget=memory_budget,
+                       prefetch=prefetch,
+                       num_threads=num_threads)
+
+        def __get_chunk_size(self, chunk_shape):
+            """
+            Internal helper function used to determine the number of channels and samples per HDF5 chunk.
+            """
+            num_channels, num_samples, num_bands = self.data.shape
+            if chunk_shape is None:
+                channel_chunk = min(num_channels, self.default_channel_chunk)
+                sample_bytes = np.dtype(self.__dtype).itemsize * num_bands * channel_chunk
+                time_chunk = max(1, self.default_chunk_bytes // sample_bytes)
+            elif self.time_axis_first:
+                time_chunk, channel_chunk = chunk_shape[0], chunk_shape[1]
+            else:
+                channel_chunk, time_chunk = chunk_shape[0], chunk_shape[1]
+            return max(1, min(int(channel_chunk), num_channels)), max(1, min(int(time_chunk), num_samples))
+
+        def __get_block_size(self, buffer_size, memory_budget):
+            """
+            Internal helper function used to determine the number of channels and samples per tile.
+            Tiles always consist of whole chunks (except at the end of the data).
+            """
+            num_channels, num_samples, num_bands = self.data.shape
+            if buffer_size is None:
+                channel_block = self.__channel_chunk
+            else:
+                channel_block = max(1, int(buffer_size) // self.__channel_chunk) * self.__channel_chunk
+            channel_block = min(channel_block, num_channels)
+            if memory_budget is None:
+                memory_budget = self.default_memory_budget
+            chunk_bytes = np.dtype(self.__dtype).itemsize * num_bands * channel_block * self.__time_chunk
+            time_block = max(1, int(memory_budget) // chunk_bytes) * self.__time_chunk
+            return channel_block, min(time_block, num_samples)
 
         @property
         def maxshape(self):
             return self.__maxshape
-        
+
         @property
         def dtype(self):
             return self.__dtype
-        
+
         def __iter__(self):
             """Return the iterator object"""
             return self
-        
+
         def __next__(self):
             """Return the next data chunk or raise a StopIteration exception if all chunks have been retrieved."""
-            next_chunk = []
-            # Determine the range of channels to be read
+            if self.prefetch > 0:
+                return self.__next_prefetched()
+            tile = self.__next_tile()
+            if tile is None:
+                self.close()
+                raise StopIteration
+            return self.__read_tile(*tile)
+
+        def __next_tile(self):
+            """
+            Internal helper function used to determine the (start_index, stop_index, start_sample, stop_sample)
+            range of the next tile and to advance the iterator. Returns None if all tiles have been retrieved.
+            """
+            num_channels, num_samples, num_bands = self.data.shape
+            # Determine the range of channels and samples to be read
             start_index = self.current_fileindex
-            stop_index = start_index + 1 #self.buffer_size
-            if stop_index > self.data.get_number_of_files():
-                stop_index = self.data.get_number_of_files()
-            # Read the data from all current channels
-            for i in range(start_index, stop_index):
-                next_chunk.append(self.data.read_channel(i))  # Read a single HTK file with the data of one electrode
-            next_chunk_size = len(next_chunk)
-            # If didn't read any channels then return None, None
-            if next_chunk_size == 0:
+            if start_index >= num_channels:
+                return None
+            stop_index = min(start_index + self.channel_block, num_channels)
+            start_sample = self.current_sampleindex
+            stop_sample = min(start_sample + self.time_block, num_samples)
+            # Advance to the next block of samples, or to the next block of channels
+            if stop_sample >= num_samples:
+                self.current_fileindex = stop_index
+                self.current_sampleindex = 0
+            else:
+                self.current_sampleindex = stop_sample
+            return start_index, stop_index, start_sample, stop_sample
+
+        def __next_prefetched(self):
+            """
+            Internal helper function used to return the next tile from the prefetch queue. Tiles are read
+            by a pool of reader threads, while the caller (e.g., hdmf) is writing the previous tiles.
+            """
+            if self.__executor is None:
+                self.__executor = ThreadPoolExecutor(max_workers=self.num_threads)
+            # Keep the queue filled up to the prefetch depth
+            while len(self.__pending) < self.prefetch:
+                tile = self.__next_tile()
+                if tile is None:
+                    break
+                self.__pending.append(self.__executor.submit(self.__read_tile, *tile))
+            if len(self.__pending) == 0:
+                self.close()
                 raise StopIteration
-            # If we had data, then determine the chunk location and convert the data to numpy, and return
+            return self.__pending.popleft().result()
+
+        def close(self):
+            """
+            Stop the reader threads used for prefetching (if any), drop all pending tiles and close
+            the files that the HTKCollection keeps open for the tile reads.
+            """
+            for future in self.__pending:
+                future.cancel()
+            self.__pending.clear()
+            if self.__executor is not None:
+                self.__executor.shutdown(wait=True)
+                self.__executor = None
+            self.data.close()
+
+        def __read_tile(self, start_index, stop_index, start_sample, stop_sample):
+            """
+            Internal helper function used to read the tile with the given channel and sample range.
+
+            :returns: DataChunk with the data of the tile and its location in the output
+            """
+            num_bands = self.data.shape[2]
+            sample_slice = slice(start_sample, stop_sample)
+            # Allocate the tile directly in the output layout so that the transpose happens as part of the read
+            if self.time_axis_first:
+                next_chunk = np.empty((stop_sample - start_sample, stop_index - start_index, num_bands),
+                                      dtype=self.__dtype)
+                for i in range(start_index, stop_index):
+                    next_chunk[:, i - start_index] = self.data.read_channel(i, sample_slice=sample_slice)
+                next_chunk_location = np.s_[start_sample:stop_sample, start_index:stop_index]
             else:
-                self.current_fileindex = stop_index
-                next_chunk = np.asarray(next_chunk)
-                if self.time_axis_first:
-                    next_chunk = np.swapaxes(next_chunk, 0, 1)     
-                else:
-                    next_chunk_location = np.s_[start_index:stop_index, ...]
-                    
-                if self.__has_bands:
-                    next_chunk_location = np.s_[:, start_index:stop_index, :]
-                else:
-                    next_chunk_location = np.s_[:, start_index:stop_index]
-                    next_chunk = next_chunk[:,:,0]
-                #print(next_chunk.shape, next_chunk_location)
-                return DataChunk(next_chunk, next_chunk_location)
+                next_chunk = np.empty((stop_index - start_index, stop_sample - start_sample, num_bands),
+                                      dtype=self.__dtype)
+                for i in range(start_index, stop_index):
+                    next_chunk[i - start_index] = self.data.read_channel(i, sample_slice=sample_slice)
+                next_chunk_location = np.s_[start_index:stop_index, start_sample:stop_sample]
+            if self.__has_bands:
+                next_chunk_location += (slice(None),)
+            else:
+                next_chunk = next_chunk[..., 0]
+            return DataChunk(next_chunk, next_chunk_location)
 
         @docval(returns='Tuple with the recommended chunk shape or None if no particular shape is recommended.')
         def recommended_chunk_shape(self):
-            """Recommend a chunk shape. This will typcially be the most common shape of chunk returned by __next__
-            but may also be some other value in case one wants to recommend chunk shapes to optimize read rather
-            than write."""
-            None
+            """Recommend a chunk shape. The tiles returned by __next__ consist of whole chunks of this shape."""
+            if self.time_axis_first:
+                chunk_shape = (self.__time_chunk, self.__channel_chunk)
+            else:
+                chunk_shape = (self.__channel_chunk, self.__time_chunk)
+            if self.__has_bands:
+                chunk_shape += (self.data.shape[2],)
+            return chunk_shape
 
         def recommended_data_shape(self):
             """Recommend an initial shape of the data. This is useful when progressively writing data and
@@ -675,8 +1114,7 @@ try:
             if self.__maxshape is not None:
                 if np.all([i is not None for i in self.__maxshape]):
                     return self.__maxshape
-            return self.__first_chunk_shape
-        
+            return self.shape
 
 
 except ImportError:
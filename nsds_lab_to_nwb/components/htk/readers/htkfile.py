@@ -47,6 +47,8 @@ prepare derivative works, incorporate into other computer software, distribute,
 sublicense such enhancements or derivative works thereof, in binary and source code form.
 """
 
+import os
+from concurrent.futures import ThreadPoolExecutor
 from struct import unpack
 import numpy as np
 import sys
@@ -142,6 +144,17 @@ class HTKFormat(object):
             hf += he['format']
         return hf
 
+    @classmethod
+    def header_dtype(cls):
+        """
+        Get the numpy structured dtype of the header of the HTK file.
+
+        :returns: numpy dtype with one field per header entry, e.g., ('num_samples', '>u4'), with the byte-order
+            of the file.
+        """
+        return np.dtype([(he['name'], cls.byte_order + np.dtype(he['format'].upper()).str[1:])
+                         for he in cls.header])
+
 
 class HTKFile(object):
     """
@@ -162,6 +175,7 @@ class HTKFile(object):
     :ivar sample_size: Number of bytes per sample
     :ivar parameter_kind: Code indicating the sample kind (see HTKFormat for details on parmKind)
     :ivar dtype: Data type
+    :ivar file_dtype: Numpy dtype of the values as stored in the file (i.e., with big-endian byte order)
     :ivar vector_length: Vector length
     :ivar A: Compression parameter
     :ivar B: Compression parameter
@@ -169,10 +183,16 @@ class HTKFile(object):
 
     Internal Variables:
 
-    :ivar __file: The handle to the HTK file
+    :ivar __file: The handle to the HTK file. Use close() or the HTKFile as a context manager to close it.
     :ivar __current_pos: Internal variable used to store the current sample position during iteration
 
     """
+
+    default_block_size = 65536
+    """
+    Default number of samples per block when compressed (_C) data is decoded block by block.
+    """
+
     def __init__(self,
                  filename,
                  sample_rate_base=10000.):
@@ -190,6 +210,7 @@ class HTKFile(object):
         self.__file = open(self.filename, 'rb')
 
         self.data = None  # Numpy array with all data or None
+        self.__data_decoded = False  # Whether self.data holds the decoded floats of a compressed (_C) file
         self.__current_pos = 0  # Current sample position. This variable is used during iteration.
 
         # Read the HTK header to initialize the variables: self.num_samples,
@@ -222,16 +243,56 @@ class HTKFile(object):
                 self.A = 32767
                 self.B = 0
             else:
-                self.A = np.fromfile(self.__file, 'f', self.vector_length)
-                self.B = np.fromfile(self.__file, 'f', self.vector_length)
+                self.A = np.fromfile(self.__file, 'f', int(self.vector_length))
+                self.B = np.fromfile(self.__file, 'f', int(self.vector_length))
                 if self.__swap_required():
                     self.A = self.A.byteswap()
                     self.B = self.B.byteswap()
         else:
             self.dtype = 'f'
             self.vector_length = self.sample_size / 4
+        self.file_dtype = np.dtype(HTKFormat.byte_order + self.dtype)
         self.header_length = self.__file.tell()
 
+    def __enter__(self):
+        """Use the HTKFile as a context manager that closes the file handle on exit"""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close the handle to the HTK file. Data that has already been read (and memmaps
+        returned by read_data) remain valid.
+        """
+        self.__file.close()
+
+    @property
+    def closed(self):
+        """Boolean indicating whether the handle to the HTK file has been closed"""
+        return self.__file.closed
+
+    @property
+    def compressed(self):
+        """Boolean indicating whether the file stores compressed (_C) int16 values"""
+        return bool(self.parameter_kind & HTKFormat.param_kind_encoding['_C'])
+
+    def get_scaling(self):
+        """
+        Get the scaling of the values stored in the file, i.e., the decoded data is
+        values * conversion + offset. For compressed (_C) files this is conversion=1/A and offset=B/A,
+        otherwise the values are stored as floats (conversion=1, offset=0).
+
+        :returns: Tuple (conversion, offset) of float64 arrays with one value per vector dimension
+        """
+        vector_length = int(self.vector_length)
+        if not self.compressed:
+            return np.ones(vector_length), np.zeros(vector_length)
+        a = np.broadcast_to(np.asarray(self.A, dtype='float64'), (vector_length,))
+        b = np.broadcast_to(np.asarray(self.B, dtype='float64'), (vector_length,))
+        return 1. / a, b / a
+
     def __iter__(self):
         """Make the HTKFile iterable"""
         self.__seek_sample(0)
@@ -302,12 +363,137 @@ class HTKFile(object):
                 tempvec = (tempvec.astype('f') + self.B) / self.A
             return tempvec
 
-    def read_data(self):
+    def read_samples(self, start, stop, decode=True):
+        """
+        Read the data of the samples in the range [start, stop) with a single read at the computed byte offset.
+
+        :param start: Index of the first sample to be read
+        :param stop: Index of the sample after the last sample to be read
+        :param decode: Decode compressed (_C) values to floats. If False, then the int16 values are returned
+            as stored (see get_scaling). Default is True.
+
+        :returns: Numpy array of shape (stop-start, #vector_length) with the data of the samples.
+        """
+        start = max(0, min(int(start), self.num_samples))
+        stop = max(start, min(int(stop), self.num_samples))
+        if self.data is not None:
+            if not self.compressed or decode == self.__data_decoded:
+                return self.data[start:stop]
+            if decode:
+                return self.__decode(self.data[start:stop])
+            # The data has been decoded, so the stored values are read from file
+        tempdata = self.__read_raw_samples(start, stop)
+        # Uncompress data to floats if needed, or convert to the native byte order
+        if self.compressed and decode:
+            return self.__decode(tempdata)
+        return tempdata.astype(self.dtype)
+
+    def __read_raw_samples(self, start, stop):
+        """
+        Internal helper function used to read the samples in the range [start, stop) as stored in the file
+        (i.e., big-endian and still compressed for _C files) with a single read at the computed byte offset.
+        """
+        # os.pread does not use (or move) the position of the file handle
+        offset = self.header_length + start * self.sample_size
+        buffer = os.pread(self.__file.fileno(), (stop - start) * self.sample_size, offset)
+        return np.frombuffer(buffer, dtype=self.file_dtype).reshape(-1, int(self.vector_length))
+
+    def __decode(self, codes, out=None):
+        """
+        Internal helper function used to decode a block of compressed (_C) int16 values to floats,
+        i.e., (codes + B) / A, in place in the output array so that no temporaries of the block are created.
+
+        :param codes: Array of shape (#samples, #vector_length) with the int16 values (in any byte order)
+        :param out: float32 array of the same shape the values are decoded into. Default is None, i.e.,
+            allocate a new array.
+
+        :returns: The out array with the decoded values
+        """
+        if out is None:
+            out = np.empty(codes.shape, dtype='f')
+        out[...] = codes
+        out += self.B
+        out /= self.A
+        return out
+
+    def iter_blocks(self, block_size=None):
+        """
+        Iterate over the data in blocks of samples. For compressed (_C) files each block is decoded
+        separately, so that the memory used is bounded by the block size rather than the file size.
+
+        :param block_size: Number of samples per block (default=default_block_size)
+
+        :returns: Generator yielding numpy arrays of shape (#block_samples, #vector_length)
+        """
+        block_size = int(block_size or self.default_block_size)
+        num_samples = self.__get_data_shape()[0]
+        for start in range(0, num_samples, block_size):
+            yield self.read_samples(start, min(start + block_size, num_samples))
+
+    def read_window(self, t_start, t_stop, decode=True):
+        """
+        Read the data of the samples in the time window [t_start, t_stop).
+
+        :param t_start: Start time of the window in seconds
+        :param t_stop: Stop time of the window in seconds
+        :param decode: Decode compressed (_C) values to floats (see read_samples)
+
+        :returns: Numpy array of shape (#samples, #vector_length) with the data of the window.
+        """
+        return self.read_samples(*self.get_sample_range(t_start, t_stop), decode=decode)
+
+    def get_sample_range(self, t_start, t_stop):
+        """
+        Get the range of sample indices [start, stop) of the time window [t_start, t_stop)
+        (rounded to the nearest sample and clipped to the samples in the file).
+
+        :param t_start: Start time of the window in seconds
+        :param t_stop: Stop time of the window in seconds
+        """
+        start = max(0, min(int(round(t_start * self.sample_rate)), self.num_samples))
+        stop = max(start, min(int(round(t_stop * self.sample_rate)), self.num_samples))
+        return start, stop
+
+    def __get_data_shape(self):
+        """
+        Internal helper function used to compute the shape (#vectors, #vector_length) of the
+        data stored in the file based on the size of the payload after the header.
+        """
+        num_values = (os.path.getsize(self.filename) - self.header_length) // self.file_dtype.itemsize
+        # Remove the checksum data
+        if self.parameter_kind & HTKFormat.param_kind_encoding['_K']:
+            num_values -= 1
+        return int(num_values // self.vector_length), int(self.vector_length)
+
+    def read_data(self, memmap=False, block_size=None, decode=True):
         """
         Get a numpy data array of all the samples
 
+        :param memmap: If set to True, then the data is not read into memory but opened as a read-only
+            np.memmap with the big-endian dtype of the file (see file_dtype). The data then stays a lazy
+            view on the file and values are only read (and byteswapped) once they are actually accessed.
+            For compressed (_C) files the memmap is decoded to floats block by block.
+        :param block_size: Number of samples per block when compressed (_C) data is decoded
+            (default=default_block_size). The data is decoded in place into a preallocated float32 array,
+            so that besides the output only a single block of int16 values is held in memory.
+        :param decode: Decode compressed (_C) values to floats. If False, then the int16 values are read
+            like uncompressed data, i.e., without the decode step (see get_scaling). Default is True.
+
         :returns: Numpy data array of all the samples
         """
+        self.__data_decoded = self.compressed and decode
+        if self.__data_decoded:
+            self.data = self.__read_blocks(memmap=memmap, block_size=block_size)
+            return self.data
+
+        if memmap:
+            self.data = np.memmap(self.filename,
+                                  dtype=self.file_dtype,
+                                  mode='r',
+                                  offset=self.header_length,
+                                  shape=self.__get_data_shape())
+            return self.data
+
         # Jump to the beginning of the file
         self.__seek_sample(0)
         # Read all data
@@ -320,8 +506,80 @@ class HTKFile(object):
         tempdata = tempdata.reshape(outshape)
         if self.__swap_required():
             tempdata = tempdata.byteswap()
-        # Uncompress data to floats if needed
-        if self.parameter_kind & HTKFormat.param_kind_encoding['_C']:
-            tempdata = (tempdata.astype('f') + self.B) / self.A
         self.data = tempdata
         return self.data
+
+    def read_data_into(self, out, block_size=None, decode=True):
+        """
+        Read all samples block by block into a preallocated array (e.g., a view on shared memory), without
+        keeping a reference to it in self.data. Compressed (_C) values are decoded in place into the output,
+        so that besides the output only a single block of int16 values is held in memory.
+
+        :param out: Array of shape (#samples, #vector_length) the samples are read into
+        :param block_size: Number of samples per block (default=default_block_size)
+        :param decode: Decode compressed (_C) values to floats (see read_data). Default is True.
+
+        :returns: The out array
+        """
+        return self.__read_blocks(memmap=True, block_size=block_size, decode=self.compressed and decode, out=out)
+
+    def __read_blocks(self, memmap=False, block_size=None, decode=True, out=None):
+        """
+        Internal helper function used to read all samples block by block into a preallocated array,
+        decoding compressed (_C) int16 values to floats.
+
+        :param memmap: Read the blocks from a np.memmap of the file rather than with one read per block
+        :param block_size: Number of samples per block (default=default_block_size)
+        :param decode: Decode the blocks (only for compressed files). If False, then the values are copied as stored.
+        :param out: Output array. Default is None, i.e., allocate a new float32 array.
+        """
+        block_size = int(block_size or self.default_block_size)
+        shape = self.__get_data_shape()
+        data = np.empty(shape, dtype='f') if out is None else out
+        if memmap:
+            codes = np.memmap(self.filename, dtype=self.file_dtype, mode='r', offset=self.header_length, shape=shape)
+        for start in range(0, shape[0], block_size):
+            stop = min(start + block_size, shape[0])
+            block = codes[start:stop] if memmap else self.__read_raw_samples(start, stop)
+            if decode:
+                self.__decode(block, out=data[start:stop])
+            else:
+                data[start:stop] = block
+        return data
+
+
+def read_htk_headers(filenames, num_threads=None):
+    """
+    Read only the fixed-size headers of a list of HTK files.
+
+    The headers are read with one os.pread call per file from a pool of threads, without creating
+    HTKFile objects or reading any of the data.
+
+    :param filenames: List of the HTK files
+    :param num_threads: Number of threads used to read the headers. Default is min(32, len(filenames)).
+
+    :returns: Numpy structured array with one element per file and the fields num_samples, sample_period,
+        sample_size and parameter_kind (see HTKFormat.header) in native byte-order.
+    """
+    header_length = HTKFormat.header_length
+
+    def read_header(filename):
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            header = os.pread(fd, header_length, 0)
+        finally:
+            os.close(fd)
+        if len(header) != header_length:
+            raise ValueError('Incomplete HTK header in %s' % filename)
+        return header
+
+    if len(filenames) == 0:
+        headers = []
+    elif len(filenames) == 1:
+        headers = [read_header(filenames[0])]
+    else:
+        num_threads = num_threads or min(32, len(filenames))
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            headers = list(executor.map(read_header, filenames))
+    header_dtype = HTKFormat.header_dtype()
+    return np.frombuffer(b''.join(headers), dtype=header_dtype).astype(header_dtype.newbyteorder('='))
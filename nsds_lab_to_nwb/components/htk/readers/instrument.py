@@ -104,7 +104,8 @@ class EPhysInstrumentData:
         if read_on_create:
             self.read_data()
 
-    def read_data(self, create_iterator=False, print_status=False, time_axis_first=True, has_bands=True):
+    def read_data(self, create_iterator=False, print_status=False, time_axis_first=True, has_bands=True,
+                  chunk_shape=None, memory_budget=None, prefetch=0, num_threads=None, num_workers=None):
         """
         Read the data for all channels
 
@@ -116,6 +117,15 @@ class EPhysInstrumentData:
         :param print_status: One of [True, False, 'jupyter']. True means-Print status message on
                         read progress on screen. 'jupyter' means create a progress bar in a Jupyter notebook.
                         False means, don't show process. Default is False.
+        :param chunk_shape: HDF5 chunk shape the tiles of the HTKChannelIterator are aligned with
+                        (only used if create_iterator is True). None means use the iterator default.
+        :param memory_budget: Maximum number of bytes per tile of the HTKChannelIterator
+                        (only used if create_iterator is True). None means use the iterator default.
+        :param prefetch: Number of tiles the HTKChannelIterator reads ahead in background threads
+                        (only used if create_iterator is True). Default is 0 (no prefetching).
+        :param num_threads: Number of reader threads used for prefetching (default=prefetch).
+        :param num_workers: Number of processes used to read all channels in parallel into shared memory
+                        (only used if create_iterator is False). Default is None (sequential read).
 
         :return:
         """
@@ -128,9 +138,13 @@ class EPhysInstrumentData:
             # from mars.io.readers.htkcollection import HTKChannelIterator
             self.data = HTKChannelIterator.from_htk_collection(collection=collection,
                                                                time_axis_first=time_axis_first,
-                                                               has_bands=has_bands)
+                                                               has_bands=has_bands,
+                                                               chunk_shape=chunk_shape,
+                                                               memory_budget=memory_budget,
+                                                               prefetch=prefetch,
+                                                               num_threads=num_threads)
         else:
-            self.data = collection.read_data(print_status=print_status)
+            self.data = collection.read_data(print_status=print_status, num_workers=num_workers)
             if time_axis_first:
                 self.data = np.swapaxes(self.data, 0, 1)
         self.sample_rate = collection.sample_rate
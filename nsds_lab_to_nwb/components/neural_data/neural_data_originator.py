@@ -1,4 +1,14 @@
 import logging.config
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
+from hdmf.backends.hdf5 import H5DataIO
+from pynwb.ecephys import ElectricalSeries
+
+from nsds_lab_to_nwb.common.throughput import ThroughputReport
+from nsds_lab_to_nwb.common.write_profile import WriteProfile
 from nsds_lab_to_nwb.components.htk.htk_manager import HtkManager
 from nsds_lab_to_nwb.components.tdt.tdt_manager import TdtManager
 
@@ -6,26 +16,158 @@ logger = logging.getLogger(__name__)
 
 
 class NeuralDataOriginator():
-    def __init__(self, dataset, metadata, use_htk=False):
+    def __init__(self, dataset, metadata, use_htk=False, write_profile=None, htk_decode=True):
         self.dataset = dataset      # this should have all relavant paths
         self.metadata = metadata    # this should have all relevant metadata
+        self.use_htk = use_htk
+        self.write_profile = WriteProfile.get(write_profile)
+        self.htk_decode = htk_decode    # decode compressed HTK files to float32 (see HtkManager)
 
         if use_htk:
             logger.info('Using HTK')
-            self.neural_data_manager = HtkManager(self.dataset.htk_path)
+            self.neural_data_manager = HtkManager(self.dataset.htk_path, write_profile=self.write_profile,
+                                                  decode=htk_decode)
         else:
             logger.info('Using TDT')
-            self.neural_data_manager = TdtManager(self.dataset.tdt_path)
+            self.neural_data_manager = TdtManager(self.dataset.tdt_path, write_profile=self.write_profile)
+        self.__device_files = []
 
-    def make(self, nwb_content, electrode_table_regions):
-        for device_name, dev_conf in self.metadata['device'].items():
-            if isinstance(dev_conf, str): # skip other annotations
-                continue
+    def get_devices(self):
+        '''Returns the list of device names'''
+        return [device_name for device_name, _ in self.__get_device_confs()]
+
+    def __get_device_confs(self):
+        return [(device_name, dev_conf) for device_name, dev_conf in self.metadata['device'].items()
+                if not isinstance(dev_conf, str)] # skip other annotations
 
-            e_series = self.neural_data_manager.extract(device_name, dev_conf,
+    def reads_on_extract(self):
+        '''True if make reads the data of the devices (rather than only their headers),
+        i.e., if extracting the devices concurrently overlaps their reads.'''
+        return self.neural_data_manager.reads_on_extract
+
+    def make(self, nwb_content, electrode_table_regions, executor=None, device_files=None, num_processes=None):
+        '''
+        Args:
+        - nwb_content: (NWBFile) the e-series of all devices are added to its acquisition
+        - electrode_table_regions: (dict) electrode table region for each device
+        - executor: (concurrent.futures.Executor) optional pool in which the devices are
+                    extracted concurrently. The e-series are still added in device order.
+        - device_files: (dict) optional path of an HDF5 file for each device. The data of each
+                        device is then written to its own file in a separate process, and the
+                        e-series link to these files (HDF5 external links) instead of holding
+                        the data. The files must stay next to the NWB file (the links are relative).
+        - num_processes: (int) number of processes writing the device files (default: one per device)
+        '''
+        devices = self.__get_device_confs()
+        if device_files is not None:
+            results = self.__make_linked(devices, electrode_table_regions, device_files, num_processes)
+        elif executor is None:
+            results = (self.neural_data_manager.extract(device_name, dev_conf,
                                                         electrode_table_regions[device_name])
+                       for device_name, dev_conf in devices)
+        else:
+            results = [executor.submit(self.neural_data_manager.extract, device_name, dev_conf,
+                                       electrode_table_regions[device_name])
+                       for device_name, dev_conf in devices]
+            results = (future.result() for future in results)
+
+        for e_series in results:
             if e_series is None:
                 logger.info('No e-series extracted. Skipping...')
             else:
                 logger.info('Adding extracted e-series to NWB...')
                 nwb_content.add_acquisition(e_series)
+
+        if self.use_htk:
+            for table in self.neural_data_manager.scaling_tables.values():
+                logger.info('Adding scaling table {} to NWB...'.format(table.name))
+                nwb_content.add_scratch(table)
+
+    def __make_linked(self, devices, electrode_table_regions, device_files, num_processes):
+        '''
+        Internal helper function used to write the data of each device to its own HDF5 file
+        in parallel processes, and to create the e-series linking to these files.
+        '''
+        raw_path = self.dataset.htk_path if self.use_htk else self.dataset.tdt_path
+        # spawn rather than fork the workers, as other threads of the builder may be running
+        mp_context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=num_processes or len(devices), mp_context=mp_context) as pool:
+            report = self.write_profile.report is not None
+            futures = [pool.submit(_write_device_file, self.use_htk, raw_path, self.write_profile.settings,
+                                   device_name, dev_conf, device_files[device_name], self.htk_decode, report)
+                       for device_name, dev_conf in devices]
+            results = [future.result() for future in futures]
+
+        e_series_list = []
+        for (device_name, dev_conf), result in zip(devices, results):
+            if result is None:
+                e_series_list.append(None)
+                continue
+            rate, conversion, offset, counter = result
+            if counter is not None:
+                # the reads and writes of the device were counted in its worker
+                self.write_profile.report.add_counter(counter)
+            description = 'no description'
+            if self.use_htk:
+                conversion, offset, description = self.neural_data_manager.get_series_scaling(
+                    device_name, conversion, offset)
+            # the file is kept open until the NWB file is written (see close())
+            h5_file = h5py.File(device_files[device_name], 'r')
+            self.__device_files.append(h5_file)
+            e_series_list.append(ElectricalSeries(name=device_name,
+                                                  data=H5DataIO(h5_file['data'], link_data=True),
+                                                  electrodes=electrode_table_regions[device_name],
+                                                  starting_time=0.,
+                                                  rate=rate,
+                                                  conversion=conversion,
+                                                  offset=offset,
+                                                  description=description))
+        return e_series_list
+
+    def describe(self):
+        '''Describe the e-series of all devices from the file headers (see NWBBuilder.plan).'''
+        descriptions = []
+        for device_name, dev_conf in self.__get_device_confs():
+            description = self.neural_data_manager.describe(device_name, dev_conf)
+            if description is not None:
+                description.update(name=device_name, kind='electrical_series')
+                descriptions.append(description)
+        return descriptions
+
+    def close(self):
+        '''Close the device files opened by make(). Call after the NWB file has been written.'''
+        for h5_file in self.__device_files:
+            h5_file.close()
+        self.__device_files = []
+
+
+def _write_device_file(use_htk, raw_path, write_profile, device_name, dev_conf, path, htk_decode=True,
+                       report=False):
+    '''
+    Write the data of one device to the 'data' dataset of its own HDF5 file (run in a worker process).
+    Returns (rate, conversion, offset, counter) of the stored data (see HtkManager.quantize), or None if
+    the device does not exist. counter is the DatasetCounter of the device if report is set, else None.
+    '''
+    write_profile = WriteProfile(write_profile)
+    if report:
+        write_profile.report = ThroughputReport()
+    if use_htk:
+        neural_data_manager = HtkManager(raw_path, write_profile=write_profile, decode=htk_decode)
+    else:
+        neural_data_manager = TdtManager(raw_path, write_profile=write_profile)
+    with write_profile.count_read('electrical_series', device_name):
+        result = neural_data_manager.get_data(device_name, dev_conf)
+    if result is None:
+        return None
+    data, rate = result
+    data, conversion, offset = neural_data_manager.quantize(data)
+    with write_profile.open_file(path, mode='w') as h5_file:
+        dataset = write_profile.write_dataset(h5_file, 'data', 'electrical_series', data,
+                                              report_name=device_name if report else None)
+        # the e-series links to the dataset, so that the attributes of its data are read from here
+        # (per-channel coefficients are kept in a scaling table of the NWB file instead)
+        uniform = not np.ndim(conversion)
+        dataset.attrs.update(conversion=conversion if uniform else 1., offset=offset if uniform else 0.,
+                             resolution=-1., unit='volts')
+    counter = write_profile.report.counters.get(device_name) if report else None
+    return rate, conversion, offset, counter
@@ -1,20 +1,32 @@
+import numpy as np
 from pynwb import TimeSeries
 
+from nsds_lab_to_nwb.common.write_profile import WriteProfile
 from nsds_lab_to_nwb.components.htk.htk_reader import HtkReader
+from nsds_lab_to_nwb.components.htk.readers.htkfile import HTKFile
 
 
 class MarkManager():
-    def __init__(self, mark_path):
+    def __init__(self, mark_path, write_profile=None):
         self.mark_path = mark_path
+        self.write_profile = WriteProfile.get(write_profile)
 
 
+    def describe(self):
+        ''' describes the mark track from its HTK header, without reading it '''
+        with HTKFile(self.mark_path) as file:
+            num_samples, vector_length, rate = file.num_samples, int(file.vector_length), file.sample_rate
+        return {'shape': (num_samples, vector_length), 'dtype': np.dtype('float32'), 'rate': rate,
+                'in_memory': True, 'chunk_bytes': None}
+
     def get_mark_track(self, name='recorded_mark'):
         # Read the mark track
-        mark_track, rate = HtkReader.read_htk(self.mark_path)
+        with self.write_profile.count_read('mark', name):
+            mark_track, rate = HtkReader.read_htk(self.mark_path)
 
         # Create the mark timeseries
         mark_time_series = TimeSeries(name=name,
-                            data=mark_track,
+                            data=self.write_profile.wrap('mark', mark_track, name=name),
                             unit='Volts',
                             starting_time=0.0,
                             rate=rate,
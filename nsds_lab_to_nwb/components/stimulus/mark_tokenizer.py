@@ -4,17 +4,24 @@ from nsds_lab_to_nwb.components.stimulus.tokenizers.wn_tokenizer import WNTokeni
 
 
 class MarkTokenizer():
-    def __init__(self, block_name, stim_configs):
+    def __init__(self, block_name, stim_configs, mark_onsets=None, cross_check=False):
+        '''
+        Args:
+        - mark_onsets: (array) onset times in seconds of the mark events (e.g., TDT epocs).
+                       None means threshold the analog mark track (see StimulusTokenizer).
+        - cross_check: (bool) compare the mark_onsets with the thresholded mark track
+        '''
         self.block_name = block_name
         self.stim_configs = stim_configs
 
+        kwargs = {'mark_onsets': mark_onsets, 'cross_check': cross_check}
         stim_name = self.stim_configs['name']
         if 'tone' in stim_name:
-            self.tokenizer = ToneTokenizer(self.block_name, self.stim_configs)
+            self.tokenizer = ToneTokenizer(self.block_name, self.stim_configs, **kwargs)
         elif 'timit' in stim_name:
-            self.tokenizer = TIMITTokenizer(self.block_name, self.stim_configs)
+            self.tokenizer = TIMITTokenizer(self.block_name, self.stim_configs, **kwargs)
         elif 'wn' in stim_name:
-            self.tokenizer = WNTokenizer(self.block_name, self.stim_configs)
+            self.tokenizer = WNTokenizer(self.block_name, self.stim_configs, **kwargs)
         else:
             raise ValueError('unknown stimulus type')
 
@@ -1,32 +1,115 @@
+import glob
+import logging.config
+import os
+
 from nsds_lab_to_nwb.components.stimulus.mark_manager import MarkManager
 from nsds_lab_to_nwb.components.stimulus.mark_tokenizer import MarkTokenizer
 from nsds_lab_to_nwb.components.stimulus.wav_manager import WavManager
+from nsds_lab_to_nwb.components.tdt.tdt_reader import TDTReader
+
+logger = logging.getLogger(__name__)
 
 
 class StimulusOriginator():
-    def __init__(self, dataset, metadata):
+    def __init__(self, dataset, metadata, onset_source='mark', cross_check=False, write_profile=None):
+        '''
+        Args:
+        - dataset: (Dataset) paths of the input data
+        - metadata: (dict) block metadata
+        - onset_source: (str) where the stimulus onsets come from. 'mark' (default) thresholds
+                        the analog mark track, 'epocs' reads the onset times of the TDT 'mark'
+                        epoc, and 'auto' uses the epocs if the block has them.
+        - cross_check: (bool) when using epocs, also threshold the mark track and warn
+                       if the onsets do not agree
+        - write_profile: (str, dict or WriteProfile) HDF5 chunking and compression of the
+                         mark and stimulus tracks (see WriteProfile)
+        '''
         self.dataset = dataset
         self.metadata = metadata
 
-        self.mark_manager = MarkManager(self.dataset.mark_path)
+        self.mark_manager = MarkManager(self.dataset.mark_path, write_profile=write_profile)
         self.mark_tokenizer = MarkTokenizer(self.metadata['block_name'],
-                                            self.metadata['stimulus'])
+                                            self.metadata['stimulus'],
+                                            mark_onsets=self.__get_epoc_onsets(onset_source),
+                                            cross_check=cross_check)
 
         self.wav_manager = WavManager(self.dataset.stim_path,
-                                      self.metadata['stimulus'])
+                                      self.metadata['stimulus'],
+                                      write_profile=write_profile)
+        self.__mark_future = None
+
+    def __get_epoc_onsets(self, onset_source):
+        '''Get the onset times of the TDT mark epoc, or None to threshold the analog mark track.
+        Only the (cached) block headers are read.
+        '''
+        if onset_source == 'mark':
+            return None
+        if onset_source not in ('auto', 'epocs'):
+            raise ValueError('unknown onset source {}'.format(onset_source))
+        tdt_path = getattr(self.dataset, 'tdt_path', None)
+        tdt_reader = None
+        # blocks without a TDT tank (e.g., HTK data only) have no epocs
+        if tdt_path and glob.glob(os.path.join(tdt_path, '*.tsq')):
+            tdt_reader = TDTReader(tdt_path, lazy=True, index_file=True)
+        if tdt_reader is not None and tdt_reader.has_events():
+            logger.info('Using TDT mark epocs for the stimulus onsets')
+            return tdt_reader.get_events()
+        if onset_source == 'epocs':
+            raise ValueError('No TDT mark epocs found for block {}'.format(self.metadata['block_name']))
+        logger.info('Using the analog mark track for the stimulus onsets')
+        return None
+
+    def prefetch(self, executor):
+        '''Start reading the mark track in the given executor, so that it is read
+        concurrently with the neural data. make() then waits for the result.
+        '''
+        self.__mark_future = executor.submit(self.mark_manager.get_mark_track)
+
+    components = ('mark', 'trials', 'stimulus')
+
+    def make(self, nwb_content, components=None):
+        '''
+        Args:
+        - nwb_content: (NWBFile) the stimulus components are added to it
+        - components: (list) subset of StimulusOriginator.components to make (default: all).
+                      The components that are not made must already be in nwb_content,
+                      e.g., when updating an existing NWB file (see NWBBuilder.update).
+        '''
+        if components is None:
+            components = self.components
+        unknown = set(components) - set(self.components)
+        if unknown:
+            raise ValueError('unknown stimulus components {}'.format(sorted(unknown)))
+
+        if 'mark' in components:
+            # add mark track
+            if self.__mark_future is not None:
+                mark_time_series = self.__mark_future.result()
+                self.__mark_future = None
+            else:
+                mark_time_series = self.mark_manager.get_mark_track()
+            nwb_content.add_stimulus(mark_time_series)
 
-    def make(self, nwb_content):
-        # add mark track
-        mark_time_series = self.mark_manager.get_mark_track()
-        nwb_content.add_stimulus(mark_time_series)
+        if 'trials' in components:
+            # tokenize into trials, once mark track has been added to nwb_content
+            self.mark_tokenizer.tokenize(nwb_content)
 
-        # tokenize into trials, once mark track has been added to nwb_content
-        self.mark_tokenizer.tokenize(nwb_content)
+        if 'stimulus' in components:
+            # add stimulus WAV data
+            first_recorded_mark = self.__get_first_recorded_mark(nwb_content)
+            stim_wav_time_series = self.wav_manager.get_stim_wav(first_recorded_mark)
+            if stim_wav_time_series is not None:
+                nwb_content.add_stimulus(stim_wav_time_series)
 
-        # add stimulus WAV data
-        first_recorded_mark = self.__get_first_recorded_mark(nwb_content)
-        stim_wav_time_series = self.wav_manager.get_stim_wav(first_recorded_mark)
-        nwb_content.add_stimulus(stim_wav_time_series)
+    def describe(self):
+        '''Describe the mark and stimulus datasets from the file headers (see NWBBuilder.plan).'''
+        descriptions = []
+        for name, kind, description in (('recorded_mark', 'mark', self.mark_manager.describe()),
+                                        ('raw_stimulus', 'stimulus', self.wav_manager.describe())):
+            if description is not None:
+                description.update(name=name, kind=kind)
+                descriptions.append(description)
+        return descriptions
 
     def __get_first_recorded_mark(self, nwb_content):
         time_table = nwb_content.trials.to_dataframe().query('sb == "s"')['start_time']
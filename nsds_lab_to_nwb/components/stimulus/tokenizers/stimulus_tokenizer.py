@@ -1,9 +1,24 @@
+import numpy as np
+
+
 class StimulusTokenizer():
     """ Base Tokenizer class for auditory stimulus data
     """
-    def __init__(self, block_name, stim_configs):
+    def __init__(self, block_name, stim_configs, mark_onsets=None, cross_check=False):
+        """
+        Args:
+        - block_name: (str) name of the block
+        - stim_configs: (dict) stimulus metadata
+        - mark_onsets: (array) onset times in seconds of the mark events, e.g., from the
+                       TDT 'mark' epoc. If None, the onsets are found by thresholding
+                       the analog mark track.
+        - cross_check: (bool) if mark_onsets are given, also threshold the analog mark
+                       track and warn if the two sets of onsets do not agree.
+        """
         self.block_name = block_name
         self.stim_configs = stim_configs
+        self.mark_onsets = mark_onsets
+        self.cross_check = cross_check
 
     def tokenize(self, nwb_content, mark_name='recorded_mark'):
         raise NotImplementedError('should be implemeted in inherited class')
@@ -14,6 +29,35 @@ class StimulusTokenizer():
     def __get_stim_onsets(self, nwb_content, mark_name):
         raise NotImplementedError('should be implemeted in inherited class')
 
+    def _get_mark_onsets(self, nwb_content, mark_name, mark_threshold):
+        """
+        Get the onset times in seconds (without the mark offset) of the mark events.
+        The given mark_onsets are used directly, so that the analog mark track is only
+        read if cross_check is set. Otherwise the analog mark track is thresholded.
+        """
+        if self.mark_onsets is None:
+            return self._threshold_mark(nwb_content, mark_name, mark_threshold)
+        mark_onsets = np.asarray(self.mark_onsets, dtype='float64')
+        if self.cross_check:
+            mark_dset = self.read_mark(nwb_content, mark_name)
+            threshold_onsets = self._threshold_mark(nwb_content, mark_name, mark_threshold)
+            # allow for an error of up to two samples of the mark track
+            tolerance = 2. / mark_dset.rate
+            if (len(threshold_onsets) != len(mark_onsets) or
+                    np.any(np.abs(threshold_onsets - mark_onsets) > tolerance)):
+                print("WARNING: {} mark onsets in block {} do not agree with the {} onsets of the mark track".format(
+                    len(mark_onsets), self.block_name, len(threshold_onsets)))
+        return mark_onsets
+
+    def _threshold_mark(self, nwb_content, mark_name, mark_threshold):
+        """
+        Find the onset times in seconds of the mark events by thresholding the analog mark track.
+        """
+        mark_dset = self.read_mark(nwb_content, mark_name)
+        thresh_crossings = np.diff((mark_dset.data[:] > mark_threshold).astype('int'), axis=0)
+        stim_onsets = np.where(thresh_crossings > 0.5)[0] + 1  # +1 b/c diff gets rid of 1st datapoint
+        return stim_onsets / mark_dset.rate
+
     def _get_end_time(self, nwb_content, mark_name):
         mark_dset = self.read_mark(nwb_content, mark_name=mark_name)
         end_time = mark_dset.num_samples/mark_dset.rate
@@ -1,5 +1,3 @@
-import numpy as np
-
 from nsds_lab_to_nwb.components.stimulus.tokenizers.stimulus_tokenizer import StimulusTokenizer
 
 
@@ -10,8 +8,9 @@ class ToneTokenizer(StimulusTokenizer):
     Original version author: Max Dougherty <maxdougherty@lbl.gov>
     As part of MARS
     """
-    def __init__(self, block_name, stim_configs):
-        StimulusTokenizer.__init__(self, block_name, stim_configs)
+    def __init__(self, block_name, stim_configs, mark_onsets=None, cross_check=False):
+        StimulusTokenizer.__init__(self, block_name, stim_configs,
+                                   mark_onsets=mark_onsets, cross_check=cross_check)
 
     def tokenize(self, nwb_content, mark_name='recorded_mark'):
         """
@@ -66,15 +65,6 @@ class ToneTokenizer(StimulusTokenizer):
                 'amp' in nwb_content.trials.colnames)
 
     def __get_stim_onsets(self, nwb_content, mark_name):
-        mark_dset = self.read_mark(nwb_content, mark_name)
-        mark_fs = mark_dset.rate
         mark_offset = self.stim_configs['mark_offset']
-        stim_dur = self.stim_configs['duration']
-
-        mark_trk, mark_threshold = self.__get_mark_threshold(mark_dset)
-        thresh_crossings = np.diff( (mark_trk > mark_threshold).astype('int'), axis=0)
-        stim_onsets = np.where(thresh_crossings > 0.5)[0] + 1
-        return (stim_onsets / mark_fs) + mark_offset
-
-    def __get_mark_threshold(self, mark_dset):
-        return mark_dset.data[:], self.stim_configs['mark_threshold']
+        stim_onsets = self._get_mark_onsets(nwb_content, mark_name, self.stim_configs['mark_threshold'])
+        return stim_onsets + mark_offset
@@ -10,8 +10,9 @@ class WNTokenizer(StimulusTokenizer):
     Original version author: Vyassa Baratham <vbaratham@lbl.gov>
     As part of MARS
     """
-    def __init__(self, block_name, stim_configs):
-        StimulusTokenizer.__init__(self, block_name, stim_configs)
+    def __init__(self, block_name, stim_configs, mark_onsets=None, cross_check=False):
+        StimulusTokenizer.__init__(self, block_name, stim_configs,
+                                   mark_onsets=mark_onsets, cross_check=cross_check)
 
     def tokenize(self, nwb_content, mark_name='recorded_mark'):
         """
@@ -53,24 +54,20 @@ class WNTokenizer(StimulusTokenizer):
             end_time = raw_dset.data.shape[0] / raw_dset.rate
             return np.arange(0.5, end_time, 1.0)
         
-        mark_dset = self.read_mark(nwb_content, mark_name)
-        mark_fs = mark_dset.rate
         mark_offset = self.stim_configs['mark_offset']
         stim_dur = self.stim_configs['duration']
-        stim_dur_samp = stim_dur*mark_fs
 
         mark_threshold = 0.25 if self.stim_configs.get('mark_is_stim') else self.stim_configs['mark_threshold']
-        thresh_crossings = np.diff( (mark_dset.data[:] > mark_threshold).astype('int'), axis=0 )
-        stim_onsets = np.where(thresh_crossings > 0.5)[0] + 1 # +1 b/c diff gets rid of 1st datapoint
+        stim_onsets = self._get_mark_onsets(nwb_content, mark_name, mark_threshold)
 
         real_stim_onsets = [stim_onsets[0]]
         for stim_onset in stim_onsets[1:]:
             # Check that each stim onset is more than 2x the stimulus duration since the previous
-            if stim_onset > real_stim_onsets[-1] + 2*stim_dur_samp:
+            if stim_onset > real_stim_onsets[-1] + 2*stim_dur:
                 real_stim_onsets.append(stim_onset)
 
         if len(real_stim_onsets) != self.stim_configs['nsamples']:
             print("WARNING: found {} stim onsets in block {}, but supposed to have {} samples".format(
                 len(real_stim_onsets), self.block_name, self.stim_configs['nsamples']))
             
-        return (np.array(real_stim_onsets) / mark_fs) + mark_offset
+        return np.array(real_stim_onsets) + mark_offset
@@ -5,13 +5,15 @@ from scipy.io import wavfile
 from pynwb import TimeSeries
 
 from nsds_lab_to_nwb.common.io import read_yaml
+from nsds_lab_to_nwb.common.write_profile import WriteProfile
 from nsds_lab_to_nwb.components.stimulus.stim_value_extractor import StimValueExtractor
 
 
 class WavManager():
-    def __init__(self, stim_path, stim_configs):
+    def __init__(self, stim_path, stim_configs, write_profile=None):
         self.stim_path = stim_path
         self.stim_configs = stim_configs
+        self.write_profile = WriteProfile.get(write_profile)
         self.__load_stim_values(self.stim_configs)
 
     def get_stim_wav(self, first_mark, name='recorded_mark'):
@@ -21,6 +23,18 @@ class WavManager():
         return self._get_stim_wav(self.get_stim_file(stim_name, self.stim_path),
                                   first_mark)
 
+    def describe(self):
+        ''' describes the stimulus wav from its header, without reading it (None for wn1) '''
+        stim_name = self.stim_configs['name']
+        if stim_name == 'wn1':
+            return None
+        # the samples are only memory-mapped, i.e., not read
+        stim_wav_fs, stim_wav = wavfile.read(self.get_stim_file(stim_name, self.stim_path), mmap=True)
+        description = {'shape': stim_wav.shape, 'dtype': stim_wav.dtype, 'rate': float(stim_wav_fs),
+                       'in_memory': True, 'chunk_bytes': None}
+        del stim_wav
+        return description
+
     def _get_stim_wav(self, stim_file, first_recorded_mark, name='raw_stimulus'):
         ''' get the raw wav stimulus track '''
         # find starting time
@@ -29,12 +43,13 @@ class WavManager():
                             - self.stim_configs['first_mark'])  # time between stimulus DVD start and the first mark
 
         # Read the stimulus wav file
-        stim_wav_fs, stim_wav = wavfile.read(stim_file)
+        with self.write_profile.count_read('stimulus', name):
+            stim_wav_fs, stim_wav = wavfile.read(stim_file)
 
         # Create the stimulus timeseries
         rate = float(stim_wav_fs)
         stim_time_series = TimeSeries(name=name,
-                            data=stim_wav,
+                            data=self.write_profile.wrap('stimulus', stim_wav, name=name),
                             unit='Volts',
                             starting_time=starting_time,
                             rate=rate,
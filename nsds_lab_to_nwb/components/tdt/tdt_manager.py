@@ -1,15 +1,43 @@
 import logging.config
+
+import numpy as np
 from pynwb.ecephys import ElectricalSeries
 
-from nsds_lab_to_nwb.components.tdt.tdt_reader import TDTReader
+from nsds_lab_to_nwb.common.write_profile import WriteProfile
+from nsds_lab_to_nwb.components.tdt.tdt_reader import TDTReader, TDTStreamIterator
 
 logger = logging.getLogger(__name__)
 
 
 class TdtManager():
-    def __init__(self, raw_tdt_path):
+    def __init__(self, raw_tdt_path, lazy=True, streaming=True, memory_budget=None, index_file=True,
+                 write_profile=None):
+        '''
+        Args:
+        - raw_tdt_path: (str) path to the TDT block
+        - lazy: (bool) only read the block headers up front, and read each stream
+                when its device is extracted (see TDTReader). Default is True.
+        - streaming: (bool) write each stream in successive time-major windows through a
+                     TDTStreamIterator, instead of passing the transposed stream to pynwb.
+                     In lazy mode the windows are also read one at a time. Default is True.
+        - memory_budget: (int) maximum number of bytes per time window when streaming
+                         (default: TDTStreamIterator.default_memory_budget)
+        - index_file: (str or bool) cached index of the parsed block headers (see TDTReader).
+                      True uses the default location in the user cache, False disables the index.
+        - write_profile: (str, dict or WriteProfile) HDF5 chunking and compression of the
+                         e-series data (see WriteProfile)
+        '''
         # TDTReader.__init__(self, raw_tdt_path)
-        self.tdt_reader = TDTReader(raw_tdt_path)
+        self.tdt_reader = TDTReader(raw_tdt_path, lazy=lazy, index_file=index_file)
+        self.streaming = streaming
+        self.memory_budget = memory_budget
+        self.write_profile = WriteProfile.get(write_profile)
+
+    @property
+    def reads_on_extract(self):
+        '''True if extract reads the stream data. When streaming (or if the whole block was
+        read on creation), extract only reads the headers of the stream.'''
+        return self.tdt_reader.lazy and not self.streaming
 
     def extract(self, device_name, dev_conf, electrode_table_region):
         '''
@@ -23,36 +51,111 @@ class TdtManager():
         Returns:
         - e_series: (ElectricalSeries) to be added to the NWB file (returns None if specifed device_name does not exist)
         '''
-        logger.info('Extracting for device: {}'.format(device_name))
-
-        stream_list = self.tdt_reader.streams
-        if device_name in stream_list:
-            result = self.tdt_reader.get_data(device_name)
-        else:
-            logger.info('- stream {} not found. Available stream list: {}'.format(device_name, stream_list))
-            result = None
-            # try alternative (device, stream) name pairs
-            alternative_device_names = [('ECoG', 'Wave')]
-            for dev_name, stream_name in alternative_device_names:
-                if device_name == dev_name:
-                    result = self.tdt_reader.get_data(stream_name)
-                    if result is not None:
-                        logger.info('- using alternative stream name: {}'.format(stream_name))
-                        break
-
+        with self.write_profile.count_read('electrical_series', device_name):
+            result = self.get_data(device_name, dev_conf)
         if result is None:
             return None
-
-        data, tdt_params = result[0], result[1]
-        data = data.T #tranpose to long form matrix
-        rate = tdt_params['sample_rate']
+        data, rate = result
+        data, conversion, offset = self.quantize(data)
 
         # Create the electrical series
         e_series = ElectricalSeries(name=device_name,
-                                    data=data,
+                                    data=self.write_profile.wrap('electrical_series', data, name=device_name),
                                     electrodes=electrode_table_region,
                                     starting_time=0.,
                                     rate=rate,
+                                    conversion=conversion,
+                                    offset=offset,
                                     )
 
         return e_series
+
+    def get_data(self, device_name, dev_conf):
+        '''
+        extracts TDT data for a single device, in the time-first layout.
+
+        Args:
+        - device_name: (str) either 'Wave' or 'Poly'
+        - dev_conf: (dict) metadata for the device.
+        Returns:
+        - (data, rate): data is a TDTStreamIterator when streaming, otherwise an array
+                        (returns None if specifed device_name does not exist)
+        '''
+        logger.info('Extracting for device: {}'.format(device_name))
+
+        # Only read the channels of the device, in the order of its electrode table region
+        channels = dev_conf.get('ch_ids', None)
+        stream_name = self.__get_stream_name(device_name)
+        if stream_name is None:
+            return None
+        # When streaming, only the metadata of the stream is read here
+        get_stream = self.tdt_reader.get_metadata if self.streaming else self.tdt_reader.get_data
+        result = get_stream(stream_name, channels)
+        if result is None:
+            return None
+
+        if self.streaming:
+            # Read and transpose the stream window by window while it is written
+            data = TDTStreamIterator(self.tdt_reader, stream_name, memory_budget=self.memory_budget,
+                                     channels=channels)
+            return data, data.sample_rate
+
+        data, tdt_params = result[0], result[1]
+        # Drop the reader's reference, so that the ElectricalSeries is the only owner of the stream data
+        self.tdt_reader.release_stream(stream_name)
+        data = data.T #tranpose to long form matrix
+        rate = tdt_params['sample_rate']
+        return data, rate
+
+    def quantize(self, data):
+        '''
+        stores the data returned by get_data as integer codes, if the write profile quantizes
+        the e-series (see WriteProfile.quantize). When streaming, the quantization is detected
+        on windows read from the block.
+
+        Returns:
+        - (data, conversion, offset)
+        '''
+        read_window = data.read_window if isinstance(data, TDTStreamIterator) else None
+        return self.write_profile.quantize('electrical_series', data, read_window=read_window)
+
+    def describe(self, device_name, dev_conf):
+        '''
+        describes the data of a single device from the block headers, without reading it.
+
+        Returns:
+        - description: (dict) shape and dtype of the time-first data, sampling rate, whether the
+                       data is held in memory until it is written (in_memory), and the number of
+                       bytes read per window when streaming (chunk_bytes).
+                       Returns None if specifed device_name does not exist.
+        '''
+        stream_name = self.__get_stream_name(device_name)
+        if stream_name is None:
+            return None
+        meta = self.tdt_reader.get_metadata(stream_name, dev_conf.get('ch_ids', None))
+        dtype = np.dtype(meta.get('dtype', 'float32'))
+        num_samples, num_channels = int(meta['num_samples']), int(meta['num_channels'])
+        shape = (num_samples,) if num_channels == 1 else (num_samples, num_channels)
+        chunk_bytes = None
+        if self.streaming:
+            memory_budget = self.memory_budget or TDTStreamIterator.default_memory_budget
+            # a channel-major window and its time-major copy
+            chunk_bytes = 2 * min(memory_budget, num_samples * num_channels * dtype.itemsize)
+        return {'shape': shape, 'dtype': dtype, 'rate': meta['sample_rate'],
+                'in_memory': not self.streaming, 'chunk_bytes': chunk_bytes}
+
+    def __get_stream_name(self, device_name):
+        '''
+        returns the name of the stream of the device, or None if the block has no such stream.
+        '''
+        stream_list = self.tdt_reader.streams
+        if device_name in stream_list:
+            return device_name
+        logger.info('- stream {} not found. Available stream list: {}'.format(device_name, stream_list))
+        # try alternative (device, stream) name pairs
+        alternative_device_names = [('ECoG', 'Wave')]
+        for dev_name, stream_name in alternative_device_names:
+            if device_name == dev_name and stream_name in stream_list:
+                logger.info('- using alternative stream name: {}'.format(stream_name))
+                return stream_name
+        return None
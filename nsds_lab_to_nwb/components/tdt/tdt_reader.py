@@ -1,67 +1,461 @@
+import hashlib
+import json
+import os
+import re
 import tdt
+import threading
 import warnings
+from datetime import datetime
+
+import numpy as np
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk
+
 
 class TDTReader():
     """TDT interface
     """
-    def __init__(self, path, verbose=False, channels=None):
+
+    index_version = 1
+    """
+    Version of the format of the cached header index files. Index files with a different version are ignored.
+    """
+
+    def __init__(self, path, verbose=False, channels=None, lazy=False, index_file=None):
         """
 
         Args:
             path (str): path to tdt folder
             verbose (bool, optional): whether to print debugging statements. Defaults to False.
             channels (list, optional): list of channel ids to import. Defaults to None.
+            lazy (bool, optional): whether to only read the block headers on creation. Each stream
+                                   is then read on demand by get_data and kept until release_stream
+                                   is called, so that only the streams in use are held in memory.
+                                   Defaults to False.
+            index_file (str or bool, optional): path of a binary index in which the parsed block headers
+                                   (the per-store offset tables of the tsq file) are cached, so that later
+                                   readers of the block do not need to parse the tsq file again. The index
+                                   is invalidated if the size or modification time of the tsq file changes.
+                                   Set to True to use the default location (see get_index_file).
+                                   Defaults to None, i.e., no index.
         """
         self.path = path
         self.channels = channels
         self.verbose = verbose
-        
-        if channels is None:
-            self.tdt_obj = tdt.read_block(path)
+        self.lazy = lazy
+        self.index_file = None
+
+        if lazy:
+            # Only the headers (tsq) are read. Stream data stays on disk until it is requested.
+            self.tdt_obj = None
+            self.headers = self.__read_headers(index_file)
+            # Stores that were only saved as sev files are not in the headers (var name -> store name)
+            self.__sev_streams = {tdt.fix_var_name(name): name for name in tdt.read_sev(path, just_names=True)
+                                  if tdt.fix_var_name(name) not in self.headers.stores.keys()}
+            self.__loaded_streams = {}
+            # the devices of a block may be extracted in concurrent threads (see NWBBuilder.build)
+            self.__lock = threading.Lock()
+            self.block_name = os.path.basename(os.path.normpath(path))
+            start_time = self.headers.start_time[0]
+            self.start_time = (np.nan if np.isnan(start_time)
+                               else datetime.fromtimestamp(start_time).strftime('%H:%M:%S'))
         else:
-            self.tdt_obj = tdt.read_block(path, channel=channels)
+            # read_block parses the tsq file itself unless it is given the headers
+            headers = self.__read_headers(index_file) if index_file else 0
+            if channels is None:
+                self.tdt_obj = tdt.read_block(path, headers=headers)
+            else:
+                self.tdt_obj = tdt.read_block(path, headers=headers, channel=channels)
+            self.headers = None
+            self.block_name = self.tdt_obj['info']['blockname']
+            self.start_time = self.tdt_obj['info']['utc_start_time']
 
         self.streams = self.get_streams()
-        self.block_name = self.tdt_obj['info']['blockname']
-        self.start_time = self.tdt_obj['info']['utc_start_time']
-        
+
         if verbose:
             print('Stream list:')
             print(self.streams)
-    
+
+    @staticmethod
+    def get_index_file(path):
+        """Get the default location of the cached header index of a block in the user cache directory
+        ($XDG_CACHE_HOME or ~/.cache)
+
+        Args:
+            path (str): path to tdt folder
+
+        Returns:
+            index_file (str): path of the index file
+        """
+        path = os.path.abspath(path)
+        cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        index_name = hashlib.sha1(path.encode('utf-8')).hexdigest() + '.tdtindex.npz'
+        return os.path.join(cache_dir, 'nsds_lab_to_nwb', index_name)
+
+    def __read_headers(self, index_file=None):
+        """Read the block headers, from the index if it is valid, or by parsing the tsq file otherwise
+
+        Args:
+            index_file (str or bool, optional): see __init__
+
+        Returns:
+            headers (tdt.StructType): block headers as returned by tdt.read_block(path, headers=1)
+        """
+        if not index_file:
+            return tdt.read_block(self.path, headers=1)
+        index_file = self.get_index_file(self.path) if index_file is True else index_file
+        tsq_files = tdt.get_files(os.path.join(self.path, ''), '.tsq', ignore_mac=True)
+        if len(tsq_files) != 1:
+            return tdt.read_block(self.path, headers=1)
+        tsq_stat = os.stat(tsq_files[0])
+        key = [self.index_version, os.path.abspath(self.path), tsq_stat.st_size, tsq_stat.st_mtime_ns]
+        try:
+            with np.load(index_file, allow_pickle=False) as index:
+                meta = json.loads(str(index['__meta__']))
+                if meta['key'] == key:
+                    headers = self.__decode_headers(meta['headers'], index)
+                    self.index_file = index_file
+                    return headers
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        headers = tdt.read_block(self.path, headers=1)
+        try:
+            arrays = {}
+            meta = {'key': key, 'headers': self.__encode_headers(headers, arrays, 'h')}
+            arrays['__meta__'] = np.array(json.dumps(meta))
+            os.makedirs(os.path.dirname(index_file), exist_ok=True)
+            # Write to a temporary file first so that concurrent readers never see a partial index
+            temp_file = '%s.%i.tmp' % (index_file, os.getpid())
+            with open(temp_file, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(temp_file, index_file)
+            self.index_file = index_file
+        except (OSError, ValueError):
+            # The index is only a cache, so failing to write it is not an error
+            pass
+        return headers
+
+    @classmethod
+    def __encode_headers(cls, value, arrays, name):
+        """Encode the block headers as JSON-compatible values, with all numpy arrays
+        moved into the arrays dict (so that they are stored in binary form without pickling)
+
+        Args:
+            value: headers or one of their values
+            arrays (dict): dict the numpy arrays are added to
+            name (str): unique name of the value
+
+        Returns:
+            JSON-compatible encoding of the value
+        """
+        if isinstance(value, tdt.StructType):
+            return {'struct': {k: cls.__encode_headers(v, arrays, name + '.' + k) for k, v in value.items()}}
+        if isinstance(value, np.ndarray):
+            if value.dtype.hasobject:
+                raise ValueError('Cannot store object arrays in the TDT index')
+            arrays[name] = value
+            return {'array': name}
+        if isinstance(value, (list, tuple)):
+            return {'list': [cls.__encode_headers(v, arrays, name + '.' + str(i)) for i, v in enumerate(value)]}
+        if isinstance(value, np.generic):
+            return {'value': value.item()}
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return {'value': value}
+        raise ValueError('Cannot store values of type %s in the TDT index' % type(value))
+
+    @classmethod
+    def __decode_headers(cls, value, arrays):
+        """Decode the block headers encoded by __encode_headers
+
+        Args:
+            value: JSON encoding of the headers or one of their values
+            arrays: mapping with the numpy arrays of the index
+
+        Returns:
+            The decoded headers or value
+        """
+        if 'struct' in value:
+            return tdt.StructType([(k, cls.__decode_headers(v, arrays)) for k, v in value['struct'].items()])
+        if 'array' in value:
+            return arrays[value['array']]
+        if 'list' in value:
+            return [cls.__decode_headers(v, arrays) for v in value['list']]
+        return value['value']
+
     def get_streams(self):
         """Get TDT all stream names
 
         Returns:
             streams (list): stream names
         """
+        if self.lazy:
+            streams = [name for name, store in self.headers.stores.items() if store.type_str == 'streams']
+            return streams + list(self.__sev_streams)
         streams = list(self.tdt_obj['streams'].keys())
         return streams
-    
-    def get_metadata(self, stream):
+
+    def __get_store_headers(self, stream):
+        """Get a copy of the block headers that only contains the given store
+
+        read_block ignores the store filter when given headers, so the headers passed to it must
+        be restricted to the store that should be read.
+        """
+        headers = tdt.StructType(self.headers.items())
+        headers.stores = tdt.StructType([(stream, self.headers.stores[stream])])
+        return headers
+
+    def __get_channel_kwargs(self, channels):
+        """Get the channel filter passed to tdt.read_block
+
+        Args:
+            channels (list): list of channel ids, or None for the channels of the reader
+
+        Returns:
+            kwargs (dict): keyword arguments for tdt.read_block
+        """
+        channels = self.channels if channels is None else channels
+        if channels is None:
+            return {}
+        # read_block only accepts a plain list, and returns the channels in ascending order
+        return {'channel': sorted(set(int(c) for c in channels))}
+
+    @staticmethod
+    def __get_channel_ids(stream_obj):
+        """Get the channel ids of the rows of a stream struct (streams read from sev files list them as 'channels')"""
+        return stream_obj['channel'] if 'channel' in stream_obj.keys() else stream_obj['channels']
+
+    @staticmethod
+    def __select_channels(data, channel_ids, channels):
+        """Select the rows of the given channels (in the given order) from stream data
+
+        Args:
+            data (np-array): data matrix (wide form) with one row per channel in channel_ids
+            channel_ids (list): channel ids of the rows of data
+            channels (list): list of channel ids to select, or None to select all channels
+
+        Returns:
+            mat (np-array): data matrix (wide form) of the selected channels
+        """
+        if channels is None or data.ndim == 1:
+            return data
+        channel_ids = [int(c) for c in channel_ids]
+        rows = [channel_ids.index(int(c)) for c in channels]
+        if rows == list(range(len(channel_ids))):
+            return data
+        return data[rows]
+
+    def __get_stream(self, stream, channels=None):
+        """Get the TDT struct of a stream, reading it from disk first in lazy mode
+
+        Args:
+            stream (string): stream name
+            channels (list, optional): list of channel ids that need to be read. Defaults to None,
+                                       i.e., the channels of the reader.
+
+        Returns:
+            stream_obj (tdt.StructType): stream struct with the fields fs, channel and data
+        """
+        if not self.lazy:
+            return self.tdt_obj['streams'][stream]
+        kwargs = self.__get_channel_kwargs(channels)
+        key = (stream, tuple(kwargs.get('channel', ())))
+        with self.__lock:
+            stream_obj = self.__loaded_streams.get(key)
+        if stream_obj is None:
+            # read outside of the lock, so that different streams are read concurrently
+            if self.verbose:
+                print('Reading stream {}'.format(stream))
+            stream_obj = self.__read_stream(stream, **kwargs)
+            with self.__lock:
+                stream_obj = self.__loaded_streams.setdefault(key, stream_obj)
+        return stream_obj
+
+    def __read_stream(self, stream, **kwargs):
+        """Read a stream (or a time window of it) from disk in lazy mode
+
+        The store filter is passed to tdt.read_block even though the headers only contain the stream,
+        since read_block otherwise also reads all stores that only exist as sev files.
+
+        Args:
+            stream (string): stream name
+            kwargs: channel and time filters passed to tdt.read_block (or tdt.read_sev)
+
+        Returns:
+            stream_obj (tdt.StructType): stream struct with the fields fs, channel (or channels) and data
+        """
+        if stream in self.__sev_streams:
+            return tdt.read_sev(self.path, event_name=self.__sev_streams[stream], **kwargs)[stream]
+        block = tdt.read_block(self.path, headers=self.__get_store_headers(stream), evtype=['streams'],
+                               store=self.headers.stores[stream].name, **kwargs)
+        return block['streams'][stream]
+
+    def __is_loaded(self, stream, channels=None):
+        """Check whether the stream (with the given channels) has already been read in lazy mode"""
+        kwargs = self.__get_channel_kwargs(channels)
+        with self.__lock:
+            return (stream, tuple(kwargs.get('channel', ()))) in self.__loaded_streams
+
+    def release_stream(self, stream):
+        """Release the data of a stream that was read in lazy mode (does nothing otherwise).
+        The stream is read again from disk if it is requested later.
+
+        Args:
+            stream (string): stream name
+        """
+        if self.lazy:
+            with self.__lock:
+                for key in [key for key in self.__loaded_streams if key[0] == stream]:
+                    self.__loaded_streams.pop(key)
+
+    def get_metadata(self, stream, channels=None):
         """Get specified stream metadata
 
         Args:
             stream (string): stream name
+            channels (list, optional): list of channel ids of the data. Defaults to None,
+                                       i.e., the channels of the reader.
 
         Returns:
             meta (dict): dictionary containing stream recording parameters (if no stream returns None)
         """
         stream_exist = self.check_stream(stream)
+        if stream_exist and self.lazy and not self.__is_loaded(stream, channels):
+            # The block headers have no information on stores that only exist as sev files,
+            # so the headers of the sev files are used instead
+            if stream in self.__sev_streams:
+                return self.__get_metadata_from_sev_headers(stream, channels)
+            return self.__get_metadata_from_headers(stream, channels)
         if stream_exist:
+            stream_obj = self.__get_stream(stream, channels)
+            channel_ids = self.__get_channel_ids(stream_obj)
             meta = {}
-            meta['sample_rate'] = self.tdt_obj['streams'][stream]['fs']
-            meta['channel_ids'] = self.tdt_obj['streams'][stream]['channel']
-            data_shape = self.tdt_obj['streams'][stream]['data'].shape
+            meta['sample_rate'] = stream_obj['fs']
+            meta['channel_ids'] = channel_ids if channels is None else list(channels)
+            data_shape = self.__select_channels(stream_obj['data'], channel_ids, channels).shape
             if len(data_shape) == 1:
                 meta['num_samples'] = data_shape[0]
                 meta['num_channels'] = 1
             else:
                 meta['num_channels'], meta['num_samples'] = data_shape
-            return meta       
+            return meta
         else:
-            return None 
-    
+            return None
+
+    def __get_metadata_from_headers(self, stream, channels=None):
+        """Get specified stream metadata from the block headers, without reading the stream data
+
+        Args:
+            stream (string): stream name
+            channels (list, optional): list of channel ids of the data (see get_metadata)
+
+        Returns:
+            meta (dict): dictionary containing stream recording parameters (see get_metadata)
+                         and the numpy dtype of the stream data
+        """
+        store = self.headers.stores[stream]
+        dtype = np.dtype(tdt.ALLOWED_FORMATS[store.dform])
+        all_channel_ids = np.unique(store.chan)
+        # Each packet holds (size - 10) 4-byte words of samples for a single channel
+        samples_per_packet = (int(store.size) - 10) * 4 // dtype.itemsize
+        meta = {}
+        meta['sample_rate'] = store.fs
+        channels = self.channels if channels is None else channels
+        meta['channel_ids'] = [int(c) for c in all_channel_ids] if channels is None else list(channels)
+        # Window reads place each packet at the sample of its timestamp, so the stream ends with the
+        # last packet of the channel that ends first (counted from the first sample of the stream)
+        packet_channels = np.ones(len(store.ts), dtype=int) if len(all_channel_ids) == 1 else np.asarray(store.chan)
+        ends = [self.__packet_to_sample(store.ts[packet_channels == int(c)][-1], store.fs) + samples_per_packet
+                for c in meta['channel_ids'] if np.any(packet_channels == int(c))]
+        meta['num_samples'] = min(ends) - self.__get_first_sample(stream) if ends else 0
+        meta['num_channels'] = len(meta['channel_ids'])
+        meta['dtype'] = dtype
+        return meta
+
+    def __get_metadata_from_sev_headers(self, stream, channels=None):
+        """Get specified stream metadata from the 40-byte headers and the sizes of the sev files of a stream,
+        without reading the stream data
+
+        Args:
+            stream (string): stream name
+            channels (list, optional): list of channel ids of the data (see get_metadata)
+
+        Returns:
+            meta (dict): dictionary containing stream recording parameters (see get_metadata)
+                         and the numpy dtype of the stream data
+        """
+        sev_files = self.__read_sev_headers(stream)
+        # Streams that were recorded for more than an hour are split into one file per channel and hour
+        num_samples = {}
+        for sev_file in sev_files:
+            num_samples[sev_file['channel']] = num_samples.get(sev_file['channel'], 0) + sev_file['num_samples']
+        meta = {}
+        meta['sample_rate'] = sev_files[0]['fs']
+        channels = self.channels if channels is None else channels
+        meta['channel_ids'] = sorted(num_samples) if channels is None else list(channels)
+        ends = [num_samples[int(c)] for c in meta['channel_ids'] if int(c) in num_samples]
+        meta['num_samples'] = min(ends) if ends else 0
+        meta['num_channels'] = len(meta['channel_ids'])
+        meta['dtype'] = sev_files[0]['dtype']
+        return meta
+
+    def __read_sev_headers(self, stream):
+        """Read the headers of the sev files of a stream that only exists as sev files (as tdt.read_sev does)
+
+        Args:
+            stream (string): stream name
+
+        Returns:
+            sev_files (list): one dict per file with the channel, fs, dtype and num_samples of the file
+        """
+        header_dtype = np.dtype([('size_bytes', '<u8'), ('file_type', 'S3'), ('file_version', 'u1'),
+                                 ('event_name', 'S4'), ('channel', '<u2'), ('total_num_channels', '<u2'),
+                                 ('sample_width_bytes', '<u2'), ('reserved', '<u2'), ('data_format', 'u1'),
+                                 ('decimate', 'u1'), ('rate', '<u2')])
+        sev_files = []
+        for path in tdt.get_files(os.path.join(self.path, ''), '.sev', ignore_mac=True):
+            name = os.path.splitext(os.path.basename(path))[0]
+            with open(path, 'rb') as f:
+                header = np.frombuffer(f.read(header_dtype.itemsize), dtype=header_dtype)[0]
+            # Only version 3 headers hold the event name reliably, older files are identified by their name
+            if header['file_version'] >= 3:
+                event_name = header['event_name'].decode('ascii')
+            else:
+                event_names = re.findall('(?=_(.{4})_)', name)
+                event_name = event_names[-1] if event_names else name
+            if event_name != self.__sev_streams[stream]:
+                continue
+            if header['file_version'] > 0:
+                data_format = tdt.ALLOWED_FORMATS[header['data_format'] & 0b111]
+                fs = 2. ** (float(header['rate']) - 12) * 25000000 / header['decimate']
+            else:
+                # files without a header are assumed to be float at the default rate, as in tdt.read_sev
+                data_format, fs = 'single', 24414.0625
+            # rawpacked samples are packed into 32-bit words. The samples follow the header, which is padded to 40 bytes
+            dtype = np.dtype(np.int32 if data_format == 'rawpacked' else data_format)
+            num_samples = (os.stat(path).st_size - 40) // dtype.itemsize
+            sev_files.append({'channel': int(header['channel']), 'fs': fs, 'dtype': dtype,
+                              'num_samples': num_samples})
+        return sev_files
+
+    @staticmethod
+    def __time_to_sample(t, fs):
+        """Convert a time to a sample index with the same rounding as tdt.read_block, i.e., the first sample at or
+        after t"""
+        return int(np.ceil(np.round(t * fs * 1e9) / 1e9))
+
+    @staticmethod
+    def __packet_to_sample(ts, fs):
+        """Convert the timestamp of a packet to the index of its first sample, with the same rounding as
+        tdt.read_block, i.e., to the nearest sample"""
+        return int(np.round(ts * fs))
+
+    def __get_first_sample(self, stream):
+        """Get the index of the first sample of a stream in the block, i.e., the sample of the first packet
+        (stores that only exist as sev files start with the block)"""
+        if stream in self.__sev_streams:
+            return 0
+        store = self.headers.stores[stream]
+        return self.__packet_to_sample(store.ts[0], store.fs)
+
     def check_stream(self, stream):
         """Checks to see if user specified stream exists in data
 
@@ -79,33 +473,187 @@ class TDTReader():
                 error_message += stream + ', '
             warnings.warn(error_message)
         return stream_available
-    
-    def get_data(self, stream):
+
+    def get_data(self, stream, channels=None):
         """Get specified stream data
 
         Args:
             stream (string): stream name
+            channels (list, optional): list of channel ids to get. In lazy mode only these channels are
+                                       read from disk. The rows of the data follow the order of the list.
+                                       Defaults to None, i.e., the channels of the reader.
 
         Returns:
-            mat, meta (np-array, dict): Returns tuple of data matrix (wide form) 
+            mat, meta (np-array, dict): Returns tuple of data matrix (wide form)
                                         and metadata dictionary (if no stream returns None)
         """
         stream_exisit = self.check_stream(stream)
         if stream_exisit:
-            mat = self.tdt_obj['streams'][stream]['data']
-            meta = self.get_metadata(stream)
+            stream_obj = self.__get_stream(stream, channels)
+            mat = self.__select_channels(stream_obj['data'], self.__get_channel_ids(stream_obj), channels)
+            meta = self.get_metadata(stream, channels)
             return mat, meta
         else:
             return None
 
+    def get_data_window(self, stream, t1, t2, channels=None):
+        """Get specified stream data in the time window [t1, t2). In lazy mode only the
+        window is read from disk (using the time filter of tdt.read_block).
+
+        Args:
+            stream (string): stream name
+            t1 (float): start time of the window in seconds, relative to the first sample of the stream
+                        (as the data returned by get_data)
+            t2 (float): stop time of the window in seconds, relative to the first sample of the stream
+            channels (list, optional): list of channel ids to get (see get_data). Defaults to None.
+
+        Returns:
+            mat (np-array): data matrix (wide form) of the window
+        """
+        if not self.lazy or self.__is_loaded(stream, channels):
+            stream_obj = self.__get_stream(stream, channels)
+            # same rounding as tdt.read_block, i.e. samples t1*fs <= i < t2*fs
+            start, stop = [self.__time_to_sample(t, stream_obj['fs']) for t in (t1, t2)]
+            return self.__select_channels(stream_obj['data'][..., start:stop], self.__get_channel_ids(stream_obj),
+                                          channels)
+        if stream not in self.__sev_streams:
+            # read_block filters on the time in the block, in which the stream may start after the first packet
+            # of another store
+            first_time = self.__get_first_sample(stream) / self.headers.stores[stream].fs
+            t1, t2 = t1 + first_time, t2 + first_time
+        stream_obj = self.__read_stream(stream, t1=t1, t2=t2, **self.__get_channel_kwargs(channels))
+        return self.__select_channels(stream_obj['data'], self.__get_channel_ids(stream_obj), channels)
+
+    def has_events(self):
+        """Checks whether the block has the mark epoc
+
+        Returns:
+            events_available (bool): whether the mark epoc exists
+        """
+        if self.lazy:
+            return 'mark' in self.headers.stores.keys() and self.headers.stores['mark'].type_str == 'epocs'
+        return 'mark' in self.tdt_obj['epocs'].keys()
+
     def get_events(self):
         """Get event onset markers
 
         Returns:
             events (list): list of samples where an event occured
         """
+        if self.lazy:
+            # epoc onsets are part of the headers
+            return self.headers.stores['mark']['onset']
         events = self.tdt_obj['epocs']['mark']['onset']
         return events
 
-    
-    
+
+class TDTStreamIterator(AbstractDataChunkIterator):
+    """Iterate over a TDT stream in successive time windows
+
+    Each window is read separately from the block (see TDTReader.get_data_window) and returned
+    as a (time_block, channels) chunk, i.e., the stream is transposed to the time-first layout
+    one window at a time. A stream of any length is therefore written with bounded memory.
+    If the reader is not lazy, the windows are views on the loaded channel-major stream, so that
+    only a single time-major window exists besides it (instead of a full transposed copy).
+    """
+
+    default_memory_budget = 64 * 1024 * 1024
+    """
+    Default maximum size in bytes of a single window returned by the iterator.
+    """
+
+    transpose_block = 4096
+    """
+    Number of samples per block when a window is transposed, so that the rows of a block stay in cache.
+    """
+
+    def __init__(self, tdt_reader, stream, time_block=None, memory_budget=None, channels=None):
+        """
+
+        Args:
+            tdt_reader (TDTReader): reader of the block
+            stream (str): stream name
+            time_block (int, optional): number of samples per window. Defaults to the number of samples
+                                        that fit into memory_budget.
+            memory_budget (int, optional): maximum number of bytes per window if time_block is not given.
+                                           Defaults to default_memory_budget.
+            channels (list, optional): list of channel ids to read, in the order of the output columns.
+                                       Defaults to None, i.e., the channels of the reader.
+        """
+        self.tdt_reader = tdt_reader
+        self.stream = stream
+        self.channels = channels
+        meta = tdt_reader.get_metadata(stream, channels)
+        self.sample_rate = meta['sample_rate']
+        self.num_samples = int(meta['num_samples'])
+        self.num_channels = int(meta['num_channels'])
+        # The metadata has no dtype if it was not read from the headers, i.e., if the stream is already loaded
+        self.__dtype = np.dtype(meta['dtype']) if 'dtype' in meta else self.read_window(0, 1).dtype
+        if time_block is None:
+            memory_budget = memory_budget or self.default_memory_budget
+            time_block = memory_budget // (self.num_channels * self.__dtype.itemsize)
+        self.time_block = max(1, int(time_block))
+        self.current_sample = 0
+
+    def __iter__(self):
+        """Return the iterator object"""
+        return self
+
+    def __next__(self):
+        """Return the next window as a DataChunk or raise a StopIteration exception if all windows have been read."""
+        start = self.current_sample
+        if start >= self.num_samples:
+            self.close()
+            raise StopIteration
+        stop = min(start + self.time_block, self.num_samples)
+        window = self.read_window(start, stop)
+        if window.shape[-1] == 0:
+            self.close()
+            raise StopIteration
+        self.current_sample = start + window.shape[-1]
+        if self.num_channels == 1:
+            return DataChunk(np.ravel(window), np.s_[start:self.current_sample])
+        # Copy into a time-major array so that each chunk is contiguous in the output layout
+        chunk = np.empty((window.shape[1], window.shape[0]), dtype=self.__dtype)
+        for block_start in range(0, window.shape[1], self.transpose_block):
+            block = slice(block_start, block_start + self.transpose_block)
+            chunk[block] = window[:, block].T
+        return DataChunk(chunk, np.s_[start:self.current_sample, :])
+
+    next = __next__
+
+    def read_window(self, start, stop):
+        """Read the samples [start, stop) of the stream (counted from its first sample)
+
+        Returns:
+            window (np-array): data matrix (wide form) of the window
+        """
+        window = self.tdt_reader.get_data_window(self.stream, start / self.sample_rate, stop / self.sample_rate,
+                                                 channels=self.channels)
+        # The windows are aligned to samples, but never go beyond the samples found in the headers
+        return window[..., :stop - start]
+
+    def close(self):
+        """Release the stream from the reader (see TDTReader.release_stream), so that a stream that was loaded
+        while the iterator was set up is not kept after it has been written"""
+        self.tdt_reader.release_stream(self.stream)
+
+    def recommended_chunk_shape(self):
+        """Recommend the chunk shape for the data array. None means that no particular shape is recommended."""
+        return None
+
+    def recommended_data_shape(self):
+        """Recommend the initial shape for the data array"""
+        return self.maxshape
+
+    @property
+    def dtype(self):
+        """Define the data type of the array"""
+        return self.__dtype
+
+    @property
+    def maxshape(self):
+        """Shape (#samples, #channels) of the stream in the time-first layout"""
+        if self.num_channels == 1:
+            return (self.num_samples,)
+        return (self.num_samples, self.num_channels)
@@ -1,14 +1,21 @@
 import logging.config
 import sys
 import os
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import pytz
 
+import h5py
 from pynwb import NWBHDF5IO, NWBFile
 from pynwb.file import Subject
 
 from nsds_lab_to_nwb.common.data_scanners import AuditoryDataScanner
+from nsds_lab_to_nwb.common.io import replace_groups
+from nsds_lab_to_nwb.common.planner import ConversionPlanner, ThroughputTable
+from nsds_lab_to_nwb.common.throughput import ThroughputReport
+from nsds_lab_to_nwb.common.write_profile import WriteProfile
 from nsds_lab_to_nwb.metadata.metadata_manager import MetadataManager
 
 from nsds_lab_to_nwb.components.device.device_originator import DeviceOriginator
@@ -52,6 +59,44 @@ class NWBBuilder:
         Start time for NWB
     use_htk : bool
         Use data from HTK files.
+    num_threads : int
+        Number of threads used to extract the devices and the mark track of the block
+        concurrently. 1 extracts them one after another. Default is one thread per store if
+        the devices are read when they are extracted (lazy TDT reads without streaming), and 1
+        otherwise, as the streamed data is only read while the NWB file is written. With the
+        default readers (streamed TDT or HTK data) the pool is therefore opt-in.
+    write_profile : str or dict
+        HDF5 chunking, compression and chunk cache settings of the written datasets,
+        per kind of data. Name of a preset ('none', 'gzip', 'lzf'), path to a YAML file
+        or dict (see WriteProfile). Default is 'none' (hdmf defaults).
+    write_buffers : int
+        Number of buffers in which the data read from the input files is queued while the
+        previous chunks are written (see BufferedChunkIterator). 0 reads and writes in turn.
+        Overrides the write profile. Default is 2 (double buffering).
+    write_buffer_size : int
+        Size in bytes of each write buffer. Overrides the write profile. Default is 64 MB.
+    quantize : bool
+        Store the e-series as int16 codes, with the conversion and offset of the ElectricalSeries,
+        if their float data turns out to be scaled 16-bit values. Data that cannot be stored
+        exactly is kept as float. Overrides the write profile.
+    htk_codes : bool
+        Write the int16 values of compressed HTK files as they are stored, with the A/B coefficients
+        of the files as the conversion and offset of the e-series (or as a scaling table in scratch,
+        if they differ between channels), rather than decoding them to float32.
+    device_files : bool
+        Write the data of each device to its own HDF5 file next to the NWB file, in parallel
+        processes, and link to these files from the NWB file (HDF5 external links).
+    num_processes : int
+        Number of processes writing the device files. Default is one per device.
+    onset_source : str
+        Where the stimulus onsets come from: 'mark' (default) thresholds the analog mark track,
+        'epocs' reads the onset times of the TDT 'mark' epoc from the block headers, and 'auto'
+        uses the epocs if the block has them (see StimulusOriginator).
+    report : bool
+        Count the bytes and the read/write times of each dataset, and write them as a JSON
+        report next to the NWB file (see get_report_file). Default is True.
+    report_provenance : bool
+        Also attach the JSON report to the NWB file, as scratch data 'conversion_report'.
     """
 
     def __init__(
@@ -63,7 +108,18 @@ class NWBBuilder:
             metadata_lib_path: str = '',
             stim_lib_path: str = '',
             session_start_time=_DEFAULT_SESSION_START_TIME,
-            use_htk=False
+            use_htk=False,
+            num_threads=None,
+            write_profile=None,
+            write_buffers=None,
+            write_buffer_size=None,
+            quantize=None,
+            htk_codes=False,
+            device_files=False,
+            num_processes=None,
+            onset_source='mark',
+            report=True,
+            report_provenance=False
     ):
         self.data_path = get_data_path(data_path)
         self.metadata_lib_path = get_metadata_lib_path(metadata_lib_path)
@@ -76,6 +132,17 @@ class NWBBuilder:
         self.stim_lib_path = stim_lib_path
         self.session_start_time = session_start_time
         self.use_htk = use_htk
+        self.num_threads = num_threads
+        self.write_profile = WriteProfile.get(write_profile, num_buffers=write_buffers,
+                                              buffer_size=write_buffer_size, quantize=quantize)
+        self.htk_codes = htk_codes
+        self.device_files = device_files
+        self.num_processes = num_processes
+        self.onset_source = onset_source
+        # the report counts the datasets wrapped by the write profile
+        self.report = ThroughputReport() if report else None
+        self.report_provenance = report_provenance
+        self.write_profile.report = self.report
 
         logger.info('Collecting metadata for NWB conversion...')
         self.metadata = self._collect_nwb_metadata(block_metadata_path,
@@ -94,8 +161,12 @@ class NWBBuilder:
         self.device_originator = DeviceOriginator(self.metadata)
         self.electrode_groups_originator = ElectrodeGroupsOriginator(self.metadata)
         self.electrodes_originator = ElectrodesOriginator(self.metadata)
-        self.neural_data_originator = NeuralDataOriginator(self.dataset, self.metadata, use_htk=self.use_htk)
-        self.stimulus_originator = StimulusOriginator(self.dataset, self.metadata)
+        self.neural_data_originator = NeuralDataOriginator(self.dataset, self.metadata, use_htk=self.use_htk,
+                                                           write_profile=self.write_profile,
+                                                           htk_decode=not self.htk_codes)
+        self.stimulus_originator = StimulusOriginator(self.dataset, self.metadata,
+                                                      onset_source=self.onset_source,
+                                                      write_profile=self.write_profile)
 
     def _collect_nwb_metadata(self, block_metadata_path, metadata_lib_path, stim_lib_path):
         # collect metadata for NWB conversion
@@ -132,6 +203,7 @@ class NWBBuilder:
         nwb_content: an NWBFile object.
         '''
         logger.info('Building components for NWB')
+        start_time = time.perf_counter()
         current_time = datetime.now(tz=pytz.utc).astimezone(LOCAL_TIMEZONE)
 
         block_name = self.metadata['block_name']
@@ -162,25 +234,168 @@ class NWBBuilder:
         self.electrode_groups_originator.make(nwb_content)
         electrode_table_regions = self.electrodes_originator.make(nwb_content)
 
-        logger.info('Adding neural data...')
-        self.neural_data_originator.make(nwb_content, electrode_table_regions)
+        # Extract the stores of the block (devices and mark track) concurrently, if the devices
+        # are read when they are extracted. Otherwise they are read while the NWB file is written.
+        num_threads = self.num_threads
+        if num_threads is None:
+            reads_on_extract = not self.device_files and self.neural_data_originator.reads_on_extract()
+            # one thread per device that is read (the metadata also lists annotations), and one for the mark
+            num_threads = len(self.neural_data_originator.get_devices()) + 1 if reads_on_extract else 1
+        executor = ThreadPoolExecutor(max_workers=num_threads) if num_threads > 1 else None
+        try:
+            if process_stim and executor is not None:
+                self.stimulus_originator.prefetch(executor)
 
-        if process_stim:
-            logger.info('Adding stimulus...')
-            self.stimulus_originator.make(nwb_content)
-        else:
-            logger.info('Skipping stimulus...')
+            logger.info('Adding neural data...')
+            device_files = None
+            if self.device_files:
+                device_files = {device_name: self.get_device_file(device_name)
+                                for device_name in self.neural_data_originator.get_devices()}
+            self.neural_data_originator.make(nwb_content, electrode_table_regions, executor=executor,
+                                             device_files=device_files, num_processes=self.num_processes)
 
+            if process_stim:
+                logger.info('Adding stimulus...')
+                self.stimulus_originator.make(nwb_content)
+            else:
+                logger.info('Skipping stimulus...')
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        if self.report is not None:
+            self.report.add_time('build', time.perf_counter() - start_time)
         return nwb_content
 
+    def plan(self, throughput_reports=None, process_stim=True):
+        '''Estimate the output size, peak memory and duration of the conversion, without
+        reading or writing any data (dry run). Only the headers of the input files are read.
+
+        Parameters
+        ----------
+        throughput_reports: list of paths to the JSON throughput reports of previous conversions,
+                used to calibrate the throughput table (see ConversionPlanner). Default rates if None.
+        process_stim: (bool) include the mark and stimulus datasets
+
+        Returns:
+        --------
+        plan: dict with the estimates per dataset and in total (see ConversionPlanner.plan)
+        '''
+        throughput = ThroughputTable.from_reports(throughput_reports) if throughput_reports else None
+        descriptions = self.neural_data_originator.describe()
+        if process_stim:
+            descriptions += self.stimulus_originator.describe()
+        plan = ConversionPlanner(self.write_profile, throughput).plan(descriptions, self.output_file)
+
+        total = plan['total']
+        logger.info('Planned conversion of {}: {:.1f} MB output, {:.1f} MB peak memory, {:.0f} s'.format(
+            self.block_folder, total['output_bytes'] / 1e6, total['peak_memory_bytes'] / 1e6, total['duration']))
+        if total['output_bytes'] > plan['free_disk_bytes']:
+            logger.warning('Expected output size exceeds the free disk space ({:.1f} MB)'.format(
+                plan['free_disk_bytes'] / 1e6))
+        if plan['available_memory_bytes'] is not None and total['peak_memory_bytes'] > plan['available_memory_bytes']:
+            logger.warning('Expected peak memory exceeds the available memory ({:.1f} MB)'.format(
+                plan['available_memory_bytes'] / 1e6))
+        return plan
+
+    def get_device_file(self, device_name):
+        '''Path of the HDF5 file holding the data of a device (if device_files is set)'''
+        return '{}_{}.h5'.format(os.path.splitext(self.output_file)[0], device_name)
+
+    def get_report_file(self):
+        '''Path of the JSON throughput report (if report is set)'''
+        return '{}_throughput.json'.format(os.path.splitext(self.output_file)[0])
+
+    def __write_report(self):
+        '''Complete the throughput report with the dataset sizes in the file, and write it.'''
+        if self.report is None:
+            return
+        self.report.update_storage(self.output_file)
+        if self.report_provenance:
+            with h5py.File(self.output_file, 'a') as h5_file:
+                # replace the report of a previous conversion (e.g., before an update)
+                if '/scratch/conversion_report' in h5_file:
+                    del h5_file['/scratch/conversion_report']
+            with NWBHDF5IO(self.output_file, mode='a') as nwb_fileIO:
+                nwb_content = nwb_fileIO.read()
+                nwb_content.add_scratch(self.report.to_json(), name='conversion_report',
+                                        description='Throughput counters of the datasets of the conversion (JSON)')
+                nwb_fileIO.write(nwb_content)
+        logger.info('Writing throughput report to ' + self.get_report_file())
+        self.report.write(self.get_report_file())
+
+    # HDF5 paths of the components that can be rebuilt in an existing NWB file
+    update_paths = {
+        'mark': '/stimulus/presentation/recorded_mark',
+        'trials': '/intervals/trials',
+        'stimulus': '/stimulus/presentation/raw_stimulus',
+    }
+
+    def update(self, components=('trials', 'stimulus')):
+        '''Rebuild only the given components in the existing output file, in place.
+
+        The acquisition (raw e-series) and all other components are left untouched, so that
+        fixing e.g. the tokenizer or the stimulus alignment does not read and write the neural
+        data again. Note, the starting time of the stimulus depends on the trials, so that the
+        stimulus should be rebuilt together with the trials.
+
+        Parameters
+        ----------
+        components: list of 'mark', 'trials' and/or 'stimulus'
+
+        Returns:
+        --------
+        output_file: path to the updated NWB file.
+        '''
+        unknown = set(components) - set(self.update_paths)
+        if unknown:
+            raise ValueError('unknown components {}. Available components: {}'.format(
+                sorted(unknown), list(self.update_paths.keys())))
+        # rebuild in dependency order: the trials need the mark, the stimulus needs the trials
+        components = [c for c in self.update_paths if c in components]
+        if not os.path.isfile(self.output_file):
+            raise FileNotFoundError('cannot update {}: file does not exist'.format(self.output_file))
+
+        # pynwb cannot remove objects from a file, so the old components are moved aside with h5py,
+        # and only deleted once the new ones have been written (they are restored if the rebuild fails)
+        logger.info('Rebuilding {} in {}...'.format(components, self.output_file))
+        start_time = time.perf_counter()
+        try:
+            with replace_groups(self.output_file, [self.update_paths[c] for c in components]):
+                with self.write_profile.open_file(self.output_file, mode='a') as h5_file:
+                    with NWBHDF5IO(mode='a', file=h5_file) as nwb_fileIO:
+                        nwb_content = nwb_fileIO.read()
+                        self.stimulus_originator.make(nwb_content, components=components)
+                        nwb_fileIO.write(nwb_content)
+        finally:
+            self.write_profile.close()
+
+        if self.report is not None:
+            self.report.add_time('update', time.perf_counter() - start_time)
+        self.__write_report()
+        logger.info(self.output_file + ' file has been updated.')
+        return self.output_file
+
     def write(self, content):
         '''Write collected NWB content into an actual file.
         '''
 
         logger.info('Writing down content to ' + self.output_file)
-        with NWBHDF5IO(path=self.output_file, mode='w') as nwb_fileIO:
-            nwb_fileIO.write(content)
-            nwb_fileIO.close()
+        start_time = time.perf_counter()
+        # the chunk cache of the write profile is set on the h5py file
+        try:
+            with self.write_profile.open_file(self.output_file, mode='w') as h5_file:
+                with NWBHDF5IO(mode='w', file=h5_file) as nwb_fileIO:
+                    nwb_fileIO.write(content)
+                    nwb_fileIO.close()
+        finally:
+            # stop the read-ahead of the data that has not been written (if the write failed)
+            self.write_profile.close()
+            # the links to the device files have been written
+            self.neural_data_originator.close()
 
+        if self.report is not None:
+            self.report.add_time('write', time.perf_counter() - start_time)
+        self.__write_report()
         logger.info(self.output_file + ' file has been created.')
         return self.output_file
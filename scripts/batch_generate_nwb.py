@@ -0,0 +1,79 @@
+#!/user/bin/env python
+import logging.config
+import os
+import argparse
+import json
+
+from nsds_lab_to_nwb.utils import (get_data_path, get_metadata_lib_path,
+                                   get_stim_lib_path)
+from nsds_lab_to_nwb.batch_builder import BatchBuilder
+
+
+PWD = os.path.dirname(os.path.abspath(__file__))
+logging.config.fileConfig(fname=str(PWD) + '/../nsds_lab_to_nwb/logging.conf', disable_existing_loggers=False)
+
+parser = argparse.ArgumentParser(description='Convert a batch of blocks to NWB files in parallel.')
+parser.add_argument('save_path', type=str, help='Path to save the NWB files.')
+parser.add_argument('block_metadata_path', type=str,
+                    help=('Path to the block metadata CSV of the animal. {block_folder} is replaced '
+                          'by the block folder (e.g., for the YAML file of each legacy block).'))
+parser.add_argument('block_folders', type=str, nargs='+',
+                    help='<animal>_<block> block specifications, or glob patterns such as RVG02_B*.')
+parser.add_argument('--data_path', '-d', type=str, default=None,
+                    help='Path to the top level data folder.')
+parser.add_argument('--metadata_lib_path', '-m', type=str, default=None,
+                    help='Path to the metadata library repo.')
+parser.add_argument('--stim_lib_path', '-s', type=str, default=None,
+                    help='Path to the stimulus library.')
+parser.add_argument('--use_htk', '-k', action='store_true',
+                    help='Use data from HTK rather than TDT files.')
+parser.add_argument('--write_profile', '-w', type=str, default=None,
+                    help=('HDF5 chunking and compression of the written datasets: '
+                          'a preset (none, gzip, lzf) or the path to a YAML profile.'))
+parser.add_argument('--quantize', action='store_true', default=None,
+                    help=('Store the neural data as int16 with a conversion factor, if it is exactly '
+                          'scaled 16-bit data (otherwise it is kept as float32).'))
+parser.add_argument('--htk_codes', action='store_true',
+                    help=('Write compressed HTK data as its int16 values with a conversion factor, '
+                          'instead of decoding it to float32.'))
+parser.add_argument('--num_workers', '-n', type=int, default=None,
+                    help=('Number of blocks converted in parallel (default: half the number of CPUs). '
+                          '0 converts the blocks one after another in this process.'))
+parser.add_argument('--manifest', type=str, default=None,
+                    help=('Path of the manifest with the status of each block, used to resume the batch '
+                          '(default: batch_manifest.json in save_path).'))
+parser.add_argument('--retry_failed', action='store_true',
+                    help='Also convert the blocks that failed in a previous run of the batch.')
+parser.add_argument('--no_report', action='store_true',
+                    help='Do not write the JSON throughput reports next to the NWB files.')
+
+
+def main():
+    args = parser.parse_args()
+    data_path = get_data_path(args.data_path)
+
+    batch_builder = BatchBuilder(
+        save_path=args.save_path,
+        block_metadata_path=args.block_metadata_path,
+        manifest_path=args.manifest,
+        num_workers=args.num_workers,
+        retry_failed=args.retry_failed,
+        data_path=data_path,
+        metadata_lib_path=get_metadata_lib_path(args.metadata_lib_path),
+        stim_lib_path=get_stim_lib_path(args.stim_lib_path),
+        use_htk=args.use_htk,
+        write_profile=args.write_profile,
+        quantize=args.quantize,
+        htk_codes=args.htk_codes,
+        report=not args.no_report)
+
+    block_folders = BatchBuilder.find_blocks(args.block_folders, data_path=data_path)
+    counts = batch_builder.run(block_folders)
+    print(json.dumps(counts, indent=2))
+    if counts['failed']:
+        raise SystemExit(1)
+
+
+# the guard is needed for the worker processes converting the blocks
+if __name__ == '__main__':
+    main()
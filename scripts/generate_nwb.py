@@ -2,6 +2,7 @@
 import logging.config
 import os
 import argparse
+import json
 
 from nsds_lab_to_nwb.utils import (get_data_path, get_metadata_lib_path,
                                    get_stim_lib_path)
@@ -23,30 +24,98 @@ parser.add_argument('--stim_lib_path', '-s', type=str, default=None,
                     help='Path to the stimulus library.')
 parser.add_argument('--use_htk', '-k', action='store_true',
                     help='Use data from HTK rather than TDT files.')
+parser.add_argument('--write_profile', '-w', type=str, default=None,
+                    help=('HDF5 chunking and compression of the written datasets: '
+                          'a preset (none, gzip, lzf) or the path to a YAML profile.'))
+parser.add_argument('--update', '-u', type=str, nargs='+', default=None,
+                    choices=list(NWBBuilder.update_paths.keys()),
+                    help=('Only rebuild the given components in the existing NWB file, '
+                          'leaving the neural data untouched.'))
+parser.add_argument('--write_buffers', type=int, default=None,
+                    help='Number of buffers read ahead of the HDF5 writer (0: no read-ahead).')
+parser.add_argument('--write_buffer_size', type=int, default=None,
+                    help='Size in bytes of each read-ahead buffer.')
+parser.add_argument('--quantize', action='store_true', default=None,
+                    help=('Store the neural data as int16 with a conversion factor, if it is exactly '
+                          'scaled 16-bit data (otherwise it is kept as float32).'))
+parser.add_argument('--htk_codes', action='store_true',
+                    help=('Write compressed HTK data as its int16 values with a conversion factor, '
+                          'instead of decoding it to float32.'))
+parser.add_argument('--device_files', action='store_true',
+                    help=('Write each device to its own HDF5 file in parallel processes, '
+                          'linked into the NWB file.'))
+parser.add_argument('--num_processes', type=int, default=None,
+                    help='Number of processes writing the device files (default: one per device).')
+parser.add_argument('--onset_source', type=str, default='mark', choices=['mark', 'epocs', 'auto'],
+                    help=('Where the stimulus onsets come from: the thresholded analog mark track (default), '
+                          'the TDT mark epoc, or the epoc if the block has one.'))
+parser.add_argument('--plan', action='store_true',
+                    help=('Only print the expected output size, peak memory and duration as JSON, '
+                          'without converting (dry run).'))
+parser.add_argument('--throughput_reports', type=str, nargs='+', default=None,
+                    help='Throughput reports of previous conversions used to calibrate the plan.')
+parser.add_argument('--no_report', action='store_true',
+                    help='Do not write the JSON throughput report next to the NWB file.')
+parser.add_argument('--report_provenance', action='store_true',
+                    help='Also attach the throughput report to the NWB file.')
 
-args = parser.parse_args()
-save_path = args.save_path
-block_folder = args.block_folder
-block_metadata_path = args.block_metadata_path
-data_path = get_data_path(args.data_path)
-metadata_lib_path = get_metadata_lib_path(args.metadata_lib_path)
-stim_lib_path = get_stim_lib_path(args.stim_lib_path)
-use_htk = args.use_htk
-
-# --- build NWB file for the specified block ---
-# NOTE: metadata collection is now done in NWBBuilder.__init__()
-# create a builder for the block
-nwb_builder = NWBBuilder(
-    data_path=data_path,
-    block_folder=block_folder,
-    save_path=save_path,
-    block_metadata_path=block_metadata_path,
-    metadata_lib_path=metadata_lib_path,
-    stim_lib_path=stim_lib_path,
-    use_htk=use_htk)
-
-# build the NWB file content
-nwb_content = nwb_builder.build()
-
-# write to file
-nwb_builder.write(nwb_content)
+
+def main():
+    args = parser.parse_args()
+    save_path = args.save_path
+    block_folder = args.block_folder
+    block_metadata_path = args.block_metadata_path
+    data_path = get_data_path(args.data_path)
+    metadata_lib_path = get_metadata_lib_path(args.metadata_lib_path)
+    stim_lib_path = get_stim_lib_path(args.stim_lib_path)
+    use_htk = args.use_htk
+    write_profile = args.write_profile
+    write_buffers = args.write_buffers
+    write_buffer_size = args.write_buffer_size
+    quantize = args.quantize
+    htk_codes = args.htk_codes
+    device_files = args.device_files
+    num_processes = args.num_processes
+    onset_source = args.onset_source
+    report = not args.no_report
+    report_provenance = args.report_provenance
+
+    # --- build NWB file for the specified block ---
+    # NOTE: metadata collection is now done in NWBBuilder.__init__()
+    # create a builder for the block
+    nwb_builder = NWBBuilder(
+        data_path=data_path,
+        block_folder=block_folder,
+        save_path=save_path,
+        block_metadata_path=block_metadata_path,
+        metadata_lib_path=metadata_lib_path,
+        stim_lib_path=stim_lib_path,
+        use_htk=use_htk,
+        write_profile=write_profile,
+        write_buffers=write_buffers,
+        write_buffer_size=write_buffer_size,
+        quantize=quantize,
+        htk_codes=htk_codes,
+        device_files=device_files,
+        num_processes=num_processes,
+        onset_source=onset_source,
+        report=report,
+        report_provenance=report_provenance)
+
+    if args.plan:
+        # dry run: only the headers of the input files are read
+        print(json.dumps(nwb_builder.plan(args.throughput_reports), indent=2))
+    elif args.update:
+        # rebuild components of the existing NWB file in place
+        nwb_builder.update(args.update)
+    else:
+        # build the NWB file content
+        nwb_content = nwb_builder.build()
+
+        # write to file
+        nwb_builder.write(nwb_content)
+
+
+# the guard is needed for the worker processes writing the device files
+if __name__ == '__main__':
+    main()
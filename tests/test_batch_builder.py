@@ -0,0 +1,85 @@
+import json
+import os
+
+import pytest
+
+from nsds_lab_to_nwb import batch_builder
+from nsds_lab_to_nwb.batch_builder import BatchBuilder, BatchManifest
+
+
+def test_find_blocks(tmpdir):
+    for block_folder in ('RVG02_B01', 'RVG02_B02', 'RVG03_B01'):
+        tmpdir.join(block_folder[:5], block_folder).ensure(dir=True)
+    assert BatchBuilder.find_blocks(['RVG02_B*', 'RVG02_B01', 'R56_B13'], data_path=str(tmpdir)) == \
+        ['RVG02_B01', 'RVG02_B02', 'R56_B13']
+    assert BatchBuilder.find_blocks(['*_B01'], data_path=str(tmpdir)) == ['RVG02_B01', 'RVG03_B01']
+
+
+def test_batch_builder_resume(tmpdir, monkeypatch):
+    converted = []
+
+    def convert_block(block_folder, block_metadata_path, save_path, builder_kwargs):
+        converted.append(block_folder)
+        if block_folder == 'RVG02_B02':
+            raise RuntimeError('conversion failed')
+        output_file = os.path.join(save_path, block_folder + '.nwb')
+        with open(output_file, 'w') as f:
+            f.write(block_folder)
+        return {'output_file': output_file, 'output_bytes': 9, 'output_hash': batch_builder.hash_file(output_file),
+                'timers': {}}
+
+    monkeypatch.setattr(batch_builder, '_convert_block', convert_block)
+    save_path = str(tmpdir)
+    block_folders = ['RVG02_B01', 'RVG02_B02', 'RVG02_B03']
+    builder = BatchBuilder(save_path, 'block_data.csv', num_workers=0)
+    counts = builder.run(block_folders)
+    assert converted == block_folders
+    assert (counts['done'], counts['failed']) == (2, 1)
+
+    manifest_path = os.path.join(save_path, BatchBuilder.default_manifest_name)
+    with open(manifest_path, 'r') as f:
+        blocks = json.load(f)['blocks']
+    assert blocks['RVG02_B01']['status'] == 'done'
+    assert blocks['RVG02_B01']['attempts'] == 1
+    assert len(blocks['RVG02_B01']['output_hash']) == 64
+    assert 'conversion failed' in blocks['RVG02_B02']['error']
+
+    # an interrupted block is converted again, done blocks are skipped
+    manifest = BatchManifest(manifest_path)
+    manifest.update('RVG02_B03', status='running')
+    del converted[:]
+    BatchBuilder(save_path, 'block_data.csv', num_workers=0).run(block_folders)
+    assert converted == ['RVG02_B03']
+
+    # a block whose NWB file is gone is converted again, failed blocks only if retried
+    os.remove(os.path.join(save_path, 'RVG02_B01.nwb'))
+    del converted[:]
+    counts = BatchBuilder(save_path, 'block_data.csv', num_workers=0, retry_failed=True).run(block_folders)
+    assert converted == ['RVG02_B01', 'RVG02_B02']
+    assert counts['failed'] == 1
+    assert BatchManifest(manifest_path).blocks['RVG02_B02']['attempts'] == 2
+
+
+class ExitWorker():
+    """Builder argument that kills the worker process it is unpickled in."""
+
+    def __reduce__(self):
+        return os._exit, (1,)
+
+
+@pytest.mark.parametrize('crash', [False, True])
+def test_batch_builder_pool(tmpdir, crash):
+    """Tests that the blocks converted in worker processes are recorded, also if a worker dies."""
+    save_path = str(tmpdir)
+    block_folders = ['RVG02_B01', 'RVG02_B02', 'RVG02_B03']
+    # the blocks fail in the worker, as there is no data
+    builder_kwargs = {'data_path': str(tmpdir.join('data'))}
+    if crash:
+        builder_kwargs['metadata_lib_path'] = ExitWorker()
+    counts = BatchBuilder(save_path, 'block_data.csv', num_workers=2, **builder_kwargs).run(block_folders)
+    assert (counts['done'], counts['failed']) == (0, 3)
+
+    blocks = BatchManifest(os.path.join(save_path, BatchBuilder.default_manifest_name)).blocks
+    for block_folder in block_folders:
+        assert blocks[block_folder]['attempts'] == 1
+        assert ('BrokenProcessPool' in blocks[block_folder]['error']) == crash
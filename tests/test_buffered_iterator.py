@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from hdmf.data_utils import DataChunkIterator
+
+from nsds_lab_to_nwb.common.buffered_iterator import BufferedChunkIterator
+
+
+def read_all(iterator, shape, dtype):
+    out = np.zeros(shape, dtype=dtype)
+    num_chunks = 0
+    for chunk in iterator:
+        out[chunk.selection] = chunk.data
+        num_chunks += 1
+    return out, num_chunks
+
+
+def test_buffered_chunk_iterator():
+    data = np.arange(1000 * 4, dtype='f').reshape(1000, 4)
+    source = DataChunkIterator(data=data, buffer_size=100)
+    iterator = BufferedChunkIterator(source, num_buffers=3)
+    assert iterator.maxshape == (1000, 4)
+    assert iterator.dtype == np.dtype('f')
+    # the buffers are never larger than the data
+    assert iterator.buffer_size == data.nbytes
+
+    out, num_chunks = read_all(iterator, data.shape, data.dtype)
+    np.testing.assert_array_equal(out, data)
+    assert num_chunks == 10
+    with pytest.raises(StopIteration):
+        next(iterator)
+
+
+def test_buffered_chunk_iterator_split():
+    data = np.arange(1000 * 4, dtype='f').reshape(1000, 4)
+    source = DataChunkIterator(data=data, buffer_size=500)
+    # each chunk of 500 rows is split into pieces of 64 rows
+    iterator = BufferedChunkIterator(source, num_buffers=2, buffer_size=64 * 4 * 4)
+    out, num_chunks = read_all(iterator, data.shape, data.dtype)
+    np.testing.assert_array_equal(out, data)
+    assert num_chunks == 2 * 8
+
+
+def test_buffered_chunk_iterator_error():
+    def generate():
+        yield np.zeros(4, dtype='f')
+        raise RuntimeError('read error')
+
+    source = DataChunkIterator(data=generate(), maxshape=(None, 4), dtype=np.dtype('f'))
+    iterator = BufferedChunkIterator(source)
+    next(iterator)
+    with pytest.raises(RuntimeError):
+        next(iterator)
@@ -0,0 +1,320 @@
+import gc
+import os
+from struct import pack
+
+import numpy as np
+import pytest
+
+from nsds_lab_to_nwb.components.htk.readers.htkfile import HTKFile, HTKFormat
+from nsds_lab_to_nwb.components.htk.readers.htkcollection import HTKCollection
+
+
+def write_htk(path, data, sample_rate=1000., compressed=False, A=None, B=None):
+    """Write a (num_samples, vector_length) array to an HTK file. If compressed, data holds the int16 codes."""
+    data = np.asarray(data)
+    num_samples, vector_length = data.shape
+    parameter_kind = HTKFormat.param_kind_base['USER']
+    if compressed:
+        parameter_kind |= HTKFormat.param_kind_encoding['_C']
+        sample_size = 2 * vector_length
+    else:
+        sample_size = 4 * vector_length
+    with open(path, 'wb') as f:
+        f.write(pack(HTKFormat.header_format(), num_samples, int(sample_rate * 10000),
+                     sample_size, parameter_kind))
+        if compressed:
+            f.write(np.asarray(A, dtype='>f4').tobytes())
+            f.write(np.asarray(B, dtype='>f4').tobytes())
+            f.write(data.astype('>i2').tobytes())
+        else:
+            f.write(data.astype('>f4').tobytes())
+
+
+@pytest.fixture
+def htk_dir(tmpdir):
+    """Directory with 4 single-band raw HTK channels, Wav1.htk ... Wav4.htk."""
+    rng = np.random.RandomState(0)
+    data = rng.randn(4, 100, 1).astype('f')
+    for i in range(4):
+        write_htk(os.path.join(str(tmpdir), 'Wav{}.htk'.format(i + 1)), data[i])
+    return str(tmpdir), data
+
+
+def test_htkfile_read_data(htk_dir):
+    """Tests that a raw HTK file is read with header information."""
+    directory, data = htk_dir
+    htkfile = HTKFile(os.path.join(directory, 'Wav1.htk'))
+    assert htkfile.num_samples == 100
+    assert htkfile.sample_rate == 1000.
+    assert htkfile.file_dtype == np.dtype('>f4')
+    np.testing.assert_array_equal(htkfile.read_data(), data[0])
+
+
+def test_htkfile_read_data_memmap(htk_dir):
+    """Tests that the memmap read path returns a lazy big-endian view with the same values."""
+    directory, data = htk_dir
+    htkfile = HTKFile(os.path.join(directory, 'Wav2.htk'))
+    mapped = htkfile.read_data(memmap=True)
+    assert isinstance(mapped, np.memmap)
+    assert mapped.dtype == np.dtype('>f4')
+    np.testing.assert_array_equal(mapped, data[1])
+
+
+def test_htkfile_read_data_compressed(tmpdir):
+    """Tests that compressed HTK files are decoded with the A/B coefficients."""
+    codes = np.arange(-50, 50, dtype='int16').reshape(50, 2)
+    A, B = np.array([2., 4.]), np.array([1., -1.])
+    path = os.path.join(str(tmpdir), 'comp11.htk')
+    write_htk(path, codes, compressed=True, A=A, B=B)
+    expected = (codes.astype('f') + B.astype('f')) / A.astype('f')
+    np.testing.assert_allclose(HTKFile(path).read_data(), expected)
+    np.testing.assert_allclose(HTKFile(path).read_data(memmap=True), expected)
+
+
+def test_htkcollection_read_channel(htk_dir):
+    """Tests that channels are found, sorted and read with and without memmap."""
+    directory, data = htk_dir
+    for memmap in (False, True):
+        collection = HTKCollection(directory, prefix='Wav', postfix=np.arange(1, 5), memmap=memmap)
+        assert collection.shape == (4, 100, 1)
+        for i in range(4):
+            np.testing.assert_array_equal(collection.read_channel(i), data[i])
+
+
+def test_htk_channel_iterator_tiles(htk_dir):
+    """Tests that the iterator emits chunk-aligned (time, channel) tiles that reassemble the data."""
+    from nsds_lab_to_nwb.components.htk.readers.htkcollection import HTKChannelIterator
+    directory, data = htk_dir
+    collection = HTKCollection(directory, prefix='Wav', postfix=np.arange(1, 5))
+    iterator = HTKChannelIterator.from_htk_collection(collection, time_axis_first=True, has_bands=False,
+                                                      chunk_shape=(16, 2), memory_budget=16 * 2 * 4 * 3)
+    assert iterator.recommended_chunk_shape() == (16, 2)
+    assert iterator.maxshape == (100, 4)
+    out = np.zeros(iterator.maxshape, dtype='f')
+    tile_shapes = []
+    for chunk in iterator:
+        out[chunk.selection] = chunk.data
+        tile_shapes.append(chunk.data.shape)
+    np.testing.assert_array_equal(out, data[:, :, 0].T)
+    assert tile_shapes[0] == (48, 2)
+    assert len(tile_shapes) == 6
+
+
+def test_htk_channel_iterator_prefetch(htk_dir):
+    """Tests that prefetching in reader threads returns the same tiles in the same order."""
+    from nsds_lab_to_nwb.components.htk.readers.htkcollection import HTKChannelIterator
+    directory, data = htk_dir
+    collection = HTKCollection(directory, prefix='Wav', postfix=np.arange(1, 5))
+    iterator = HTKChannelIterator.from_htk_collection(collection, time_axis_first=True, has_bands=False,
+                                                      chunk_shape=(10, 1), memory_budget=40,
+                                                      prefetch=3, num_threads=2)
+    selections = []
+    out = np.zeros(iterator.maxshape, dtype='f')
+    for chunk in iterator:
+        out[chunk.selection] = chunk.data
+        selections.append(chunk.selection)
+    np.testing.assert_array_equal(out, data[:, :, 0].T)
+    assert len(selections) == 40
+    assert selections[1] == np.s_[10:20, 0:1]
+
+
+def test_htkcollection_read_data_parallel(htk_dir):
+    """Tests that reading with a process pool into shared memory gives the same data."""
+    directory, data = htk_dir
+    collection = HTKCollection(directory, prefix='Wav', postfix=np.arange(1, 5))
+    np.testing.assert_array_equal(collection.read_data(num_workers=2), data)
+    np.testing.assert_array_equal(collection.read_channel(2), data[2])
+    collection.clear_data()
+    assert collection.data is None
+
+
+def test_htkcollection_read_data_parallel_lifetime(htk_dir):
+    """Tests that the shared memory stays mapped while the data is used after the collection is gone."""
+    directory, data = htk_dir
+
+    def read_data():
+        return HTKCollection(directory, prefix='Wav', postfix=np.arange(1, 5)).read_data(num_workers=2)
+
+    parallel_data = read_data()
+    gc.collect()
+    assert parallel_data.sum() == data.sum()
+    channel = parallel_data[1]
+    del parallel_data
+    gc.collect()
+    np.testing.assert_array_equal(channel, data[1])
+
+
+def test_htkcollection_read_compressed_parallel(tmpdir):
+    """Tests that compressed files are decoded into shared memory."""
+    codes = np.random.RandomState(0).randint(-1000, 1000, size=(3, 100, 2)).astype('int16')
+    A, B = np.array([2., 4.]), np.array([1., -1.])
+    for i in range(3):
+        write_htk(os.path.join(str(tmpdir), 'Wav{}.htk'.format(i + 1)), codes[i], compressed=True, A=A, B=B)
+    collection = HTKCollection(str(tmpdir), prefix='Wav', postfix=np.arange(1, 4))
+    np.testing.assert_allclose(collection.read_data(num_workers=2), (codes + B) / A)
+    collection.clear_data()
+
+
+def test_read_htk_headers(htk_dir):
+    """Tests the header-only scan and the consistency check of a collection."""
+    from nsds_lab_to_nwb.components.htk.readers.htkfile import read_htk_headers
+    directory, data = htk_dir
+    filenames = [os.path.join(directory, 'Wav{}.htk'.format(i + 1)) for i in range(4)]
+    headers = read_htk_headers(filenames)
+    assert headers.shape == (4,)
+    assert np.all(headers['num_samples'] == 100)
+    assert np.all(headers['sample_size'] == 4)
+    collection = HTKCollection(directory, prefix='Wav', postfix=np.arange(1, 5), check_consistency=True)
+    assert collection.get_number_of_files() == 4
+    # Same file size, but different sample rate
+    write_htk(os.path.join(directory, 'Wav4.htk'), data[3], sample_rate=2000.)
+    with pytest.raises(AssertionError):
+        HTKCollection(directory, prefix='Wav', postfix=np.arange(1, 5), check_consistency=True)
+
+
+def test_read_window(htk_dir, tmpdir):
+    """Tests time-window reads on single files and on the collection."""
+    directory, data = htk_dir
+    htkfile = HTKFile(os.path.join(directory, 'Wav3.htk'))
+    np.testing.assert_array_equal(htkfile.read_window(0.01, 0.025), data[2, 10:25])
+    np.testing.assert_array_equal(htkfile.read_window(0.09, 1.), data[2, 90:])
+    collection = HTKCollection(directory, prefix='Wav', postfix=np.arange(1, 5))
+    window = collection.read_window(0.05, 0.06, channels=[3, 1])
+    np.testing.assert_array_equal(window, data[[3, 1], 50:60, 0].T)
+    assert collection.read_window(0., 0.1).shape == (100, 4)
+    # compressed files are decoded for the window only
+    codes = np.arange(-50, 50, dtype='int16').reshape(50, 2)
+    A, B = np.array([2., 4.]), np.array([1., -1.])
+    path = os.path.join(str(tmpdir), 'comp11.htk')
+    write_htk(path, codes, compressed=True, A=A, B=B)
+    expected = (codes.astype('f') + B.astype('f')) / A.astype('f')
+    np.testing.assert_allclose(HTKFile(path).read_window(0.005, 0.007), expected[5:7])
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'), reason='requires /proc to count open files')
+def test_htk_file_handle_pool(htk_dir):
+    """Tests that HTKFile closes deterministically and that the collection reuses a bounded pool of files."""
+    directory, data = htk_dir
+    with HTKFile(os.path.join(directory, 'Wav1.htk')) as htkfile:
+        np.testing.assert_array_equal(htkfile.read_samples(5, 10), data[0, 5:10])
+    assert htkfile.closed
+    with HTKCollection(directory, prefix='Wav', postfix=np.arange(1, 5), max_open_files=2) as collection:
+        num_open = len(os.listdir('/proc/self/fd'))
+        for t_start in (0., 0.02, 0.04):
+            window = collection.read_window(t_start, t_start + 0.01)
+            np.testing.assert_array_equal(window, data[:, int(t_start * 1000):int(t_start * 1000) + 10, 0].T)
+        assert len(os.listdir('/proc/self/fd')) == num_open + 2
+    assert len(os.listdir('/proc/self/fd')) == num_open
+
+
+def test_htkfile_decode_compressed_blocks(tmpdir):
+    """Tests that compressed HTK files are decoded block by block into float32."""
+    codes = np.arange(-50, 50, dtype='int16').reshape(50, 2)
+    A, B = np.array([2., 4.]), np.array([1., -1.])
+    path = os.path.join(str(tmpdir), 'comp11.htk')
+    write_htk(path, codes, compressed=True, A=A, B=B)
+    expected = (codes.astype('f') + B.astype('f')) / A.astype('f')
+    with HTKFile(path) as htkfile:
+        blocks = list(htkfile.iter_blocks(block_size=16))
+        assert [len(block) for block in blocks] == [16, 16, 16, 2]
+        np.testing.assert_allclose(np.concatenate(blocks), expected)
+        for memmap in (False, True):
+            data = htkfile.read_data(memmap=memmap, block_size=7)
+            assert data.dtype == np.dtype('f')
+            np.testing.assert_allclose(data, expected)
+
+
+def test_htkcollection_index_file(htk_dir, tmpdir_factory, monkeypatch):
+    """Tests that the directory layout is cached in a sidecar index that is invalidated by file changes."""
+    directory, data = htk_dir
+    index_file = os.path.join(str(tmpdir_factory.mktemp('index')), 'htk.json')
+    collection = HTKCollection(directory, prefix='Wav', postfix=np.arange(1, 5), index_file=index_file)
+    assert collection.index_file == index_file and os.path.isfile(index_file)
+    with monkeypatch.context() as m:
+        m.setattr(os, 'scandir', None)  # The directory must not be listed again
+        cached = HTKCollection(directory, prefix='Wav', postfix=np.arange(1, 5), index_file=index_file)
+    assert cached.htk_files == collection.htk_files
+    assert cached.file_to_channel_map == collection.file_to_channel_map
+    np.testing.assert_array_equal(cached.channel_to_file_map, collection.channel_to_file_map)
+    assert (cached.num_samples, cached.sample_rate, cached.dtype) == (100, 1000., np.dtype('f'))
+    np.testing.assert_array_equal(cached.read_channel(3), data[3])
+    # A different selection of files gets its own entry in the index
+    assert HTKCollection(directory, prefix='Wav', postfix=np.arange(1, 3), index_file=index_file).shape[0] == 2
+    # Changing the size of a file invalidates the index
+    write_htk(os.path.join(directory, 'Wav2.htk'), np.zeros((50, 1)))
+    with pytest.raises(ValueError):
+        HTKCollection(directory, prefix='Wav', postfix=np.arange(1, 5), index_file=index_file)
+    # The default index is kept in the user cache directory, not next to the raw data
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir_factory.mktemp('cache')))
+    default_index_file = HTKCollection.get_index_file(directory)
+    assert default_index_file.startswith(os.environ['XDG_CACHE_HOME'])
+    collection = HTKCollection(directory, prefix='Wav', postfix=np.arange(3, 5), index_file=True)
+    assert collection.index_file == default_index_file and os.path.isfile(default_index_file)
+    assert not any(name.endswith('.htkindex.json') for name in os.listdir(os.path.dirname(directory)))
+
+
+def test_htkfile_read_codes(tmpdir):
+    """Tests that the int16 values of compressed HTK files are read as stored, with their scaling."""
+    codes = np.arange(-50, 50, dtype='int16').reshape(50, 2)
+    A, B = np.array([2., 4.]), np.array([1., -1.])
+    path = os.path.join(str(tmpdir), 'comp11.htk')
+    write_htk(path, codes, compressed=True, A=A, B=B)
+    with HTKFile(path) as htkfile:
+        assert htkfile.compressed
+        conversion, offset = htkfile.get_scaling()
+        np.testing.assert_array_equal(conversion, 1. / A)
+        np.testing.assert_array_equal(offset, B / A)
+        np.testing.assert_array_equal(htkfile.read_samples(10, 20, decode=False), codes[10:20])
+        for memmap in (False, True):
+            data = htkfile.read_data(memmap=memmap, decode=False)
+            assert data.dtype.kind == 'i'
+            np.testing.assert_array_equal(data, codes)
+            # the samples of the cached data are decoded (or not) as requested
+            decoded = htkfile.read_samples(10, 20)
+            np.testing.assert_allclose(decoded, (codes[10:20] + B) / A)
+            htkfile.read_data(memmap=memmap)
+            np.testing.assert_array_equal(htkfile.read_samples(10, 20), decoded)
+            np.testing.assert_array_equal(htkfile.read_samples(10, 20, decode=False), codes[10:20])
+
+
+def test_htk_manager_codes(tmpdir):
+    """Tests that compressed HTK channels are written as int16 with the conversion of their coefficients."""
+    from datetime import datetime
+    from dateutil.tz import tzlocal
+    from pynwb import NWBFile, NWBHDF5IO
+    from nsds_lab_to_nwb.components.htk.htk_manager import HtkManager
+
+    codes = np.random.RandomState(0).randint(-1000, 1000, size=(4, 100, 1)).astype('int16')
+    dev_conf = {'prefix': 'Wav', 'ch_ids': [1, 2, 3, 4], 'device_type': 'ECoG', 'sampling_rate': 1000.}
+    for uniform in (True, False):
+        directory = str(tmpdir.mkdir('uniform' if uniform else 'channels'))
+        for i in range(4):
+            A = [8.] if uniform else [8. * (i + 1)]
+            write_htk(os.path.join(directory, 'Wav{}.htk'.format(i + 1)), codes[i], compressed=True, A=A, B=[4.])
+        nwbfile = NWBFile('test', 'test', datetime.now(tzlocal()))
+        group = nwbfile.create_electrode_group('group', 'test', 'test', nwbfile.create_device('device'))
+        for i in range(4):
+            nwbfile.add_electrode(group=group, location='test')
+        region = nwbfile.create_electrode_table_region(list(range(4)), 'electrodes')
+
+        manager = HtkManager(directory, index_file=False, decode=False)
+        nwbfile.add_acquisition(manager.extract('Wave', dev_conf, region))
+        for table in manager.scaling_tables.values():
+            nwbfile.add_scratch(table)
+        path = os.path.join(directory, 'test.nwb')
+        with NWBHDF5IO(path, mode='w') as io:
+            io.write(nwbfile)
+
+        with NWBHDF5IO(path, mode='r') as io:
+            read_nwbfile = io.read()
+            e_series = read_nwbfile.acquisition['Wave']
+            assert e_series.data.dtype == np.dtype('int16')
+            np.testing.assert_array_equal(e_series.data[:], codes[..., 0].T)
+            if uniform:
+                assert (e_series.conversion, e_series.offset) == (1. / 8., 0.5)
+                assert 'Wave_scaling' not in read_nwbfile.scratch
+            else:
+                assert (e_series.conversion, e_series.offset) == (1., 0.)
+                table = read_nwbfile.scratch['Wave_scaling'].to_dataframe()
+                np.testing.assert_array_equal(table['conversion'], 1. / (8. * np.arange(1, 5)))
+                np.testing.assert_array_equal(table['offset'], 4. / (8. * np.arange(1, 5)))
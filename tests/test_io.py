@@ -0,0 +1,81 @@
+from datetime import datetime
+
+import h5py
+import numpy as np
+import pytest
+import pytz
+from pynwb import NWBFile, NWBHDF5IO, TimeSeries
+
+from nsds_lab_to_nwb.common.io import BACKUP_GROUP, replace_groups
+
+MARK_PATH = '/stimulus/presentation/recorded_mark'
+TRIALS_PATH = '/intervals/trials'
+
+
+def add_components(nwb_content, num_samples):
+    nwb_content.add_stimulus(TimeSeries(name='recorded_mark', data=np.arange(num_samples, dtype='f'),
+                                        unit='Volts', starting_time=0., rate=1000.))
+    nwb_content.add_trial_column('sb', 'Stimulus (s) or baseline (b) period')
+    nwb_content.add_trial(start_time=0., stop_time=float(num_samples), sb='s')
+
+
+def rebuild_components(path, num_samples, error=None):
+    """Replace the mark and trials of an NWB file, raising error after the new ones have been written."""
+    with replace_groups(path, [MARK_PATH, TRIALS_PATH]):
+        with NWBHDF5IO(path, mode='a') as io:
+            nwb_content = io.read()
+            add_components(nwb_content, num_samples)
+            io.write(nwb_content)
+        if error is not None:
+            raise error
+
+
+def read_components(path):
+    with NWBHDF5IO(path, mode='r') as io:
+        nwb_content = io.read()
+        return (nwb_content.stimulus['recorded_mark'].data[:],
+                nwb_content.trials.to_dataframe()['stop_time'].tolist())
+
+
+@pytest.fixture
+def nwb_file(tmpdir):
+    path = str(tmpdir.join('block.nwb'))
+    nwb_content = NWBFile(session_description='test', identifier='test',
+                          session_start_time=datetime(2020, 1, 1, tzinfo=pytz.utc))
+    add_components(nwb_content, 10)
+    with NWBHDF5IO(path, mode='w') as io:
+        io.write(nwb_content)
+    return path
+
+
+def test_replace_groups(nwb_file):
+    rebuild_components(nwb_file, 5)
+    mark, stop_times = read_components(nwb_file)
+    np.testing.assert_array_equal(mark, np.arange(5))
+    assert stop_times == [5.]
+    with h5py.File(nwb_file, 'r') as h5_file:
+        assert BACKUP_GROUP not in h5_file
+
+
+def test_replace_groups_failure(nwb_file):
+    """Tests that the old groups are restored if the rebuild fails, even after the new ones were written."""
+    with pytest.raises(RuntimeError, match='rebuild failed'):
+        rebuild_components(nwb_file, 5, error=RuntimeError('rebuild failed'))
+    mark, stop_times = read_components(nwb_file)
+    np.testing.assert_array_equal(mark, np.arange(10))
+    assert stop_times == [10.]
+    with h5py.File(nwb_file, 'r') as h5_file:
+        assert BACKUP_GROUP not in h5_file
+
+
+def test_replace_groups_interrupted(nwb_file):
+    """Tests that the backup of an interrupted replacement is restored before the next one."""
+    with h5py.File(nwb_file, 'a') as h5_file:
+        h5_file.create_group(BACKUP_GROUP).attrs['group_paths'] = '["{}"]'.format(MARK_PATH)
+        h5_file.move(MARK_PATH, BACKUP_GROUP + '/0')
+        h5_file.create_group(MARK_PATH)  # partially written new mark
+    with replace_groups(nwb_file, []):
+        pass
+    np.testing.assert_array_equal(read_components(nwb_file)[0], np.arange(10))
+    with h5py.File(nwb_file, 'r') as h5_file:
+        assert BACKUP_GROUP not in h5_file
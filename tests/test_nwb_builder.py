@@ -0,0 +1,156 @@
+import os
+
+import h5py
+import numpy as np
+import pytest
+from pynwb import NWBHDF5IO
+
+from nsds_lab_to_nwb.common.data_scanners import Dataset
+from nsds_lab_to_nwb.common.io import BACKUP_GROUP
+from nsds_lab_to_nwb.components.htk.htk_reader import HtkReader
+from nsds_lab_to_nwb.components.tdt.tdt_reader import TDTReader
+from nsds_lab_to_nwb.nwb_builder import NWBBuilder
+
+from test_htk_reader import write_htk
+from test_tdt_reader import write_tdt_block
+
+BLOCK_FOLDER = 'RVG02_B01'
+MARK_RATE = 1000.
+MARK_ONSETS = [0.5, 1.5, 2.5]
+
+
+def make_metadata():
+    """Block metadata of a 2-channel Wave device and a white noise stimulus."""
+    ch_pos = {str(ch): {'x': float(ch), 'y': 0., 'z': 0.} for ch in (1, 2)}
+    return {'block_name': BLOCK_FOLDER, 'experiment_type': 'auditory',
+            'session_description': 'test', 'experimenter': 'test', 'lab': 'test', 'institution': 'test',
+            'experiment_description': 'test',
+            'subject': {'subject id': 'RVG02', 'description': 'test', 'genotype': 'wt', 'sex': 'U',
+                        'species': 'Rattus norvegicus'},
+            'device': {'Wave': {'manufacturer': 'TDT', 'ch_ids': [1, 2], 'ch_pos': ch_pos},
+                       'mark': 'analog mark track'},
+            'stimulus': {'name': 'wn1', 'duration': 0.1, 'baseline_start': 0., 'baseline_end': 0.,
+                         'mark_offset': 0.01, 'mark_threshold': 0.5, 'nsamples': 3}}
+
+
+@pytest.fixture
+def block(tmpdir, monkeypatch):
+    """Factory of NWBBuilders for a block with a 2-channel Wave stream (int16 codes scaled by 2 ** -15)
+    and an HTK mark track with a 50 ms pulse at each of MARK_ONSETS. Returns (make_builder, wave)."""
+    data_path = str(tmpdir.join('data'))
+    # the index of the block headers is written to the user cache
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('cache')))
+    tdt_path = os.path.join(data_path, 'RVG02', BLOCK_FOLDER)
+    os.makedirs(os.path.dirname(tdt_path))
+    rng = np.random.RandomState(0)
+    wave = (rng.randint(-1000, 1000, size=(2, 64 * 50)) * 2. ** -15).astype('f')
+    write_tdt_block(tdt_path, streams={'Wave': (wave, 0.)})
+    mark_track = np.zeros((int(3.5 * MARK_RATE), 1), dtype='float32')
+    for onset in MARK_ONSETS:
+        mark_track[int(onset * MARK_RATE):int((onset + 0.05) * MARK_RATE)] = 1.
+    mark_path = os.path.join(data_path, 'mark.htk')
+    write_htk(mark_path, mark_track, sample_rate=MARK_RATE)
+    dataset = Dataset(BLOCK_FOLDER, data_path, tdt_path=tdt_path, mark_path=mark_path, stim_path=data_path)
+
+    def make_builder(metadata=None, **kwargs):
+        # the metadata library and the data scanner are replaced by the synthetic block
+        metadata = metadata or make_metadata()
+        monkeypatch.setattr(NWBBuilder, '_collect_nwb_metadata', lambda self, *args: metadata)
+        monkeypatch.setattr(NWBBuilder, '_collect_dataset_paths', lambda self: dataset)
+        return NWBBuilder(data_path, BLOCK_FOLDER, str(tmpdir.join('nwb')), 'block_data.csv', **kwargs)
+
+    return make_builder, wave
+
+
+def test_nwb_builder_plan_reads_headers_only(block, monkeypatch):
+    """Tests that planning a conversion does not read the TDT streams or the mark track."""
+    make_builder, wave = block
+    builder = make_builder()
+
+    def fail_read(*args, **kwargs):
+        raise AssertionError('plan read the data')
+
+    monkeypatch.setattr(TDTReader, '_TDTReader__get_stream', fail_read)
+    monkeypatch.setattr(TDTReader, '_TDTReader__read_stream', fail_read)
+    monkeypatch.setattr(HtkReader, 'read_htk', fail_read)
+    plan = builder.plan()
+    shapes = {dataset['name']: tuple(dataset['shape']) for dataset in plan['datasets']}
+    assert shapes == {'Wave': wave.T.shape, 'recorded_mark': (int(3.5 * MARK_RATE), 1)}
+    assert not os.path.exists(builder.output_file)
+
+
+def read_nwb(path):
+    """Read the Wave data, the mark track and the stimulus start times of an NWB file."""
+    with NWBHDF5IO(path, mode='r') as io:
+        nwb_content = io.read()
+        e_series = nwb_content.acquisition['Wave']
+        wave = e_series.data[:] * e_series.conversion + e_series.offset
+        mark = nwb_content.stimulus['recorded_mark'].data[:]
+        start_times = nwb_content.trials.to_dataframe().query('sb == "s"')['start_time'].values
+        return wave, mark, start_times
+
+
+def test_nwb_builder_threads(block, monkeypatch):
+    """Tests that a block built with a thread pool (the mark track is read concurrently) is complete."""
+    make_builder, wave = block
+    builder = make_builder(num_threads=2)
+    prefetched = []
+    prefetch = builder.stimulus_originator.prefetch
+    monkeypatch.setattr(builder.stimulus_originator, 'prefetch',
+                        lambda executor: prefetched.append(executor) or prefetch(executor))
+    builder.write(builder.build())
+    assert len(prefetched) == 1
+    data, mark, start_times = read_nwb(builder.output_file)
+    np.testing.assert_array_equal(data, wave.T)
+    assert mark.shape == (int(3.5 * MARK_RATE), 1)
+    np.testing.assert_allclose(start_times, np.array(MARK_ONSETS) + 0.01)
+
+
+def test_nwb_builder_device_files(block):
+    """Tests that the e-series linked to quantized device files are read back with the scaling of the files."""
+    make_builder, wave = block
+    builder = make_builder(device_files=True, quantize=True)
+    builder.write(builder.build())
+    device_file = builder.get_device_file('Wave')
+    with h5py.File(device_file, 'r') as h5_file:
+        dataset = h5_file['data']
+        assert dataset.dtype == np.dtype('int16')
+        conversion, offset = dataset.attrs['conversion'], dataset.attrs['offset']
+    assert conversion != 1.
+    with NWBHDF5IO(builder.output_file, mode='r') as io:
+        e_series = io.read().acquisition['Wave']
+        assert e_series.data.file.filename == device_file
+        assert (e_series.conversion, e_series.offset) == (conversion, offset)
+        np.testing.assert_array_equal((e_series.data[:] * e_series.conversion + e_series.offset).astype('f'),
+                                      wave.T)
+    # the stimulus is written into the NWB file itself
+    np.testing.assert_allclose(read_nwb(builder.output_file)[2], np.array(MARK_ONSETS) + 0.01)
+
+
+def test_nwb_builder_update(block, monkeypatch):
+    """Tests that update rebuilds the trials in place, and leaves the file unchanged if the rebuild fails."""
+    make_builder, wave = block
+    builder = make_builder()
+    builder.write(builder.build())
+
+    metadata = make_metadata()
+    metadata['stimulus']['mark_offset'] = 0.02
+    make_builder(metadata).update(components=['trials'])
+    data, mark, start_times = read_nwb(builder.output_file)
+    np.testing.assert_allclose(start_times, np.array(MARK_ONSETS) + 0.02)
+    np.testing.assert_array_equal(data, wave.T)
+    assert mark.shape == (int(3.5 * MARK_RATE), 1)
+
+    metadata = make_metadata()
+    metadata['stimulus']['mark_offset'] = 0.03
+    failing = make_builder(metadata)
+
+    def fail_tokenize(nwb_content):
+        raise RuntimeError('tokenizer failed')
+
+    monkeypatch.setattr(failing.stimulus_originator.mark_tokenizer, 'tokenize', fail_tokenize)
+    with pytest.raises(RuntimeError, match='tokenizer failed'):
+        failing.update(components=['trials'])
+    np.testing.assert_allclose(read_nwb(builder.output_file)[2], np.array(MARK_ONSETS) + 0.02)
+    with h5py.File(builder.output_file, 'r') as h5_file:
+        assert BACKUP_GROUP not in h5_file
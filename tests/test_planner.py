@@ -0,0 +1,44 @@
+import json
+
+import numpy as np
+
+from nsds_lab_to_nwb.common.planner import ConversionPlanner, ThroughputTable
+
+
+def describe(name, kind, shape, in_memory, chunk_bytes=None):
+    return {'name': name, 'kind': kind, 'shape': shape, 'dtype': np.dtype('float32'), 'rate': 1000.,
+            'in_memory': in_memory, 'chunk_bytes': chunk_bytes}
+
+
+def test_conversion_planner():
+    descriptions = [describe('Wave', 'electrical_series', (10**6, 100), False, chunk_bytes=10**6),
+                    describe('recorded_mark', 'mark', (10**6, 1), True)]
+    throughput = ThroughputTable({'electrical_series': {'read_mb_per_s': 100., 'write_mb_per_s': 50.}})
+    plan = ConversionPlanner('gzip', throughput).plan(descriptions)
+
+    wave, mark = plan['datasets']
+    assert wave['data_bytes'] == 4 * 10**8
+    assert wave['output_bytes'] == 2 * 10**8  # default compression ratio
+    # the reads and writes overlap
+    assert wave['duration'] == wave['write_time'] == 8.
+    assert wave['memory_bytes'] == 10**6 + 2 * 64 * 1024 * 1024
+    assert not mark['streamed']
+    total = plan['total']
+    assert total['peak_memory_bytes'] == 4 * 10**6 + wave['memory_bytes'] + 64 * 1024 * 1024
+
+    plan = ConversionPlanner(None, throughput).plan(descriptions)
+    # no compression and no read-ahead
+    assert plan['datasets'][0]['output_bytes'] == 4 * 10**8
+
+
+def test_throughput_table_from_reports(tmpdir):
+    report = {'datasets': [{'name': 'Wave', 'kind': 'electrical_series', 'bytes_read': 2 * 10**8,
+                            'read_wall_time': 1., 'data_bytes': 2 * 10**8, 'write_wall_time': 4.,
+                            'bytes_written': 5 * 10**7}],
+              'timers': {}}
+    report_file = tmpdir.join('report.json')
+    report_file.write(json.dumps(report))
+    throughput = ThroughputTable.from_reports([str(report_file)])
+    assert throughput.get_rates('electrical_series', compressed=True) == (200., 50., 4.)
+    assert throughput.get_rates('mark', compressed=False) == (
+        ThroughputTable.default_read_mb_per_s, ThroughputTable.default_write_mb_per_s, 1.)
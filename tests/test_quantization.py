@@ -0,0 +1,106 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+from dateutil.tz import tzlocal
+from hdmf.data_utils import DataChunkIterator
+from pynwb import NWBFile, NWBHDF5IO, TimeSeries
+
+from nsds_lab_to_nwb.common.quantization import (QuantizationError, QuantizedChunkIterator,
+                                                 find_quantization)
+from nsds_lab_to_nwb.common.write_profile import WriteProfile
+
+
+def adc_data(shape, scale=3.0517578e-07 * 1.7, seed=0):
+    rng = np.random.default_rng(seed)
+    codes = rng.integers(-32768, 32768, size=shape)
+    return (codes * scale).astype('float32'), scale
+
+
+def test_find_quantization():
+    data, scale = adc_data((5000, 4))
+    conversion, offset = find_quantization(data)
+    assert offset == 0.
+    assert conversion == pytest.approx(scale, rel=1e-6)
+
+    # offset codes
+    codes = np.random.default_rng(1).integers(0, 60000, size=5000)
+    data = (codes * 0.25 + 10.).astype('float32')
+    conversion, offset = find_quantization(data)
+    np.testing.assert_array_equal((np.round((data - offset) / conversion) * conversion + offset).astype('float32'),
+                                  data)
+
+    # not quantized
+    assert find_quantization(np.random.default_rng(2).normal(size=5000).astype('float32')) is None
+    assert find_quantization(np.zeros(100, dtype='float32')) is None
+
+
+def test_write_profile_quantize_array():
+    profile = WriteProfile(quantize=True)
+    data, scale = adc_data((10000, 4))
+    codes, conversion, offset = profile.quantize('electrical_series', data)
+    assert codes.dtype == np.dtype('int16')
+    np.testing.assert_array_equal((codes * conversion + offset).astype('float32'), data)
+
+    # falls back to float if the round trip is not exact
+    data[-1, -1] += 1e-3
+    result, conversion, offset = profile.quantize('electrical_series', data)
+    assert result is data
+    assert (conversion, offset) == (1., 0.)
+
+    # kinds that are not quantized are unchanged
+    assert WriteProfile().quantize('electrical_series', data)[0] is data
+
+
+def test_write_profile_quantize_iterator(tmpdir):
+    profile = WriteProfile('gzip', quantize=True)
+    data, scale = adc_data((20000, 4))
+    iterator = DataChunkIterator(data=data, buffer_size=1000)
+    quantized, conversion, offset = profile.quantize('electrical_series', iterator,
+                                                     read_window=lambda start, stop: data[start:stop])
+    assert isinstance(quantized, QuantizedChunkIterator)
+    assert quantized.dtype == np.dtype('int16')
+
+    nwbfile = NWBFile('test', 'test', datetime.now(tzlocal()))
+    nwbfile.add_acquisition(TimeSeries(name='data', data=profile.wrap('electrical_series', quantized),
+                                       unit='Volts', starting_time=0., rate=1000.,
+                                       conversion=conversion, offset=offset))
+    path = str(tmpdir.join('test.nwb'))
+    with NWBHDF5IO(path, mode='w') as io:
+        io.write(nwbfile)
+
+    with NWBHDF5IO(path, mode='r') as io:
+        series = io.read().acquisition['data']
+        assert series.data.dtype == np.dtype('int16')
+        np.testing.assert_array_equal((series.data[:] * series.conversion + series.offset).astype('float32'),
+                                      data)
+
+
+def test_write_profile_quantize_iterator_fallback():
+    """Tests that an iterator is kept as float if the data outside of the sampled windows is not quantized."""
+    profile = WriteProfile(quantize=True)
+    profile.quantize_check_bytes = 1000 * 4 * 4
+    data, scale = adc_data((200000, 4))
+    # between the sampled windows
+    data[10000, 2] += scale / 2
+    iterator = DataChunkIterator(data=data, buffer_size=1000)
+    windows = []
+
+    def read_window(start, stop):
+        windows.append((start, stop))
+        return data[start:stop]
+
+    result, conversion, offset = profile.quantize('electrical_series', iterator, read_window=read_window)
+    assert result is iterator
+    assert (conversion, offset) == (1., 0.)
+    # the whole data is checked in windows of quantize_check_bytes
+    assert (10000, 11000) in windows
+
+
+def test_quantized_chunk_iterator_error():
+    data, scale = adc_data((1000, 4))
+    data[500, 0] += scale / 2
+    iterator = QuantizedChunkIterator(DataChunkIterator(data=data, buffer_size=400), scale, 0.)
+    next(iterator)
+    with pytest.raises(QuantizationError):
+        next(iterator)
@@ -0,0 +1,79 @@
+import os
+from datetime import datetime
+
+import numpy as np
+import pytest
+import pytz
+from pynwb import NWBFile, TimeSeries
+
+from nsds_lab_to_nwb.common.data_scanners import Dataset
+from nsds_lab_to_nwb.components.stimulus.stimulus_originator import StimulusOriginator
+
+from test_tdt_reader import write_tdt_block
+
+MARK_RATE = 1000.
+EPOC_ONSETS = [0.5, 1.5, 2.5]
+MARK_ONSETS = [0.6, 1.6, 2.6]  # the analog mark track lags the epocs, to tell the sources apart
+TOLERANCE = 1e-5  # the epoc onsets are rounded to the clock ticks of the TDT hardware
+
+
+def make_nwb_content():
+    """NWB file with an analog mark track with a 50 ms pulse at each of MARK_ONSETS."""
+    mark_track = np.zeros((int(3.5 * MARK_RATE), 1), dtype='float32')
+    for onset in MARK_ONSETS:
+        mark_track[int(onset * MARK_RATE):int((onset + 0.05) * MARK_RATE)] = 1.
+    nwb_content = NWBFile(session_description='test', identifier='test',
+                          session_start_time=datetime(2020, 1, 1, tzinfo=pytz.utc))
+    nwb_content.add_stimulus(TimeSeries(name='recorded_mark', data=mark_track, unit='Volts',
+                                        starting_time=0., rate=MARK_RATE))
+    return nwb_content
+
+
+@pytest.fixture
+def block(tmpdir, monkeypatch):
+    """Dataset of a block with a TDT mark epoc, and the metadata of a white noise stimulus."""
+    data_path = str(tmpdir)
+    # the index of the block headers is written to the user cache
+    monkeypatch.setenv('XDG_CACHE_HOME', os.path.join(data_path, 'cache'))
+    tdt_path = os.path.join(data_path, 'RVG02', 'RVG02_B01')
+    os.makedirs(os.path.dirname(tdt_path))
+    write_tdt_block(tdt_path, epocs={'mark': EPOC_ONSETS})
+    dataset = Dataset('RVG02_B01', data_path, tdt_path=tdt_path, mark_path=None, stim_path=data_path)
+    metadata = {'block_name': 'RVG02_B01',
+                'stimulus': {'name': 'wn1', 'duration': 0.1, 'baseline_start': 0., 'baseline_end': 0.,
+                             'mark_offset': 0.01, 'mark_threshold': 0.5, 'nsamples': 3}}
+    return dataset, metadata
+
+
+def get_stim_onsets(stimulus_originator):
+    nwb_content = make_nwb_content()
+    stimulus_originator.make(nwb_content, components=['trials'])
+    return nwb_content.trials.to_dataframe().query('sb == "s"')['start_time'].values
+
+
+@pytest.mark.parametrize('onset_source', ['mark', 'auto', 'epocs'])
+def test_tokenizer_onset_source(block, onset_source):
+    """Tests that the stimulus onsets are thresholded from the mark track by default, or read from the epocs."""
+    dataset, metadata = block
+    kwargs = {} if onset_source == 'mark' else {'onset_source': onset_source}
+    stim_onsets = get_stim_onsets(StimulusOriginator(dataset, metadata, **kwargs))
+    expected = MARK_ONSETS if onset_source == 'mark' else EPOC_ONSETS
+    np.testing.assert_allclose(stim_onsets, np.array(expected) + 0.01, atol=TOLERANCE)
+
+
+def test_tokenizer_cross_check(block, capsys):
+    """Tests that epoc onsets that do not agree with the mark track are reported."""
+    dataset, metadata = block
+    stim_onsets = get_stim_onsets(StimulusOriginator(dataset, metadata, onset_source='epocs', cross_check=True))
+    np.testing.assert_allclose(stim_onsets, np.array(EPOC_ONSETS) + 0.01, atol=TOLERANCE)
+    assert 'do not agree' in capsys.readouterr().out
+
+
+def test_tokenizer_without_tdt_block(block):
+    """Tests that the mark track is thresholded for a block without a TDT tank, unless epocs are required."""
+    dataset, metadata = block
+    dataset.tdt_path = os.path.join(dataset.data_path, 'RVG02', 'RVG02_B02')
+    stim_onsets = get_stim_onsets(StimulusOriginator(dataset, metadata, onset_source='auto'))
+    np.testing.assert_allclose(stim_onsets, np.array(MARK_ONSETS) + 0.01)
+    with pytest.raises(ValueError, match='No TDT mark epocs'):
+        StimulusOriginator(dataset, metadata, onset_source='epocs')
@@ -0,0 +1,267 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from struct import pack
+
+import numpy as np
+import pytest
+import tdt
+
+from nsds_lab_to_nwb.components.tdt.tdt_reader import TDTReader, TDTStreamIterator
+
+SAMPLE_RATE = 24414.0625  # 2 ** -10 * 25 MHz, a sampling rate of the TDT hardware
+BLOCK_START = 1600000000.
+
+
+def tsq_record(size, event_type, code, channel, timestamp, offset, dform, fs):
+    """Pack a 40-byte tsq event header. offset is the tev byte offset, or the value of an epoc event."""
+    code = int.from_bytes(code.encode('ascii'), 'little') if isinstance(code, str) else code
+    offset_format = 'd' if isinstance(offset, float) else 'Q'
+    return pack('<iiIHHd' + offset_format + 'if', size, event_type, code, channel, 0, timestamp, offset, dform, fs)
+
+
+def write_tdt_block(path, streams=(), epocs=(), sev_streams=(), samples_per_packet=64):
+    """Write a TDT block folder with a tsq/tev pair, and a sev file per channel of the sev streams.
+
+    Args:
+        path: block folder
+        streams: dict of stream name -> (float32 data of shape (#channels, #samples), time of the first sample)
+        epocs: dict of epoc name -> onset times
+        sev_streams: dict of stream name -> float32 data of shape (#channels, #samples), starting at time 0
+        samples_per_packet: number of samples per channel in each packet of the tev streams
+    """
+    os.makedirs(path)
+    block_name = os.path.basename(path)
+    events = []  # (time, tsq record)
+    tev = bytearray()
+    for name, (data, first_time) in dict(streams).items():
+        for start in range(0, data.shape[1], samples_per_packet):
+            timestamp = first_time + start / SAMPLE_RATE
+            for channel, row in enumerate(data, 1):
+                packet = row[start:start + samples_per_packet].astype('float32').tobytes()
+                events.append((timestamp, tsq_record(10 + samples_per_packet, tdt.EVTYPE_STREAM, name, channel,
+                                                     BLOCK_START + timestamp, len(tev), tdt.DFORM_FLOAT,
+                                                     SAMPLE_RATE)))
+                tev += packet
+    for name, onsets in dict(epocs).items():
+        for value, onset in enumerate(onsets, 1):
+            events.append((onset, tsq_record(10, tdt.EVTYPE_STRON, name, 0, BLOCK_START + onset, float(value),
+                                             tdt.DFORM_DOUBLE, 0.)))
+    events.sort(key=lambda event: event[0])
+    stop_time = events[-1][0] + 1. if events else 1.
+    with open(os.path.join(path, block_name + '.tsq'), 'wb') as f:
+        f.write(tsq_record(0, 0, 0, 0, 0., 0, 0, 0.))
+        f.write(tsq_record(0, 0, tdt.EVMARK_STARTBLOCK, 0, BLOCK_START, 0, 0, 0.))
+        for _, record in events:
+            f.write(record)
+        f.write(tsq_record(0, 0, tdt.EVMARK_STOPBLOCK, 0, BLOCK_START + stop_time, 0, 0, 0.))
+    with open(os.path.join(path, block_name + '.tev'), 'wb') as f:
+        f.write(tev)
+    with open(os.path.join(path, block_name + '.tnt'), 'w') as f:
+        f.write('1\n')  # notes file with the file version only
+    for name, data in dict(sev_streams).items():
+        for channel, row in enumerate(data, 1):
+            payload = row.astype('float32').tobytes()
+            # version 3 header: the sampling rate is 2 ** (rate - 12) * 25 MHz / decimate
+            header = pack('<Q3sB4sHHHHBBH', 40 + len(payload), b'SEV', 3, name.encode('ascii'), channel,
+                          len(data), 4, 0, tdt.DFORM_FLOAT, 1, 2)
+            with open(os.path.join(path, '{}_{}_Ch{}.sev'.format(block_name, name, channel)), 'wb') as f:
+                f.write(header.ljust(40, b'\0') + payload)
+
+
+@pytest.fixture
+def tdt_block(tmpdir):
+    """Block with a 3-channel tev stream Wave whose first packet is at 0.0123 s, a 2-channel sev-only
+    stream Wav5, and a mark epoc."""
+    rng = np.random.RandomState(0)
+    wave = rng.randn(3, 64 * 20).astype('f')
+    wav5 = rng.randn(2, 500).astype('f')
+    path = os.path.join(str(tmpdir), 'RVG02_B01')
+    write_tdt_block(path, streams={'Wave': (wave, 0.0123)}, epocs={'mark': [0.02, 0.03, 0.045]},
+                    sev_streams={'Wav5': wav5})
+    return path, wave, wav5
+
+
+def test_tdt_reader_lazy(tdt_block):
+    """Tests that a lazy reader reads the streams on demand, with the same data as an eager reader."""
+    path, wave, wav5 = tdt_block
+    eager = TDTReader(path)
+    lazy = TDTReader(path, lazy=True)
+    assert lazy.tdt_obj is None
+    assert sorted(lazy.streams) == sorted(eager.streams) == ['Wav5', 'Wave']
+
+    meta = lazy.get_metadata('Wave')
+    assert (meta['num_channels'], meta['num_samples'], meta['dtype']) == (3, wave.shape[1], np.dtype('float32'))
+    data, meta = lazy.get_data('Wave')
+    np.testing.assert_array_equal(data, wave)
+    np.testing.assert_array_equal(data, eager.get_data('Wave')[0])
+    assert meta['channel_ids'] == [1, 2, 3]
+    lazy.release_stream('Wave')
+
+    # the stream that only exists as sev files
+    np.testing.assert_array_equal(lazy.get_data('Wav5')[0], eager.get_data('Wav5')[0])
+    np.testing.assert_array_equal(lazy.get_data('Wav5')[0][:, :500], wav5)
+
+
+def test_tdt_reader_lazy_threads(tdt_block):
+    """Tests that the streams of a lazy reader can be read in concurrent threads."""
+    path, wave, wav5 = tdt_block
+    lazy = TDTReader(path, lazy=True)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(lazy.get_data, stream, channels) for stream, channels in
+                   (('Wave', None), ('Wave', [2]), ('Wav5', None), ('Wave', None))]
+        results = [future.result()[0] for future in futures]
+    np.testing.assert_array_equal(results[0], wave)
+    np.testing.assert_array_equal(results[1], wave[1])
+    np.testing.assert_array_equal(results[2][:, :500], wav5)
+    np.testing.assert_array_equal(results[3], wave)
+
+
+def test_tdt_reader_lazy_store_filter(tdt_block, monkeypatch):
+    """Tests that reading a tev stream lazily does not read the stores that only exist as sev files."""
+    path, wave, wav5 = tdt_block
+    lazy = TDTReader(path, lazy=True)
+    sev_reads = []
+    read_sev = tdt.read_sev
+
+    def record_read_sev(*args, **kwargs):
+        sev_reads.append(kwargs.get('event_name'))
+        return read_sev(*args, **kwargs)
+
+    # read_block calls read_sev of its own module
+    monkeypatch.setattr(tdt, 'read_sev', record_read_sev)
+    monkeypatch.setattr(tdt.TDTbin2py, 'read_sev', record_read_sev)
+    np.testing.assert_array_equal(lazy.get_data('Wave')[0], wave)
+    lazy.release_stream('Wave')
+    lazy.get_data_window('Wave', 0.02, 0.03)
+    assert not any(sev_reads)
+
+
+def test_tdt_reader_lazy_sev_metadata(tdt_block, monkeypatch):
+    """Tests that the metadata of a stream that only exists as sev files is read from the sev headers."""
+    path, wave, wav5 = tdt_block
+    lazy = TDTReader(path, lazy=True)
+
+    def fail_read(*args, **kwargs):
+        raise AssertionError('the stream data was read')
+
+    monkeypatch.setattr(tdt, 'read_sev', fail_read)
+    meta = lazy.get_metadata('Wav5')
+    assert meta['sample_rate'] == SAMPLE_RATE
+    assert (meta['channel_ids'], meta['num_channels'], meta['num_samples']) == ([1, 2], 2, wav5.shape[1])
+    assert meta['dtype'] == np.dtype('float32')
+    assert lazy.get_metadata('Wav5', channels=[2])['channel_ids'] == [2]
+
+
+def read_iterator(iterator):
+    """Write the chunks of a data chunk iterator into an array of its maximum shape."""
+    out = np.zeros(iterator.maxshape, dtype=iterator.dtype)
+    for chunk in iterator:
+        out[chunk.selection] = chunk.data
+    return out
+
+
+@pytest.mark.parametrize('time_block', [333, 64, None])
+def test_tdt_stream_iterator(tdt_block, time_block):
+    """Tests that streaming windows of a stream that does not start with the block gives the eager data."""
+    path, wave, wav5 = tdt_block
+    eager = TDTReader(path)
+    lazy = TDTReader(path, lazy=True)
+    expected = eager.get_data('Wave')[0].T
+    for reader in (lazy, eager):
+        iterator = TDTStreamIterator(reader, 'Wave', time_block=time_block)
+        assert iterator.maxshape == expected.shape
+        np.testing.assert_array_equal(read_iterator(iterator), expected)
+    np.testing.assert_array_equal(lazy.get_data_window('Wave', 100 / SAMPLE_RATE, 200 / SAMPLE_RATE), wave[:, 100:200])
+
+    # sev-only streams start with the block
+    iterator = TDTStreamIterator(lazy, 'Wav5', time_block=time_block)
+    np.testing.assert_array_equal(read_iterator(iterator)[:500], wav5.T)
+
+
+def test_tdt_stream_iterator_release(tdt_block, monkeypatch):
+    """Tests that an iterator over a loaded stream does not read it again, and releases it once it is done."""
+    path, wave, wav5 = tdt_block
+    lazy = TDTReader(path, lazy=True)
+    lazy.get_data('Wave')
+    assert 'dtype' not in lazy.get_metadata('Wave')
+
+    def fail_get_data(*args, **kwargs):
+        raise AssertionError('the stream was read again')
+
+    monkeypatch.setattr(lazy, 'get_data', fail_get_data)
+    iterator = TDTStreamIterator(lazy, 'Wave', time_block=500)
+    assert iterator.dtype == np.dtype('float32')
+    np.testing.assert_array_equal(read_iterator(iterator), wave.T)
+    # the metadata is read from the headers again once the stream is released
+    assert lazy.get_metadata('Wave')['dtype'] == np.dtype('float32')
+
+
+@pytest.mark.parametrize('lazy', [True, False])
+def test_tdt_reader_channels(tdt_block, lazy):
+    """Tests that only the selected channels are returned, in the order of the selection."""
+    path, wave, wav5 = tdt_block
+    reader = TDTReader(path, lazy=lazy)
+    data, meta = reader.get_data('Wave', channels=[3, 1])
+    np.testing.assert_array_equal(data, wave[[2, 0]])
+    assert (meta['channel_ids'], meta['num_channels'], meta['num_samples']) == ([3, 1], 2, wave.shape[1])
+    np.testing.assert_array_equal(reader.get_data_window('Wave', 0., 100 / SAMPLE_RATE, channels=[2, 3]),
+                                  wave[1:, :100])
+    iterator = TDTStreamIterator(reader, 'Wave', time_block=100, channels=[3, 1])
+    np.testing.assert_array_equal(read_iterator(iterator), wave[[2, 0]].T)
+    iterator = TDTStreamIterator(reader, 'Wave', time_block=100, channels=[2])
+    assert iterator.maxshape == (wave.shape[1],)
+    np.testing.assert_array_equal(read_iterator(iterator), wave[1])
+
+    # the channels of the reader
+    reader = TDTReader(path, lazy=lazy, channels=[2, 3])
+    np.testing.assert_array_equal(reader.get_data('Wave')[0], wave[1:])
+
+
+def test_tdt_stream_iterator_chunks(tdt_block, monkeypatch):
+    """Tests that the windows are returned as contiguous time-major chunks, transposed block by block."""
+    path, wave, wav5 = tdt_block
+    monkeypatch.setattr(TDTStreamIterator, 'transpose_block', 7)
+    iterator = TDTStreamIterator(TDTReader(path, lazy=True), 'Wave', memory_budget=3 * 4 * 500)
+    assert iterator.time_block == 500
+    chunks = list(iterator)
+    assert [chunk.selection for chunk in chunks] == [np.s_[0:500, :], np.s_[500:1000, :], np.s_[1000:1280, :]]
+    for chunk in chunks:
+        assert chunk.data.flags['C_CONTIGUOUS']
+        np.testing.assert_array_equal(chunk.data, wave.T[chunk.selection])
+
+
+def test_tdt_reader_index_file(tdt_block, tmpdir_factory, monkeypatch):
+    """Tests that the parsed block headers are cached in an index that is invalidated by changes of the tsq file."""
+    path, wave, wav5 = tdt_block
+    index_file = os.path.join(str(tmpdir_factory.mktemp('index')), 'block.tdtindex.npz')
+    reader = TDTReader(path, lazy=True, index_file=index_file)
+    assert reader.index_file == index_file and os.path.isfile(index_file)
+
+    read_block = tdt.read_block
+
+    def read_block_without_headers(block_path, **kwargs):
+        if isinstance(kwargs.get('headers'), int) and kwargs['headers'] == 1:
+            raise AssertionError('the tsq file must not be parsed again')
+        return read_block(block_path, **kwargs)
+
+    with monkeypatch.context() as m:
+        m.setattr(tdt, 'read_block', read_block_without_headers)
+        cached = TDTReader(path, lazy=True, index_file=index_file)
+        assert cached.index_file == index_file
+        assert cached.get_metadata('Wave') == reader.get_metadata('Wave')
+        np.testing.assert_array_equal(cached.get_events(), reader.get_events())
+        np.testing.assert_array_equal(cached.get_data_window('Wave', 0., 100 / SAMPLE_RATE), wave[:, :100])
+        # an eager reader also reads the block with the cached headers
+        np.testing.assert_array_equal(TDTReader(path, index_file=index_file).get_data('Wave')[0], wave)
+
+    # changing the tsq file invalidates the index
+    shutil.rmtree(path)
+    write_tdt_block(path, streams={'Wave': (wave, 0.0123)}, epocs={'mark': [0.02, 0.03]})
+    assert len(TDTReader(path, lazy=True, index_file=index_file).get_events()) == 2
+
+    # the default index is kept in the user cache directory
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir_factory.mktemp('cache')))
+    reader = TDTReader(path, lazy=True, index_file=True)
+    assert reader.index_file == TDTReader.get_index_file(path)
+    assert reader.index_file.startswith(os.environ['XDG_CACHE_HOME'])
@@ -0,0 +1,77 @@
+import json
+import pickle
+from datetime import datetime
+
+import h5py
+import numpy as np
+from dateutil.tz import tzlocal
+from hdmf.data_utils import DataChunkIterator
+from pynwb import NWBFile, NWBHDF5IO, TimeSeries
+
+from nsds_lab_to_nwb.common.throughput import ThroughputReport
+from nsds_lab_to_nwb.common.write_profile import WriteProfile
+
+
+def test_throughput_report(tmpdir):
+    report = ThroughputReport()
+    profile = WriteProfile('gzip')
+    profile.report = report
+
+    data = np.zeros((10000, 4), dtype='f')
+    iterator = DataChunkIterator(data=data, buffer_size=1000)
+    mark = np.zeros(5000, dtype='f')
+    with profile.count_read('mark', 'recorded_mark'):
+        mark_data = profile.wrap('mark', mark, name='recorded_mark')
+
+    nwbfile = NWBFile('test', 'test', datetime.now(tzlocal()))
+    nwbfile.add_acquisition(TimeSeries(name='Wave', unit='Volts', starting_time=0., rate=1000.,
+                                       data=profile.wrap('electrical_series', iterator, name='Wave')))
+    nwbfile.add_stimulus(TimeSeries(name='recorded_mark', data=mark_data, unit='Volts',
+                                    starting_time=0., rate=1000.))
+    path = str(tmpdir.join('test.nwb'))
+    with NWBHDF5IO(path, mode='w') as io:
+        io.write(nwbfile)
+    report.update_storage(path)
+
+    counters = report.to_dict()['datasets']
+    assert [c['name'] for c in counters] == ['recorded_mark', 'Wave']
+    mark_counter, wave_counter = counters
+    assert mark_counter['bytes_read'] == mark.nbytes
+    assert wave_counter['bytes_read'] == data.nbytes
+    assert wave_counter['data_bytes'] == data.nbytes
+    # zeros compress well
+    assert wave_counter['compression_ratio'] > 10
+    assert wave_counter['write_wall_time'] is not None
+
+    report.add_time('write', 1.)
+    report_file = report.write(str(tmpdir.join('report.json')))
+    with open(report_file) as f:
+        assert json.load(f)['timers'] == {'write': 1.}
+
+
+def test_throughput_report_device_file(tmpdir):
+    """Tests the counters of a dataset written to a device file, returned from a worker and linked into the NWB file."""
+    worker_report = ThroughputReport()
+    profile = WriteProfile('gzip')
+    profile.report = worker_report
+    data = np.zeros((10000, 4), dtype='f')
+    device_file = str(tmpdir.join('Wave.h5'))
+    with profile.open_file(device_file, mode='w') as h5_file:
+        profile.write_dataset(h5_file, 'data', 'electrical_series', DataChunkIterator(data=data, buffer_size=1000),
+                              report_name='Wave')
+    # the counter is pickled to return it from the worker process
+    counter = pickle.loads(pickle.dumps(worker_report.counters['Wave']))
+    assert counter.bytes_read == data.nbytes
+    assert 0 < counter.bytes_written < data.nbytes
+
+    report = ThroughputReport()
+    report.add_counter(counter)
+    path = str(tmpdir.join('test.nwb'))
+    with h5py.File(path, 'w') as h5_file:
+        h5_file['/acquisition/Wave/data'] = h5py.ExternalLink('Wave.h5', '/data')
+    counter.bytes_written = None
+    report.update_storage(path)
+    wave_counter = report.to_dict()['datasets'][0]
+    assert (wave_counter['name'], wave_counter['bytes_read'], wave_counter['data_bytes']) == \
+        ('Wave', data.nbytes, data.nbytes)
+    assert wave_counter['compression_ratio'] > 10
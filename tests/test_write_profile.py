@@ -0,0 +1,96 @@
+from datetime import datetime
+import threading
+
+import numpy as np
+import pytest
+from dateutil.tz import tzlocal
+from hdmf.backends.hdf5 import H5DataIO
+from hdmf.data_utils import DataChunkIterator
+from pynwb import NWBFile, NWBHDF5IO, TimeSeries
+
+from nsds_lab_to_nwb.common.buffered_iterator import BufferedChunkIterator
+from nsds_lab_to_nwb.common.write_profile import WriteProfile
+
+
+def test_write_profile_presets():
+    profile = WriteProfile()
+    data = np.zeros((100, 4), dtype='f')
+    assert profile.wrap('electrical_series', data) is data
+
+    profile = WriteProfile('gzip')
+    wrapped = profile.wrap('electrical_series', data)
+    assert isinstance(wrapped, H5DataIO)
+    assert wrapped.io_settings['compression'] == 'gzip'
+    assert wrapped.io_settings['shuffle']
+    # chunks are clipped to the data shape
+    assert wrapped.io_settings['chunks'] == (100, 4)
+
+    assert profile.get_chunk_shape('electrical_series', (10**6, 128)) == (16384, 16)
+    assert profile.get_chunk_shape('mark', (10**6,)) == (65536,)
+    assert WriteProfile.get(profile) is profile
+
+    with pytest.raises(ValueError):
+        WriteProfile('unknown')
+    with pytest.raises(ValueError):
+        profile.wrap('unknown', data)
+
+
+def test_write_profile_yaml(tmpdir):
+    profile_file = tmpdir.join('profile.yaml')
+    profile_file.write('electrical_series:\n  chunk_time: 32\n  compression: lzf\n')
+    profile = WriteProfile(str(profile_file))
+
+    iterator = DataChunkIterator(data=np.zeros((100, 4), dtype='f'), buffer_size=10)
+    wrapped = profile.wrap('electrical_series', iterator)
+    assert wrapped.io_settings['chunks'] == (32, 4)
+    assert wrapped.io_settings['compression'] == 'lzf'
+    # the iterator is read ahead of the writer
+    assert isinstance(wrapped.data, BufferedChunkIterator)
+    assert wrapped.data.data is iterator
+    # no settings for the other kinds, and no read-ahead
+    profile = WriteProfile.get(profile, num_buffers=0)
+    assert profile.wrap('mark', iterator) is iterator
+
+
+def test_write_profile_nwb(tmpdir):
+    profile = WriteProfile('gzip')
+    data = np.arange(200000, dtype='f')
+    nwbfile = NWBFile('test', 'test', datetime.now(tzlocal()))
+    nwbfile.add_stimulus(TimeSeries(name='recorded_mark', data=profile.wrap('mark', data),
+                                    unit='Volts', starting_time=0., rate=1000.))
+
+    path = str(tmpdir.join('test.nwb'))
+    with profile.open_file(path, mode='w') as h5_file:
+        with NWBHDF5IO(mode='w', file=h5_file) as io:
+            io.write(nwbfile)
+
+    with NWBHDF5IO(path, mode='r') as io:
+        dataset = io.read().stimulus['recorded_mark'].data
+        assert dataset.compression == 'gzip'
+        assert dataset.chunks == (65536,)
+        np.testing.assert_array_equal(dataset[:], data)
+
+
+def test_write_profile_write_dataset(tmpdir):
+    profile = WriteProfile('gzip', buffer_size=4096)
+    data = np.arange(1000 * 4, dtype='f').reshape(1000, 4)
+    iterator = DataChunkIterator(data=data, buffer_size=128)
+    with profile.open_file(str(tmpdir.join('device.h5')), mode='w') as h5_file:
+        dataset = profile.write_dataset(h5_file, 'data', 'electrical_series', iterator)
+        assert dataset.compression == 'gzip'
+        np.testing.assert_array_equal(dataset[:], data)
+
+
+def test_write_profile_close():
+    """Tests that closing the profile stops the read-ahead of an iterator the writer gave up on."""
+    profile = WriteProfile(num_buffers=1, buffer_size=100 * 4 * 4)
+    data = np.arange(1000 * 4, dtype='f').reshape(1000, 4)
+    iterator = profile.wrap('electrical_series', DataChunkIterator(data=data, buffer_size=100))
+    assert isinstance(iterator, BufferedChunkIterator)
+    next(iterator)
+    # the producer thread now waits for the buffer of the first chunk
+    assert any(thread.name == 'BufferedChunkIterator' for thread in threading.enumerate())
+    profile.close()
+    assert not any(thread.name == 'BufferedChunkIterator' for thread in threading.enumerate())
+    with pytest.raises(StopIteration):
+        next(iterator)